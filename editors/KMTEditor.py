@@ -23,7 +23,17 @@ import matplotlib.patches as mpatches
 from matplotlib.collections import PatchCollection
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 
-from cesmGUITools.utilities import nccopy
+from cesmGUITools.utilities.gridio import read_kmt_grid, write_kmt_file
+from cesmGUITools.utilities.areaweights import cell_weights, WeightedStats
+from cesmGUITools.utilities.viewcache import ViewCache, prepare_view, face_colors
+from cesmGUITools.utilities.prefetch import ViewPrefetcher
+from cesmGUITools.utilities.qtasks import TaskRunner, TaskCancelled, run_with_progress
+from cesmGUITools.utilities.gridsession import GridSession
+from cesmGUITools.utilities.latency import LatencyRecorder, timed_interaction, timed_stage
+from cesmGUITools.utilities.bgsave import BackgroundSaver
+from cesmGUITools.utilities.journal import EditJournal, read_journal, orphaned_journals, discard_journals
+from cesmGUITools.utilities.changelog import read_changes, latest_changes
+from cesmGUITools.utilities.kmtcheck import PathologyScanner
 
 mpl.rc('axes',edgecolor='w')
 
@@ -40,18 +50,24 @@ class DataContainer(object):
             self.y = 0           # Y-position of the cursor
 
 
-    def __init__(self, nrows, ncols, fname, datavar):
+    def __init__(self, nrows, ncols, fname, datavar, shared=False, progress=None):
         """
         ARGUMENTS
-            nrows - number of rows for the view
-            ncols - number of columns for the view
-            fname - name of the data file.
-            scale - a multiplicative scale factor for the data to be visualized and edited
+            nrows  - number of rows for the view
+            ncols  - number of columns for the view
+            fname  - name of the data file.
+            scale  - a multiplicative scale factor for the data to be visualized and edited
+            shared - if True, the grid is shared with the other editors open on the same file
+                     (see gridsession.py)
+            progress - optionally, the progress function of the task that reads the file in the
+                     background (see qtasks.py), called between the stages of the reading
         """
         self.fname   = fname
         self.datavar = datavar
+        # The shared grid session, or None
+        self.session = GridSession.attach(fname, datavar) if shared else None
         self.__read_nc_file()
-        self.orig_data = np.copy(self.data)
+        self.orig_data = np.copy(self.data) if self.session is None else self.session.orig
         self.ny, self.nx = self.data.shape
 
 
@@ -69,23 +85,109 @@ class DataContainer(object):
         # The columns store: i index, j index, new value
         self.changes = np.zeros((self.ny*self.nx, 3), dtype=np.int32)
         self.changes_row_idx = 0
+        self.__stage(progress, "Reading the changes")
+        self.loadChanges()
+
+        self.__stage(progress, "Reading the cell areas")
+        # Area weights for the statistics, used when the weighted statistics are switched on (W key)
+        weights, self.weights_source = cell_weights(self.fname, self.kmt_lats, flip=True)
+        self.wstats   = WeightedStats(self.data, weights)
+        self.weighted = False
+        # Views prepared in the background by the editor, see prepareView
+        self.viewcache = ViewCache()
+        # Times the stages of the interactions. Replaced by the recorder of the editor.
+        self.latency = LatencyRecorder()
+        # Cells highlighted from a changes table loaded from another file (e.g. made by ncdiff.py).
+        # A (n, 2) array of i, j indices, or None.
+        self.overlay = None
+        # Incremented on every edit. A save records the generation of the snapshot it
+        # wrote so that edits made while the save was running are not lost track of.
+        self.generation = 0
+        # The write-ahead journal of edits. Set by the editor once it has dealt with any
+        # journal left behind by a previous session.
+        self.journal = None
+        # Finds the problem cells (isolated points, narrow channels, pits, lakes). Created on the
+        # first jump to a problem, and kept up to date with the edits from then on.
+        self.scanner = None
 
         # A cursor object on the view
         self.cursor = DataContainer.Cursor()
 
 
+    def __stage(self, progress, msg):
+        """ Reports a stage of the reading, detaching from the session if the reading has been cancelled. """
+        if progress is None: return
+        try:
+            progress(msg)
+        except TaskCancelled:
+            if self.session is not None: self.session.detach()
+            raise
+
+
     def __read_nc_file(self):
         """ This subroutine reads the netCDF4 data file. """
-        ncfile        = Dataset(self.fname, "r", format="NETCDF4")
-        # We are flipping the arrays so that the latitudes go from 90:-90
-        self.data     = np.flipud(ncfile.variables[self.datavar][:,:])
-        self.kmt_lons = np.flipud(ncfile.variables["ULON"][:,:])
-        self.kmt_lats = np.flipud(ncfile.variables["ULAT"][:,:])
-        ncfile.close()
+        if self.session is not None:
+            # The arrays of the session are mapped from shared memory. Edits are made to them in place.
+            self.data, self.kmt_lons, self.kmt_lats = self.session.data, self.session.lons, self.session.lats
+            return
+        # The arrays are flipped so that the latitudes go from 90:-90
+        self.data, self.kmt_lons, self.kmt_lats = read_kmt_grid(self.fname, self.datavar)
+
+
+
+    def loadChanges(self):
+        """
+        A file saved by this editor records the changes made to it and the original data. These
+        are read back so that the edited cells are highlighted again when the file is reopened,
+        and so that the next save keeps the whole history of changes.
+        """
+        changes, original = read_changes(self.fname)
+        if original is not None and original.shape == self.data.shape: self.orig_data = original
+        if changes is None or len(changes) == 0: return
+        # Only the last edit of each cell is kept, which also keeps the table within its ny*nx rows
+        changes = latest_changes(changes, self.data.shape)
+        self.changes[:len(changes), :] = changes
+        self.changes_row_idx = len(changes)
+
+
+
+    def loadOverlay(self, fname):
+        """
+        Loads the changes table of another file as an overlay of highlighted cells. The data is not changed.
+        RETURNS
+            the number of cells in the overlay
+        RAISES
+            ValueError if the file has no changes table or it does not fit this grid
+        """
+        changes, original = read_changes(fname)
+        if changes is None:
+            raise ValueError("{0} has no changes table".format(fname))
+        self.overlay = latest_changes(changes, self.data.shape)[:, 0:2].astype(np.intp)
+        return len(self.overlay)
+
+
 
+    @timed_stage()
+    def getViewStatistics(self): return self.viewStatistics(self.view, self.si, self.sj)
 
 
-    def getViewStatistics(self): return (self.view.min(), self.view.max(), self.view.mean())
+    def viewStatistics(self, view, si, sj):
+        """ Returns the min, max and mean of a view whose top left cell is (si, sj). """
+        mean = self.wstats.viewMean(view, si, sj) if self.weighted else view.mean()
+        return (view.min(), view.max(), mean)
+
+
+    def prepareView(self, si, sj, colorize=None):
+        """
+        Prepares the view at (si, sj) for the view cache. This is called by the prefetch thread,
+        and only reads the data.
+        """
+        return prepare_view(self.data, si, sj, self.nrows, self.ncols, self.viewStatistics, colorize)
+
+
+    def getGlobalMean(self):
+        """ Returns the mean of the whole grid, weighted by area if the weighted statistics are on. """
+        return self.wstats.mean() if self.weighted else self.data.mean()
 
 
     def getCursor(self): return self.cursor
@@ -116,6 +218,7 @@ class DataContainer(object):
             self.cursor.x = min(self.ncols-1, self.cursor.x + 1)
 
 
+    @timed_stage()
     def updateView(self, si, sj):
         """
         Updates the data for the view.
@@ -137,7 +240,9 @@ class DataContainer(object):
 
         self.si   = si
         self.sj   = sj
-        return self.getViewStatistics()
+        # The statistics of a view prepared in the background are ready
+        item = self.viewcache.get((si, sj))
+        return item["stats"] if item is not None else self.getViewStatistics()
 
 
     def updateMask(self): self.view_masked.mask = (self.view == 0)
@@ -168,6 +273,7 @@ class DataContainer(object):
             return self.updateView(new_si, self.sj)
 
 
+    @timed_stage()
     def modifyValue(self, inp):
         """
         Modify the value for a particular pixel. The location of the pixel is that
@@ -178,15 +284,92 @@ class DataContainer(object):
         ci, cj = self.viewIndex2GlobalIndex(self.cursor.y, self.cursor.x)
         
         _tmp = int(float(inp))
+        old  = self.data[ci, cj]
         self.data[ci, cj] = _tmp
+        self.wstats.update(ci, cj, old, self.data[ci, cj])
+        self.viewcache.invalidate(ci, cj)
+        if self.session: self.session.publish(ci, cj, old, _tmp)
         self.changes[self.changes_row_idx, :] = ci, cj, _tmp
         self.changes_row_idx += 1
+        self.generation += 1
+        if self.journal: self.journal.append_point(ci, cj, _tmp)
+        if self.scanner: self.scanner.update(ci, cj)
 
         # Now that we have changed a value, we have to update the continent mask as
         # well, in case the update entailed creating or destroying land.
         self.updateMask()
 
 
+    def recordChanges(self, points_i, points_j, vals):
+        """
+        Appends the edit of a group of cells to the changes table.
+        ARGUMENTS
+            points_i, points_j - arrays with the global row and column indices of the cells
+            vals               - an array with the new value of each cell, or a single value
+        """
+        new = np.empty((len(points_i), 3))
+        new[:,0], new[:,1], new[:,2] = points_i, points_j, vals
+        if self.changes_row_idx + len(new) > self.changes.shape[0]:
+            # The table is full. Only the last edit of each cell is needed to highlight the
+            # edited cells, and there are at most ny*nx of those.
+            new = latest_changes(np.concatenate((self.changes[:self.changes_row_idx], new)), self.data.shape)
+            self.changes_row_idx = 0
+        self.changes[self.changes_row_idx:self.changes_row_idx+len(new), :] = new
+        self.changes_row_idx += len(new)
+
+
+    def replayJournal(self, records):
+        """
+        Re-applies edits recovered from the journal of a previous session.
+        ARGUMENTS
+            records - a list of (i, j, vals) tuples of arrays as returned by read_journal
+        RETURNS
+            the number of cells that were edited
+        """
+        ncells = 0
+        for i, j, vals in records:
+            n = len(i)
+            old = self.data[i, j]
+            self.data[i, j] = vals
+            self.wstats.update(i, j, old, self.data[i, j])
+            self.viewcache.invalidate(i, j)
+            if self.session: self.session.publish(i, j, old, self.data[i, j])
+            self.recordChanges(i, j, vals)
+            self.generation += 1
+            if self.journal: self.journal.append_bulk(i, j, vals)
+            ncells += n
+        if self.view_masked is not None: self.updateMask()
+        if self.scanner: self.scanner.scan()
+        return ncells
+
+
+    def applySessionEdits(self, edits):
+        """
+        Brings the statistics, the problem cells and the changes table up to date with the edits that
+        the other editors of the session made to the shared KMT, which are already in self.data.
+        ARGUMENTS
+            edits - a list of (i, j, old, new) tuples of arrays as returned by GridSession.poll
+        RETURNS
+            the number of cells that were edited
+        """
+        ncells = 0
+        for i, j, old, new in edits:
+            n = len(i)
+            self.wstats.update(i, j, old, new)
+            self.viewcache.invalidate(i, j)
+            # The edits are recorded in the changes table, so that they are highlighted and saved,
+            # but not journalled, which is up to the editor that made them
+            self.recordChanges(i, j, new)
+            self.generation += 1
+            if self.scanner:
+                if n > 64: self.scanner.scan()
+                else:
+                    for ci, cj in zip(i, j): self.scanner.update(ci, cj)
+            ncells += n
+        if self.view_masked is not None: self.updateMask()
+        return ncells
+
+
     def getAverage(self):
         """
         Returns the average value at the cursor computed from the values of the surrounding cells. This
@@ -201,31 +384,86 @@ class DataContainer(object):
 
 
 
+    def findProblem(self, step):
+        """
+        Finds the next problem cell after the cursor in row-major order (or the previous one if
+        step is negative), scanning the grid on first use.
+        RETURNS
+            a tuple (i, j, kinds) with the global indices of the cell and the list of its kinds of
+            problem, or None if there are no problems
+        """
+        if self.scanner is None: self.scanner = PathologyScanner(self.data)
+        ci, cj = self.viewIndex2GlobalIndex(self.cursor.y, self.cursor.x)
+        found  = self.scanner.next(ci, cj, step)
+        if found is None: return None
+        return found + (self.scanner.problemsAt(*found),)
+
+
+    def centreView(self, i, j):
+        """
+        Moves the view so that the global cell (i, j) is (as near as possible) at its centre, and
+        puts the cursor on that cell.
+        RETURNS
+            Statistics of the newly updated view (a tuple with the min, max, and the mean for the new view)
+        """
+        si = min(max(0, i - self.nrows//2), self.ny - self.nrows)
+        sj = min(max(0, j - self.ncols//2), self.nx - self.ncols)
+        stats = self.updateView(si, sj)
+        self.cursor.y, self.cursor.x = i - si, j - sj
+        return stats
+
+
     def viewIndex2GlobalIndex(self, i, j):
         """ Converts an i,j index into the data window into an index for the
         same element into the global data. """
         return (self.si + i, self.sj + j)
 
 
+    def snapshot(self):
+        """
+        Returns a snapshot of the edited state that can be written to disk while editing
+        continues. Copying the in-memory arrays is a plain memcpy, which is orders of
+        magnitude cheaper than the netCDF write that follows.
+        RETURNS
+            a tuple (generation, data, orig_data, changes)
+        """
+        return (self.generation, self.data.copy(), self.orig_data,
+                self.changes[0:self.changes_row_idx,:].copy())
+
+
 
 class KMTEditor(QMainWindow):
 
+    # The kind of interaction of each key, for the latency timings (see latency.py)
+    KEY_INTERACTIONS = {Qt.Key_H: "pan", Qt.Key_J: "pan", Qt.Key_K: "pan", Qt.Key_L: "pan",
+                        Qt.Key_Up: "cursor", Qt.Key_Down: "cursor", Qt.Key_Left: "cursor", Qt.Key_Right: "cursor",
+                        Qt.Key_V: "edit", Qt.Key_A: "edit", Qt.Key_N: "jump", Qt.Key_P: "jump"}
+
     KMT_MIN_VAL = 0
     KMT_MAX_VAL = 60
 
-    def __init__(self, fname, datavar, dwx=60, dwy=60):
+    def __init__(self, fname, datavar, dwx=60, dwy=60, dc=None, latency_log=None):
         """
         ARGUMENTS:
             fname    - Name of the netcdf4 file
             datavar  - Name of the data variable in the file for which to plot
             dwx, dwy - size of the DataContainer in number of array elements
             scale    - A float that will be multiplied with the data to scale the data
+            dc       - the DataContainer, if it has already been read (see main)
+            latency_log - a .json or .csv file to write the timings of the interactions to on exit
         """
         super(KMTEditor, self).__init__(None)
         self.setWindowTitle('KMTEditor - {0}'.format(fname))
 
         #  Creating a variable that contains all the data
-        self.dc = DataContainer(dwy, dwx, fname, datavar)
+        self.dc = dc if dc is not None else DataContainer(dwy, dwx, fname, datavar)
+        # Times the interactions (see latency.py). Off unless a log file is given or the HUD is shown.
+        self.latency     = LatencyRecorder(enabled=latency_log is not None)
+        self.latency_log = latency_log
+        self.latency_hud = None
+        self.dc.latency  = self.latency
+        self.unsaved_changes_exist = False
+        self.setup_journal()
 
         self.cursor = self.dc.getCursor()  # Defining a cursor on the data
         # This is the Rectangle boundary drawn on the world map that bounds the region
@@ -245,7 +483,25 @@ class KMTEditor(QMainWindow):
         # Stuff for saving data
         self.ofile = None   # Name of output file
         self.asked_about_overwrite_permission = False
-        self.unsaved_changes_exist = False
+
+        # Saves are written by a worker thread so that the window does not freeze
+        self.saver = BackgroundSaver(self)
+        self.connect(self.saver, SIGNAL("saveProgress(QString)"), self.on_save_progress)
+        self.connect(self.saver, SIGNAL("saveFinished(int, QString)"), self.on_save_finished)
+        self.connect(self.saver, SIGNAL("saveFailed(int, QString)"), self.on_save_failed)
+
+        # Long operations run on a thread pool. Their results are applied on the GUI thread.
+        self.tasks = TaskRunner(self)
+        self.connect(self.tasks, SIGNAL("busyChanged(bool)"), self.on_busy)
+        self.connect(self.tasks, SIGNAL("taskProgress(QString, QString, int)"), self.on_task_progress)
+        self.connect(self.tasks, SIGNAL("taskFailed(QString, QString)"), self.on_task_failed)
+
+        # The views around the current one are prepared in the background once a pan has settled
+        self.prefetch_colorize = None
+        self.prefetcher = ViewPrefetcher(self.dc.viewcache, self.prefetch_view, self)
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.connect(self.prefetch_timer, SIGNAL("timeout()"), self.prefetch_views)
 
 
         self.maps = mpl.cm.datad.keys()  # The names of colormaps available
@@ -258,10 +514,57 @@ class KMTEditor(QMainWindow):
 
         self.draw_preview_worldmap()
         self.render_view()
+        self.prefetch_timer.start(500)
+
+        # The edits the other editors make to the shared grid are picked up from the session log
+        if self.dc.session is not None:
+            self.session_timer = QTimer(self)
+            self.connect(self.session_timer, SIGNAL("timeout()"), self.sync_session)
+            self.session_timer.start(250)
         self.statusBar().showMessage('KMTEditor 2015')
 
 
+    def setup_journal(self):
+        """
+        Starts the write-ahead journal of edits. If journals were left behind by sessions that
+        did not exit normally, the user is offered to replay the edits recorded in them. The
+        journals of other editors that are still running (e.g. on a shared grid) are left alone.
+        """
+        records = []
+        orphans = orphaned_journals(self.dc.fname, self.dc.datavar, "kmt")
+        for pid in orphans:
+            try:
+                records += read_journal(self.dc.fname, self.dc.datavar, self.dc.data.shape, "kmt", pid)
+            except ValueError as err:
+                QMessageBox.warning(self, "Journal", "Ignoring journal: {0}".format(err))
+
+        if records:
+            reply = QMessageBox.question(self, 'Recover edits',
+                    "Found {0} unsaved edits from a previous session. Replay them?".format(len(records)),
+                    QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+            if reply != QMessageBox.Yes: records = []
+
+        # The journal of this editor. The replayed edits are journalled again in it below, after
+        # which the old journals are removed.
+        self.dc.journal = EditJournal(self.dc.fname, self.dc.datavar, self.dc.data.shape, "kmt")
+        if records:
+            self.dc.replayJournal(records)
+            self.unsaved_changes_exist = True
+        self.dc.journal.sync()
+        discard_journals(self.dc.fname, self.dc.datavar, "kmt", orphans)
+
+        # The journal is fsync'ed on a timer so that many edits share a single fsync
+        self.journal_timer = QTimer(self)
+        self.connect(self.journal_timer, SIGNAL("timeout()"), self.dc.journal.sync)
+        self.journal_timer.start(1000)
+
+
     def keyPressEvent(self, e):
+        with self.latency.interaction(self.KEY_INTERACTIONS.get(e.key(), "key")):
+            self.handle_key(e)
+
+
+    def handle_key(self, e):
         if e.key() == Qt.Key_Equal:
             # Pressing = for edit
             self.inputbox.setFocus()
@@ -275,6 +578,8 @@ class KMTEditor(QMainWindow):
             self.update_value_with_average(self.dc.getAverage())
         elif e.key() == Qt.Key_M:
             self.colormaps.setFocus()
+        elif e.key() == Qt.Key_W:
+            self.toggle_weighted_stats()
         elif e.key() == Qt.Key_Escape:
             # Pressing escape to refocus back to the main frame
             self.main_frame.setFocus()
@@ -282,6 +587,13 @@ class KMTEditor(QMainWindow):
             self.set_stats_info(self.dc.moveView(e.key()))
             self.render_view()
             self.render_edited_cells()
+            self.prefetch_timer.start(200)
+        elif e.key() == Qt.Key_N:
+            # Jump to the next problem cell
+            self.jump_to_problem(1)
+        elif e.key() == Qt.Key_P:
+            # Jump to the previous problem cell
+            self.jump_to_problem(-1)
         else:
             self.dc.updateCursorPosition(e)
             self.draw_cursor()
@@ -352,6 +664,7 @@ class KMTEditor(QMainWindow):
 
         for i, name in enumerate(["Minimum", "Maximum", "Mean"]):
             w = QLabel(name)
+            if name == "Mean": self.meanlabel = w
             w.setFont(font)
             self.statgrid.addWidget(w, i+2, 0, Qt.AlignLeft)
 
@@ -399,6 +712,7 @@ class KMTEditor(QMainWindow):
         self.colormaps = QComboBox(self)
         self.colormaps.addItems(self.maps)
         self.colormaps.setCurrentIndex(self.maps.index('Set1'))
+        self.colormaps.currentIndexChanged.connect(lambda idx: self.dc.viewcache.clear())   # The prepared colours are of the old map
         self.colormaps.currentIndexChanged.connect(self.render_view)
 
         # New value editor
@@ -494,6 +808,10 @@ class KMTEditor(QMainWindow):
         helpgrid.addWidget(QLabel("move focus to color selector"),         7, 1, 1, 1, Qt.AlignLeft)
         helpgrid.addWidget(QLabel("Escape"), 8, 0, 1, 1, Qt.AlignLeft)
         helpgrid.addWidget(QLabel("move focus to main view"),         8, 1, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("n, p"),                9, 0, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("jump to next/previous problem cell"), 9, 1, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("w"),                   10, 0, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("area-weighted means on/off"),     10, 1, 1, 1, Qt.AlignLeft)
 
 
 
@@ -513,6 +831,7 @@ class KMTEditor(QMainWindow):
         self.main_frame.setFocus()
 
 
+    @timed_stage("preview")
     def draw_preview_worldmap(self):
         """
         This function draws the world map in the preview window on the top right hand corner
@@ -528,6 +847,7 @@ class KMTEditor(QMainWindow):
 
 
 
+    @timed_stage("colorbar")
     def draw_colorbar(self):
         """
         This function draws the colorbar and the labels for the colorbar. 
@@ -551,6 +871,7 @@ class KMTEditor(QMainWindow):
 
 
 
+    @timed_stage()
     def draw_cursor(self, noremove=False):
         if self.cursor.marker and (not noremove): self.cursor.marker.remove()
         # The increment by 0.5 below is done so that the center of the marker is shifted
@@ -563,12 +884,14 @@ class KMTEditor(QMainWindow):
         self.canvas.draw()
 
 
+    @timed_stage()
     def render_edited_cells(self):
         """
         This function draws a box around cells that have been edited, thereby highlighting
         them from the other cells. 
         """
         changes_row_idx = self.dc.changes_row_idx
+        self.render_overlay()
 
         # We only need to go ahead if a change has been made, i.e. changes_row_idx is larger than 0
         if changes_row_idx > 0:
@@ -597,34 +920,108 @@ class KMTEditor(QMainWindow):
 
 
 
+    def render_overlay(self):
+        """ Draws a magenta box around the cells of the loaded overlay that lie within the view. """
+        if self.dc.overlay is None or len(self.dc.overlay) == 0: return
+        rows, cols = self.dc.overlay[:, 0], self.dc.overlay[:, 1]
+        si, sj     = self.dc.si, self.dc.sj
+        inview     = (rows >= si) & (rows < si+self.dc.nrows) & (cols >= sj) & (cols < sj+self.dc.ncols)
+        self.axes.scatter(cols[inview] + 0.5 - sj, rows[inview] + 0.5 - si, s=60, marker='s',
+                          edgecolor="m", facecolor='none', linewidth=1.5)
+        self.canvas.draw()
+
+
+    def load_overlay(self):
+        """ Asks for a file with a changes table and highlights its cells. """
+        fname = QFileDialog.getOpenFileName(self, "Load overlay", "", "netCDF files (*.nc);;All files (*)")
+        if not fname: return
+        try:
+            n = self.dc.loadOverlay(str(fname))
+        except (ValueError, IOError, RuntimeError) as err:
+            QMessageBox.warning(self, "Load overlay", str(err))
+            return
+        self.render_view()
+        self.render_edited_cells()
+        self.statusBar().showMessage('Overlay of {0} cells loaded from {1}'.format(n, fname), 2000)
+
+
+    def jump_to_problem(self, step):
+        """ Centres the view on the next (step > 0) or previous problem cell and moves the cursor onto it. """
+        if self.dc.scanner is None:
+            self.scan_for_problems(step)
+            return
+        found = self.dc.findProblem(step)
+        if found is None:
+            self.statusBar().showMessage('No problems found', 2000)
+            return
+        i, j, kinds = found
+        self.set_stats_info(self.dc.centreView(i, j))
+        self.render_view()
+        self.render_edited_cells()
+        counts = self.dc.scanner.counts()
+        self.statusBar().showMessage('{0} at {1},{2} ({3})'.format(", ".join(kinds), i, j,
+                                     ", ".join("{0} {1}".format(counts[k], k) for k in sorted(counts))), 5000)
+
+
+    def scan_for_problems(self, step):
+        """
+        Scans a snapshot of the grid for problem cells in the background (the first scan of a large
+        grid takes a while), and then jumps to the next problem.
+        """
+        if self.tasks.isActive("Scanning for problems"): return
+        generation = self.dc.generation
+
+        def scanned(scanner):
+            if generation != self.dc.generation:
+                # The grid was edited during the scan, which has missed the edits
+                self.scan_for_problems(step)
+                return
+            # From now on the scanner is kept up to date with the edits of the grid itself
+            scanner.kmt = self.dc.data
+            self.dc.scanner = scanner
+            self.jump_to_problem(step)
+
+        self.tasks.submit("Scanning for problems", lambda progress, kmt: PathologyScanner(kmt, progress=progress),
+                          (self.dc.data.copy(),), finished=scanned)
+
+
+    @timed_stage()
     def render_view(self):
         self.draw_colorbar()
         self.axes.clear()
         # Either select the colormap through the combo box or specify a custom colormap
         cmap = mpl.cm.get_cmap(self.maps[self.colormaps.currentIndex()])
-        self.axes.pcolor(self.dc.view_masked, cmap=cmap, edgecolors='w', linewidths=0.5,
-                         vmin=KMTEditor.KMT_MIN_VAL, vmax=KMTEditor.KMT_MAX_VAL)
+        with self.latency.stage("pcolor"):
+            cells = self.axes.pcolor(self.dc.view_masked, cmap=cmap, edgecolors='w', linewidths=0.5,
+                                     vmin=KMTEditor.KMT_MIN_VAL, vmax=KMTEditor.KMT_MAX_VAL)
+        # A view prepared in the background has its colours ready
+        item = self.dc.viewcache.peek((self.dc.si, self.dc.sj))
+        if item is not None and "rgba" in item:
+            cells.set_array(None)
+            cells.set_facecolor(face_colors(item, self.dc.view_masked))
 
         tmp1 = self.dc.nrows
         tmp2 = self.dc.ncols
 
         # This is for drawing the black contour line for the continents
-        self.axes.contour(self.dc.view, levels=[0], colors='k', linewidth=1.5,
-                          interpolation="nearest", origin="lower",
-                          extents=[0.5,tmp2+0.5, 0.5, tmp1+0.5])
+        with self.latency.stage("contour"):
+            self.axes.contour(self.dc.view, levels=[0], colors='k', linewidth=1.5,
+                              interpolation="nearest", origin="lower",
+                              extents=[0.5,tmp2+0.5, 0.5, tmp1+0.5])
 
         # Setting the axes limits. This helps in setting the right orientation of the plot
         # and in clontrolling how much extra space we want around the scatter plot.
         # I am putting 4% space around the scatter plot
         self.axes.set_ylim([int(tmp1*1.02), 0 - int(tmp1*0.02)])
         self.axes.set_xlim([0 - int(tmp2*0.02), int(tmp2*1.02)])
-        self.canvas.draw()
-        self.fig.tight_layout()
+        with self.latency.stage("canvas.draw"): self.canvas.draw()
+        with self.latency.stage("tight_layout"): self.fig.tight_layout()
         self.draw_cursor(noremove=True)
 
 
 
 
+    @timed_interaction("edit")
     def update_value(self, inp=None):
         if inp == None:
             inp = self.inputbox.text()   # Get the value in the text box
@@ -682,26 +1079,90 @@ class KMTEditor(QMainWindow):
         self.idxdisplay.setText("{0:3d},{1:3d}".format(int(i_global), int(j_global)))
 
 
+    @timed_stage("stats panel")
     def set_stats_info(self, s):
         """
         Updates the statistics display panel with the stats for the view.
         ARGUMENTS
             s - a tuple with the min, max and mean of the view
         """
+        # The weighted global mean is kept up to date with the edits, so it is shown afresh
+        if self.dc.weighted: self.statsarray[5].setText("{0:3d}".format(int(self.dc.getGlobalMean())))
         self.statsarray[0].setText("{0:3d}".format(int(s[0])))
         self.statsarray[1].setText("{0:3d}".format(int(s[1])))
         self.statsarray[2].setText("{0:3d}".format(int(s[2])))
 
 
+    @timed_interaction("jump")
     def onclick(self, event):
         QMessageBox.information(self, "", "KMTEditor does not presently support mouse selection over the preview plot")
 
     
+    def toggle_weighted_stats(self):
+        """ Switches the means of the statistics panel between plain and area-weighted means. """
+        self.dc.weighted = not self.dc.weighted
+        self.dc.viewcache.clear()   # The prepared statistics are of the other kind
+        self.meanlabel.setText("Mean (area)" if self.dc.weighted else "Mean")
+        self.statsarray[5].setText("{0:3d}".format(int(self.dc.getGlobalMean())))
+        self.set_stats_info(self.dc.getViewStatistics())
+        msg = 'Means weighted by {0}'.format(self.dc.weights_source) if self.dc.weighted else 'Unweighted means'
+        self.statusBar().showMessage(msg, 2000)
+
+
+    def sync_session(self):
+        """ Applies the edits that the other editors of the session made to the shared KMT. """
+        edits = self.dc.session.poll()
+        if not edits: return
+        n = self.dc.applySessionEdits(edits)
+        self.unsaved_changes_exist = True
+        self.set_stats_info(self.dc.getViewStatistics())
+        self.render_view()
+        self.render_edited_cells()
+        self.statusBar().showMessage('{0} cells edited in another editor'.format(n), 2000)
+
+
+    def view_colorizer(self):
+        """ Returns a function that colours a view as render_view does, for the prefetch thread. """
+        cmap = mpl.cm.get_cmap(self.maps[self.colormaps.currentIndex()])
+        norm = mpl.colors.Normalize(vmin=KMTEditor.KMT_MIN_VAL, vmax=KMTEditor.KMT_MAX_VAL)
+        return lambda view: cmap(norm(np.ma.masked_equal(view, 0)))
+
+
+    def prefetch_views(self):
+        """ Asks the prefetch thread to prepare the views around the current one. """
+        self.prefetch_colorize = self.view_colorizer()
+        self.prefetcher.request(self.dc.si, self.dc.sj, self.dc.nrows, self.dc.ncols, self.dc.ny, self.dc.nx)
+
+
+    def prefetch_view(self, si, sj):
+        """ Prepares a view in the prefetch thread. This must not touch any widgets. """
+        return self.dc.prepareView(si, sj, self.prefetch_colorize)
+
+
+    def toggle_latency_hud(self):
+        """ Shows or hides the latency display over the view. Showing it starts the timing of the interactions. """
+        if self.latency_hud is None:
+            self.latency_hud = QLabel(self.canvas)
+            self.latency_hud.setStyleSheet("QLabel { background-color: rgba(0, 0, 0, 170); color: white; "
+                                           "font-family: monospace; padding: 4px; }")
+            self.latency.listeners.append(self.update_latency_hud)
+        self.latency.enabled = True
+        self.latency_hud.setVisible(not self.latency_hud.isVisible())
+        self.update_latency_hud()
+
+
+    def update_latency_hud(self, kind=None, ms=None):
+        if self.latency_hud is None or not self.latency_hud.isVisible(): return
+        self.latency_hud.setText(self.latency.hud_text())
+        self.latency_hud.adjustSize()
+
+
     def on_about(self):
         msg = """ Edit KMT levels for the POP ocean model.  """
         QMessageBox.about(self, "About", msg.strip())
 
 
+    @timed_interaction("save")
     def save_data(self):
         """
         Saves the data to a netCDF4 file. The program tries to construct a default format of
@@ -742,49 +1203,60 @@ class KMTEditor(QMainWindow):
                             self.statusBar().showMessage('Save cancelled', 2000)
                             return
             
-            # To simplify creation of the output filename, i first duplicate the original file, then overwrite
-            # the kmt array.
-            nccopy(self.dc.fname, self.ofile, quiet=True, clobber=clobber, zlib=False, shuffle=False, classic=1)
-
+            copy_input = True
             # now we set this to True, so that next time we save, we are not prompted about existing file
             self.asked_about_overwrite_permission = True
+        else:
+            copy_input = False
+            clobber    = False
 
+        # The data is written by the background saver from a snapshot, so that editing can
+        # continue while the file is being written.
+        generation, data, orig_data, changes = self.dc.snapshot()
+        self.saver.submit(generation, write_kmt_file, self.dc.fname, self.ofile, clobber, copy_input,
+                          max(self.dc.nrows, self.dc.ncols), data, orig_data, changes)
+        self.statusBar().showMessage('Saving to file: %s' % self.ofile)
 
-        ncfile = Dataset(self.ofile, "a", format="NETCDF4")
-        alldimensions = ncfile.dimensions
-        allvariables  = ncfile.variables
-        if not "changes" in alldimensions: ncfile.createDimension("changes", None)
-        if not "i" in alldimensions: ncfile.createDimension("i", 3)
 
+    def on_save_progress(self, msg):
+        self.statusBar().showMessage(msg)
 
-        if not "original_kmt" in allvariables: 
-            okmt   = ncfile.createVariable("original_kmt", "f4", ("latitude", "longitude"))
-            okmt.description   = "Original KMT data from which this file was created by KMTEditor.py"
-            okmt[:,:]          = np.flipud(self.dc.orig_data)
 
-        if not "changes" in allvariables: 
-            cngvar = ncfile.createVariable("changes", "f8", ("changes", "i"))
-            cngvar.description = "changes to original data leading to present data. (i,j,val)"        
-            cngvar[:,:]        = self.dc.changes[0:self.dc.changes_row_idx,:]
-        else:
-            cngvar = allvariables["changes"]
-            # s = cngvar.shape[0]
-            cngvar[:,:]       = self.dc.changes[0:self.dc.changes_row_idx,:]
-        
+    def on_save_finished(self, generation, msg):
+        # Edits made after the snapshot was taken are still unsaved
+        if generation == self.dc.generation: self.unsaved_changes_exist = False
+        self.statusBar().showMessage(msg, 2000)
 
-        kmtvar             = ncfile.variables["kmt"]
-        kmtvar[:,:]        = np.flipud(self.dc.data)
-        kmtvar.description = "Created by KMTEditor.py"
-        
-        ncfile.history     = "Created by KMTEditor.py"
-        ncfile.input_file  = self.dc.fname
-        ncfile.created     = time.ctime()
-        ncfile.close()
 
-        self.unsaved_changes_exist = False
-        self.statusBar().showMessage('Saved to file: %s' % self.ofile, 2000)
+    def on_save_failed(self, generation, msg):
+        # The failure has already been shown if the window was being closed when it came in
+        if self.saver.takeFailure() is None: return
+        self.show_save_failure(msg)
 
 
+    def show_save_failure(self, msg, closing=False):
+        # The output file may not have been created, so the next save starts from scratch
+        self.asked_about_overwrite_permission = False
+        self.statusBar().showMessage('Save failed', 2000)
+        if closing: msg = "The last save failed, so the window stays open. The edits are kept in the journal.\n\n" + str(msg)
+        QMessageBox.critical(self, "Save failed", str(msg))
+
+
+
+    def on_busy(self, busy):
+        """ Shows a busy cursor while any background task is running. """
+        if busy: QApplication.setOverrideCursor(QCursor(Qt.BusyCursor))
+        else: QApplication.restoreOverrideCursor()
+
+
+    def on_task_progress(self, name, msg, percent):
+        if percent >= 0: msg = '{0} ({1}%)'.format(msg or name, percent)
+        self.statusBar().showMessage(msg or '{0}...'.format(name))
+
+
+    def on_task_failed(self, name, msg):
+        self.statusBar().showMessage('{0} failed: {1}'.format(name, str(msg).strip().splitlines()[-1]), 5000)
+
 
 
     def create_action(self, text, slot=None, shortcut=None,
@@ -820,13 +1292,20 @@ class KMTEditor(QMainWindow):
             shortcut="Ctrl+S", slot=self.save_data,
             tip="Save the data array")
 
-        self.add_actions(self.file_menu, (load_file_action,))
+        load_overlay_action = self.create_action("Load &Overlay...",
+            shortcut="Ctrl+O", slot=self.load_overlay,
+            tip="Highlight the cells of a changes table, e.g. one made by ncdiff.py")
+
+        self.add_actions(self.file_menu, (load_file_action, load_overlay_action))
 
         self.help_menu = self.menuBar().addMenu("&Help")
         about_action = self.create_action("&About",
             shortcut='F1', slot=self.on_about,
             tip='About KMTEditor')
-        self.add_actions(self.help_menu, (about_action,))
+        latency_action = self.create_action("&Latency HUD",
+            shortcut='F3', slot=self.toggle_latency_hud,
+            tip='Show how long each kind of interaction takes', checkable=True)
+        self.add_actions(self.help_menu, (about_action, latency_action))
 
 
     def closeEvent(self, event):
@@ -838,6 +1317,31 @@ class KMTEditor(QMainWindow):
                 event.accept()
             else:
                 event.ignore()
+                return
+
+        # Wait for any save that is still being written
+        if self.saver.isBusy():
+            self.statusBar().showMessage('Waiting for save to finish...')
+            self.saver.wait()
+
+        # If a save failed, the edits since the last good save are only in the journal
+        failures = self.saver.takeFailures()
+        if failures:
+            self.show_save_failure(failures[-1][1], closing=True)
+            event.ignore()
+            return
+
+        self.prefetch_timer.stop()
+        self.prefetcher.wait()
+        self.tasks.cancelAll()
+        self.tasks.waitForDone()
+
+        # The session ended normally, so there is nothing left to recover
+        self.dc.journal.close(remove=True)
+        if self.latency_log: self.latency.dump(self.latency_log)
+        if self.dc.session is not None:
+            self.session_timer.stop()
+            self.dc.session.detach()
 
 
 
@@ -848,9 +1352,18 @@ def main():
     parser = argparse.ArgumentParser(description='KMTEditor', add_help=False)
     parser.add_argument('fname', nargs=1, type=str, help='name of the netcdf4 data file')
     parser.add_argument('-s',    nargs=1, type=int, help='size of the view in number of pixels', default=[60])
+    parser.add_argument('--latency', nargs=1, type=str, help='time the interactions and write the timings to this .json or .csv file on exit', default=[None])
+    parser.add_argument('--shared', action='store_true', help='share the grid with the other editors open on the same file')
     args = parser.parse_args()
 
-    mw = KMTEditor(args.fname[0], "kmt", dwx=args.s[0], dwy=args.s[0])
+    # The file is read in the background, so that the application does not freeze while it loads
+    try:
+        dc = run_with_progress(None, 'Reading {0}'.format(args.fname[0]),
+                               lambda progress, *dcargs: DataContainer(*dcargs, progress=progress), (args.s[0], args.s[0], args.fname[0], "kmt", args.shared))
+    except TaskCancelled:
+        return
+
+    mw = KMTEditor(args.fname[0], "kmt", dwx=args.s[0], dwy=args.s[0], dc=dc, latency_log=args.latency[0])
     mw.show()     # Render the window
     mw.raise_()   # Bring the PyQt4 window to the front
     app.exec_()   # Run the application loop
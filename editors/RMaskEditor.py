@@ -20,81 +20,29 @@ import matplotlib as mpl
 from matplotlib import pylab as plt
 from mpl_toolkits.basemap import Basemap
 import matplotlib.patches as mpatches
-from matplotlib.collections import PatchCollection
+from matplotlib.collections import PatchCollection, LineCollection
+from matplotlib.widgets import RectangleSelector
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 
-from PyCESM.utilities import nccopy
-
-from matplotlib.widgets import Lasso
-from matplotlib import path
+from cesmGUITools.utilities.gridio import read_kmt_grid, read_cell_area, write_rmask_file
+from cesmGUITools.utilities.areaweights import cell_weights, WeightedStats
+from cesmGUITools.utilities.viewcache import ViewCache, prepare_view, face_colors
+from cesmGUITools.utilities.prefetch import ViewPrefetcher
+from cesmGUITools.utilities.qtasks import TaskRunner, TaskCancelled, run_with_progress
+from cesmGUITools.utilities.gridsession import GridSession
+from cesmGUITools.utilities.latency import LatencyRecorder, timed_interaction, timed_stage
+from cesmGUITools.utilities.bgsave import BackgroundSaver
+from cesmGUITools.utilities.journal import EditJournal, read_journal, orphaned_journals, discard_journals
+from cesmGUITools.utilities.lasso import LassoTool
+from cesmGUITools.utilities.gridops import component
+from cesmGUITools.utilities.selection import Selection, MODES
+from cesmGUITools.utilities.regionstats import RegionStats
+from cesmGUITools.utilities.changelog import read_changes, latest_changes
 
 
 mpl.rc('axes',edgecolor='w')
 
 
-class LassoTool(object):
-    def __init__(self, ax, nx, ny, callback):
-        """
-        ARGUMENTS
-            nx  - number of columns in the view window
-            ny  - number of rows in the view window
-            callback - a function from the main program that the LassoTool class
-                   calls when it has selected a list of points inside a lasso
-        """
-        self.axes   = ax
-        self.canvas = ax.figure.canvas
-        self.main_app_callback = callback
-        
-        yv, xv = np.mgrid[0:ny,0:nx]
-
-        self.points = np.c_[xv.flatten(), yv.flatten()]
-        del yv, xv
-        # self.points contains coordinate locations of each pixel in the view
-        # where the locations are indexed as (x_index, y_index), equivalently
-        # as (column_index, row_index). 
-        
-        self.cid = self.canvas.mpl_connect('button_press_event', self.onpress)
-
-
-    def callback(self, verts):
-        """
-        This function is called by the matplotlib lasso widget when the lasso is released.
-        ARGUMENTS
-            verts - a list of tuples which collectively defines a path
-        """
-        p = path.Path(verts)  # We first create a closed path using the vertices
-        
-        # Selecting points that lie inside the lasso >>>>
-        ind = p.contains_points(self.points)
-        selected_points = self.points[ind,:]
-        # <<<< Selecting points that lie inside the lasso
-        
-        self.canvas.draw_idle()
-        # self.canvas.widgetlock.release(self.lasso)
-        del self.lasso
-        # Now that we are done with the lasso stuff, we call back an appropriate 
-        # function in the main program (this function was passed as an argument
-        # to the constructor for LassoTool)
-        self.main_app_callback(selected_points)
-
-    def onpress(self, event):
-        """
-        This function is called by matplotlib when a button is pressed on the view
-        window.
-        ARGUMENT
-            event - matplotlib passes the event as the argument to this function
-        """
-        # if self.canvas.widgetlock.locked(): 
-        #     print "here"
-        #     return
-        if event.inaxes is None: return
-        self.lasso = Lasso(event.inaxes, (event.xdata, event.ydata), self.callback)
-        # acquire a lock on the widget drawing
-        # self.canvas.widgetlock(self.lasso)
-
-
-
-
 class DataContainer(object):
     """
     DataContainer: A "data container" class for this application which does the job
@@ -107,16 +55,22 @@ class DataContainer(object):
             self.y = 0           # Y-position of the cursor
 
 
-    def __init__(self, nrows, ncols, fname, datavar):
+    def __init__(self, nrows, ncols, fname, datavar, shared=False, progress=None):
         """
         ARGUMENTS
-            nrows - number of rows for the view
-            ncols - number of columns for the view
-            fname - name of the data file.
-            scale - a multiplicative scale factor for the data to be visualized and edited
+            nrows  - number of rows for the view
+            ncols  - number of columns for the view
+            fname  - name of the data file.
+            scale  - a multiplicative scale factor for the data to be visualized and edited
+            shared - if True, the grid is shared with the other editors open on the same file
+                     (see gridsession.py)
+            progress - optionally, the progress function of the task that reads the file in the
+                     background (see qtasks.py), called between the stages of the reading
         """
         self.fname   = fname
         self.datavar = datavar
+        # The shared grid session, or None
+        self.session = GridSession.attach(fname, datavar) if shared else None
         self.__read_nc_file()
         self.orig_data = np.copy(self.data)
         self.ny, self.nx = self.data.shape
@@ -134,29 +88,101 @@ class DataContainer(object):
         # Tracking which elements are changed
         self.changes = np.zeros((self.ny*self.nx, 3), dtype=np.int32)
         self.changes_row_idx = 0
+        # Cells highlighted from a changes table loaded from another file (e.g. made by ncdiff.py).
+        # A (n, 2) array of i, j indices, or None.
+        self.overlay = None
+        # Incremented on every edit. A save records the generation of the snapshot it
+        # wrote so that edits made while the save was running are not lost track of.
+        self.generation = 0
+        # The write-ahead journal of edits. Set by the editor once it has dealt with any
+        # journal left behind by a previous session.
+        self.journal = None
+        # The cells selected for the next edit, in global indices, gathered over any number of views
+        self.selection = Selection(self.ny, self.nx)
+        self.__stage(progress, "Reading the cell areas")
+        # The number of cells, area and extent of each region, kept up to date with the edits
+        area, self.area_var = read_cell_area(self.fname)
+        self.regionstats = RegionStats(self.data, self.kmt_lats, self.kmt_lons, area)
+        self.__stage(progress, "Computing the area weights")
+
+        # Area weights for the statistics, used when the weighted statistics are switched on (W key)
+        weights, self.weights_source = cell_weights(self.fname, self.kmt_lats, flip=True)
+        self.wstats   = WeightedStats(self.data, weights)
+        self.weighted = False
+        # Views prepared in the background by the editor, see prepareView
+        self.viewcache = ViewCache()
+        # Times the stages of the interactions. Replaced by the recorder of the editor.
+        self.latency = LatencyRecorder()
 
         # A cursor object on the view
         self.cursor = DataContainer.Cursor()
 
 
+    def __stage(self, progress, msg):
+        """ Reports a stage of the reading, detaching from the session if the reading has been cancelled. """
+        if progress is None: return
+        try:
+            progress(msg)
+        except TaskCancelled:
+            if self.session is not None: self.session.detach()
+            raise
+
+
     def __read_nc_file(self):
         """ This subroutine reads the netCDF4 data file. """
-        ncfile        = Dataset(self.fname, "r", format="NETCDF4")
-        # We are flipping the arrays so that the latitudes go from 90:-90
-        self.data     = np.flipud(ncfile.variables[self.datavar][:,:])
-        self.kmt_lons = np.flipud(ncfile.variables["ULON"][:,:])
-        self.kmt_lats = np.flipud(ncfile.variables["ULAT"][:,:])
-        ncfile.close()
-
-        # Now we are making the data array a masked array
-        self.data = np.ma.array(self.data, mask=(self.data == 0))
+        if self.session is not None:
+            # The KMT and the coordinates are mapped from the shared session
+            self.data, self.kmt_lons, self.kmt_lats = self.session.data, self.session.lons, self.session.lats
+        else:
+            # The arrays are flipped so that the latitudes go from 90:-90
+            self.data, self.kmt_lons, self.kmt_lats = read_kmt_grid(self.fname, self.datavar)
+
+        # Now we are making the data array a masked array. The shared KMT must not be overwritten
+        # with the regions, so it is copied.
+        self.data = np.ma.array(self.data, mask=(self.data == 0), copy=self.session is not None)
         # Now we are making the mask of this masked array "hard", i.e. it cannot be changed
         self.data.harden_mask()
         self.data[:,:] = 50.0   # Putting some default value for the ocean regions
 
 
 
-    def getViewStatistics(self): return (self.view.min(), self.view.max(), self.view.mean())
+    @timed_stage()
+    def loadOverlay(self, fname):
+        """
+        Loads the changes table of another file as an overlay of highlighted cells. The data is not changed.
+        RETURNS
+            the number of cells in the overlay
+        RAISES
+            ValueError if the file has no changes table or it does not fit this grid
+        """
+        changes, original = read_changes(fname)
+        if changes is None:
+            raise ValueError("{0} has no changes table".format(fname))
+        self.overlay = latest_changes(changes, self.data.shape)[:, 0:2].astype(np.intp)
+        return len(self.overlay)
+
+
+
+    def getViewStatistics(self): return self.viewStatistics(self.view, self.si, self.sj)
+
+
+    def viewStatistics(self, view, si, sj):
+        """ Returns the min, max and mean of a view whose top left cell is (si, sj). """
+        mean = self.wstats.viewMean(view, si, sj) if self.weighted else view.mean()
+        return (view.min(), view.max(), mean)
+
+
+    def prepareView(self, si, sj, colorize=None):
+        """
+        Prepares the view at (si, sj) for the view cache. This is called by the prefetch thread,
+        and only reads the data.
+        """
+        return prepare_view(self.data, si, sj, self.nrows, self.ncols, self.viewStatistics, colorize)
+
+
+    def getGlobalMean(self):
+        """ Returns the mean of the whole grid, weighted by area if the weighted statistics are on. """
+        return self.wstats.mean() if self.weighted else self.data.mean()
 
 
     def getCursor(self): return self.cursor
@@ -186,6 +212,7 @@ class DataContainer(object):
             self.cursor.x = min(self.ncols-1, self.cursor.x + 1)
 
 
+    @timed_stage()
     def updateView(self, si, sj):
         """
         Updates the data for the view.
@@ -197,7 +224,9 @@ class DataContainer(object):
         self.view = self.data[si:si+self.nrows, sj:sj+self.ncols].view()
         self.si   = si
         self.sj   = sj
-        return self.getViewStatistics()
+        # The statistics of a view prepared in the background are ready
+        item = self.viewcache.get((si, sj))
+        return item["stats"] if item is not None else self.getViewStatistics()
 
 
 
@@ -226,6 +255,7 @@ class DataContainer(object):
             return self.updateView(new_si, self.sj)
 
 
+    @timed_stage()
     def modifyValue(self, inp):
         """
         Modify the value for a particular pixel. The location of the pixel is that
@@ -236,10 +266,93 @@ class DataContainer(object):
         ci, cj = self.viewIndex2GlobalIndex(self.cursor.y, self.cursor.x)
         
         _tmp = int(float(inp))
+        old  = self.data[ci, cj]
         self.data[ci, cj] = _tmp
+        self.regionstats.update(ci, cj, old, self.data[ci, cj])
+        self.wstats.update(ci, cj, old, self.data[ci, cj])
+        self.viewcache.invalidate(ci, cj)
         self.changes[self.changes_row_idx, :] = ci, cj, _tmp
         self.changes_row_idx += 1
+        self.generation += 1
+        if self.journal: self.journal.append_point(ci, cj, _tmp)
+
 
+    @timed_stage()
+    def modifyValues(self, points_i, points_j, val):
+        """
+        Sets a group of cells, such as those selected with the lasso, to a single value.
+        ARGUMENTS
+            points_i, points_j - arrays with the global row and column indices of the cells
+            val                - the new value
+        """
+        old = self.data[points_i, points_j]
+        self.data[points_i, points_j] = val
+        self.regionstats.update(points_i, points_j, old, self.data[points_i, points_j])
+        self.wstats.update(points_i, points_j, old, self.data[points_i, points_j])
+        self.viewcache.invalidate(points_i, points_j)
+        self.generation += 1
+        if self.journal: self.journal.append_bulk(points_i, points_j, val)
+
+
+    def connectedCells(self, connectivity=4, bounded=False):
+        """
+        Finds the ocean cells connected to the cell under the cursor (a flood fill), over the whole
+        (zonally periodic) grid.
+        ARGUMENTS
+            connectivity - 4 to connect cells that share an edge, 8 to also connect cells that share a corner
+            bounded      - if True, only cells with the same region value as the cell under the cursor are connected
+        RETURNS
+            a tuple (points_i, points_j) with the global indices of the cells, empty if the cursor is over land
+        """
+        ocean, ci, cj = self.fillMask(bounded)
+        return component(ocean, ci, cj, connectivity, wrap=True)
+
+
+    def fillMask(self, bounded=False):
+        """
+        Returns a tuple (mask, ci, cj) with a new boolean array of the cells a flood fill from the
+        cell under the cursor may reach, and the global indices of that cell. See connectedCells.
+        """
+        ci, cj = self.viewIndex2GlobalIndex(self.cursor.y, self.cursor.x)
+        ocean  = ~np.ma.getmaskarray(self.data)
+        if bounded: ocean &= (self.data.filled(0) == self.data.filled(0)[ci, cj])
+        return ocean, ci, cj
+
+
+    def modifySelection(self, val):
+        """
+        Sets the ocean cells of the selection to a region value as a single edit, and clears the selection.
+        RETURNS
+            the number of ocean cells that were changed
+        """
+        points_i, points_j = self.selection.indices()
+        # Land cells are masked and keep their value
+        ocean = ~np.ma.getmaskarray(self.data)[points_i, points_j]
+        points_i, points_j = points_i[ocean], points_j[ocean]
+        if len(points_i): self.modifyValues(points_i, points_j, val)
+        self.selection.clear()
+        return len(points_i)
+
+
+    def replayJournal(self, records):
+        """
+        Re-applies edits recovered from the journal of a previous session.
+        ARGUMENTS
+            records - a list of (i, j, vals) tuples of arrays as returned by read_journal
+        RETURNS
+            the number of cells that were edited
+        """
+        ncells = 0
+        for i, j, vals in records:
+            old = self.data[i, j]
+            self.data[i, j] = vals
+            self.regionstats.update(i, j, old, self.data[i, j])
+            self.wstats.update(i, j, old, self.data[i, j])
+            self.viewcache.invalidate(i, j)
+            self.generation += 1
+            if self.journal: self.journal.append_bulk(i, j, vals)
+            ncells += len(i)
+        return ncells
 
 
     def viewIndex2GlobalIndex(self, i, j):
@@ -248,22 +361,74 @@ class DataContainer(object):
         return (self.si + i, self.sj + j)
 
 
+    def applySessionEdits(self, edits):
+        """
+        Updates the land mask with the edits that the other editors of the session made to the shared
+        KMT. Cells that became land are masked, and cells that became ocean get the default region.
+        ARGUMENTS
+            edits - a list of (i, j, old, new) tuples of arrays as returned by GridSession.poll
+        RETURNS
+            the number of cells that changed between land and ocean
+        """
+        ncells = 0
+        for i, j, old, new in edits:
+            flip = (old == 0) != (new == 0)
+            if not flip.any(): continue
+            i, j, ocean = i[flip], j[flip], new[flip] != 0
+            before = self.data[i, j]
+            self.data.soften_mask()
+            self.data.mask[i, j] = ~ocean
+            self.data.data[i[ocean], j[ocean]] = 50   # The default value of __read_nc_file
+            self.data.harden_mask()
+            self.regionstats.update(i, j, before, self.data[i, j])
+            self.wstats.update(i, j, before, self.data[i, j])
+            self.viewcache.invalidate(i, j)
+            ncells += len(i)
+        return ncells
+
+
+    def snapshot(self):
+        """
+        Returns a snapshot of the edited state that can be written to disk while editing
+        continues. Copying the in-memory array is a plain memcpy, which is orders of
+        magnitude cheaper than the netCDF write that follows.
+        RETURNS
+            a tuple (generation, data)
+        """
+        return (self.generation, self.data.copy())
+
+
 
 class RMaskEditor(QMainWindow):
 
-    def __init__(self, fname, datavar, dwx=60, dwy=60):
+    # The kind of interaction of each key, for the latency timings (see latency.py)
+    KEY_INTERACTIONS = {Qt.Key_H: "pan", Qt.Key_J: "pan", Qt.Key_K: "pan", Qt.Key_L: "pan",
+                        Qt.Key_Up: "cursor", Qt.Key_Down: "cursor", Qt.Key_Left: "cursor", Qt.Key_Right: "cursor",
+                        Qt.Key_V: "edit", Qt.Key_A: "edit",
+                        Qt.Key_Return: "edit", Qt.Key_Enter: "edit", Qt.Key_F: "select"}
+
+    def __init__(self, fname, datavar, dwx=60, dwy=60, dc=None, latency_log=None):
         """
         ARGUMENTS:
             fname    - Name of the netcdf4 file
             datavar  - Name of the data variable in the file for which to plot
             dwx, dwy - size of the DataContainer in number of array elements
             scale    - A float that will be multiplied with the data to scale the data
+            dc       - the DataContainer, if it has already been read (see main)
+            latency_log - a .json or .csv file to write the timings of the interactions to on exit
         """
         super(RMaskEditor, self).__init__(None)
         self.setWindowTitle('RMaskEditor - {0}'.format(fname))
 
         #  Creating a variable that contains all the data
-        self.dc = DataContainer(dwy, dwx, fname, datavar)
+        self.dc = dc if dc is not None else DataContainer(dwy, dwx, fname, datavar)
+        # Times the interactions (see latency.py). Off unless a log file is given or the HUD is shown.
+        self.latency     = LatencyRecorder(enabled=latency_log is not None)
+        self.latency_log = latency_log
+        self.latency_hud = None
+        self.dc.latency  = self.latency
+        self.unsaved_changes_exist = False
+        self.setup_journal()
 
         self.cursor = self.dc.getCursor()  # Defining a cursor on the data
         # This is the Rectangle boundary drawn on the world map that bounds the region
@@ -280,7 +445,27 @@ class RMaskEditor(QMainWindow):
         # The previously updated value
         self.buffer_value = None
 
-        self.unsaved_changes_exist = False
+        # How the cells picked with the lasso, the rectangle or a flood fill are combined with the selection
+        self.selection_mode = "union"
+
+        # Saves are written by a worker thread so that the window does not freeze
+        self.saver = BackgroundSaver(self)
+        self.connect(self.saver, SIGNAL("saveProgress(QString)"), self.on_save_progress)
+        self.connect(self.saver, SIGNAL("saveFinished(int, QString)"), self.on_save_finished)
+        self.connect(self.saver, SIGNAL("saveFailed(int, QString)"), self.on_save_failed)
+
+        # Long operations run on a thread pool. Their results are applied on the GUI thread.
+        self.tasks = TaskRunner(self)
+        self.connect(self.tasks, SIGNAL("busyChanged(bool)"), self.on_busy)
+        self.connect(self.tasks, SIGNAL("taskProgress(QString, QString, int)"), self.on_task_progress)
+        self.connect(self.tasks, SIGNAL("taskFailed(QString, QString)"), self.on_task_failed)
+
+        # The views around the current one are prepared in the background once a pan has settled
+        self.prefetch_colorize = None
+        self.prefetcher = ViewPrefetcher(self.dc.viewcache, self.prefetch_view, self)
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.connect(self.prefetch_timer, SIGNAL("timeout()"), self.prefetch_views)
 
         self.maps = mpl.cm.datad.keys()  # The names of colormaps available
         self.maps.sort() # Sorting them alphabetically for ease of use
@@ -292,10 +477,58 @@ class RMaskEditor(QMainWindow):
 
         self.draw_preview_worldmap()
         self.render_view()
+        self.render_region_stats()
+        self.prefetch_timer.start(500)
+
+        # The edits the other editors make to the shared grid are picked up from the session log
+        if self.dc.session is not None:
+            self.session_timer = QTimer(self)
+            self.connect(self.session_timer, SIGNAL("timeout()"), self.sync_session)
+            self.session_timer.start(250)
         self.statusBar().showMessage('RMaskEditor 2015')
 
 
+    def setup_journal(self):
+        """
+        Starts the write-ahead journal of edits. If journals were left behind by sessions that
+        did not exit normally, the user is offered to replay the edits recorded in them. The
+        journals of other editors that are still running (e.g. on a shared grid) are left alone.
+        """
+        records = []
+        orphans = orphaned_journals(self.dc.fname, self.dc.datavar, "rmask")
+        for pid in orphans:
+            try:
+                records += read_journal(self.dc.fname, self.dc.datavar, self.dc.data.shape, "rmask", pid)
+            except ValueError as err:
+                QMessageBox.warning(self, "Journal", "Ignoring journal: {0}".format(err))
+
+        if records:
+            reply = QMessageBox.question(self, 'Recover edits',
+                    "Found {0} unsaved edits from a previous session. Replay them?".format(len(records)),
+                    QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+            if reply != QMessageBox.Yes: records = []
+
+        # The journal of this editor. The replayed edits are journalled again in it below, after
+        # which the old journals are removed.
+        self.dc.journal = EditJournal(self.dc.fname, self.dc.datavar, self.dc.data.shape, "rmask")
+        if records:
+            self.dc.replayJournal(records)
+            self.unsaved_changes_exist = True
+        self.dc.journal.sync()
+        discard_journals(self.dc.fname, self.dc.datavar, "rmask", orphans)
+
+        # The journal is fsync'ed on a timer so that many edits share a single fsync
+        self.journal_timer = QTimer(self)
+        self.connect(self.journal_timer, SIGNAL("timeout()"), self.dc.journal.sync)
+        self.journal_timer.start(1000)
+
+
     def keyPressEvent(self, e):
+        with self.latency.interaction(self.KEY_INTERACTIONS.get(e.key(), "key")):
+            self.handle_key(e)
+
+
+    def handle_key(self, e):
         if e.key() == Qt.Key_Equal:
             # Pressing = for edit
             self.inputbox.setFocus()
@@ -309,12 +542,28 @@ class RMaskEditor(QMainWindow):
             self.update_value_with_average(self.dc.getAverage())
         elif e.key() == Qt.Key_M:
             self.colormaps.setFocus()
+        elif e.key() == Qt.Key_W:
+            self.toggle_weighted_stats()
         elif e.key() == Qt.Key_Escape:
             # Pressing escape to refocus back to the main frame
             self.main_frame.setFocus()
         elif e.key() in [Qt.Key_H, Qt.Key_J, Qt.Key_K, Qt.Key_L]:
             self.set_stats_info(self.dc.moveView(e.key()))
             self.render_view()
+            self.prefetch_timer.start(200)
+        elif e.key() == Qt.Key_F:
+            # Select the ocean region under the cursor
+            self.flood_fill()
+        elif e.key() == Qt.Key_R:
+            self.toggle_selection_tool()
+        elif e.key() == Qt.Key_U:
+            self.cycle_selection_mode()
+        elif e.key() == Qt.Key_X:
+            self.dc.selection.clear()
+            self.statusBar().showMessage('Selection cleared', 2000)
+            self.render_view()
+        elif e.key() in [Qt.Key_Return, Qt.Key_Enter]:
+            self.modify_selected_points()
         else:
             self.dc.updateCursorPosition(e)
             self.draw_cursor()
@@ -364,7 +613,10 @@ class RMaskEditor(QMainWindow):
         # work.
         #
         self.axes = self.fig.add_subplot(111)
-        self.lman = LassoTool(self.axes, self.dc.ny, self.dc.nx, self.modify_selected_points)
+        self.lman = LassoTool(self.axes, self.dc.ncols, self.dc.nrows, self.lasso_selected)
+        # The rectangle tool is used instead of the lasso when toggled on with R
+        self.rman = RectangleSelector(self.axes, self.rectangle_selected)
+        self.rman.set_active(False)
         # Turning off the axes ticks to maximize space. Also the labels were meaningless
         # anyway because they were not representing the actual lat/lons.
         self.axes.get_xaxis().set_visible(False)
@@ -387,6 +639,7 @@ class RMaskEditor(QMainWindow):
 
         for i, name in enumerate(["Minimum", "Maximum", "Mean"]):
             w = QLabel(name)
+            if name == "Mean": self.meanlabel = w
             w.setFont(font)
             self.statgrid.addWidget(w, i+2, 0, Qt.AlignLeft)
 
@@ -431,6 +684,17 @@ class RMaskEditor(QMainWindow):
             w.setFont(font)
         # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 
+        # REGIONS >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+        self.regiondisplay = QLabel("Regions:")
+        self.regiontable   = QTableWidget(0, 5)
+        # The area column stays empty if the file has no TAREA
+        self.regiontable.setHorizontalHeaderLabels(["Region", "Cells", "Area (km^2)", "Latitude", "Longitude"])
+        self.regiontable.verticalHeader().setVisible(False)
+        self.regiontable.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.regiontable.setFocusPolicy(Qt.NoFocus)
+        self.regiontable.setMaximumHeight(200)
+        # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
 
         # Colorscheme selector
         cmap_label = QLabel('Colorscheme:')
@@ -450,7 +714,7 @@ class RMaskEditor(QMainWindow):
 
         for item in [self.statdisplay, self.infodisplay, self.latdisplay, \
                      self.idxdisplay, self.londisplay, \
-                     self.valdisplay, cmap_label]:
+                     self.valdisplay, self.regiondisplay, cmap_label]:
             item.setFont(font)
 
 
@@ -491,6 +755,9 @@ class RMaskEditor(QMainWindow):
         vbox2.addWidget(fr)
         vbox2.setAlignment(fr, Qt.AlignTop)
 
+        vbox2.addWidget(self.regiondisplay)
+        vbox2.addWidget(self.regiontable)
+
 
 
         vbox2.addLayout(valhbox, Qt.AlignTop)
@@ -532,6 +799,20 @@ class RMaskEditor(QMainWindow):
         helpgrid.addWidget(QLabel("move focus to color selector"),         7, 1, 1, 1, Qt.AlignLeft)
         helpgrid.addWidget(QLabel("Escape"), 8, 0, 1, 1, Qt.AlignLeft)
         helpgrid.addWidget(QLabel("move focus to main view"),         8, 1, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("mouse"),               9, 0, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("lasso (or rectangle) selection"), 9, 1, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("r"),                   10, 0, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("switch lasso/rectangle"),         10, 1, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("f"),                   11, 0, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("select ocean connected to cursor"), 11, 1, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("u"),                   12, 0, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("union/subtract/replace selection"), 12, 1, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("x"),                   13, 0, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("clear selection"),     13, 1, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("Enter"),               14, 0, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("set region of selection"),        14, 1, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("w"),                   15, 0, 1, 1, Qt.AlignLeft)
+        helpgrid.addWidget(QLabel("area-weighted means on/off"),     15, 1, 1, 1, Qt.AlignLeft)
 
 
 
@@ -551,6 +832,7 @@ class RMaskEditor(QMainWindow):
         self.main_frame.setFocus()
 
 
+    @timed_stage("preview")
     def draw_preview_worldmap(self):
         """
         This function draws the world map in the preview window on the top right hand corner
@@ -561,6 +843,7 @@ class RMaskEditor(QMainWindow):
         self.preview.draw()
 
 
+    @timed_stage("colorbar")
     def draw_colorbar(self):
         """
         This function draws the colorbar and the labels for the colorbar. 
@@ -584,6 +867,7 @@ class RMaskEditor(QMainWindow):
 
 
 
+    @timed_stage()
     def draw_cursor(self, noremove=False):
         if self.cursor.marker and (not noremove): self.cursor.marker.remove()
         # The increment by 0.5 below is done so that the center of the marker is shifted
@@ -596,6 +880,7 @@ class RMaskEditor(QMainWindow):
         self.canvas.draw()
 
 
+    @timed_stage()
     def render_view(self, clear=True):
         """
         ARGUMENTS
@@ -605,7 +890,13 @@ class RMaskEditor(QMainWindow):
         if clear: self.axes.clear()
         # Either select the colormap through the combo box or specify a custom colormap
         # cmap = mpl.cm.get_cmap(self.maps[self.colormaps.currentIndex()])
-        self.axes.pcolor(self.dc.view, cmap=mpl.cm.Dark2, edgecolors='k', linewidths=0.5, vmin=0.0, vmax=50.0)
+        with self.latency.stage("pcolor"):
+            cells = self.axes.pcolor(self.dc.view, cmap=mpl.cm.Dark2, edgecolors='k', linewidths=0.5, vmin=0.0, vmax=50.0)
+        # A view prepared in the background has its colours ready
+        item = self.dc.viewcache.peek((self.dc.si, self.dc.sj))
+        if item is not None and "rgba" in item:
+            cells.set_array(None)
+            cells.set_facecolor(face_colors(item, self.dc.view))
 
         tmp1 = self.dc.nrows
         tmp2 = self.dc.ncols
@@ -615,13 +906,47 @@ class RMaskEditor(QMainWindow):
         # I am putting 4% space around the scatter plot
         self.axes.set_ylim([int(tmp1*1.02), 0 - int(tmp1*0.02)])
         self.axes.set_xlim([0 - int(tmp2*0.02), int(tmp2*1.02)])
-        self.canvas.draw()
-        self.fig.tight_layout()
+        self.render_selection()
+        self.render_overlay()
+        with self.latency.stage("canvas.draw"): self.canvas.draw()
+        with self.latency.stage("tight_layout"): self.fig.tight_layout()
         self.draw_cursor(noremove=clear)
 
 
+    @timed_stage()
+    def render_selection(self):
+        """ Draws the outline of the part of the selection that lies within the view. """
+        segments = self.dc.selection.outline(self.dc.si, self.dc.sj, self.dc.nrows, self.dc.ncols)
+        if len(segments) == 0: return
+        self.axes.add_collection(LineCollection(segments, colors="r", linewidths=2))
+
+
+    def render_overlay(self):
+        """ Draws a magenta box around the cells of the loaded overlay that lie within the view. """
+        if self.dc.overlay is None or len(self.dc.overlay) == 0: return
+        rows, cols = self.dc.overlay[:, 0], self.dc.overlay[:, 1]
+        si, sj     = self.dc.si, self.dc.sj
+        inview     = (rows >= si) & (rows < si+self.dc.nrows) & (cols >= sj) & (cols < sj+self.dc.ncols)
+        self.axes.scatter(cols[inview] + 0.5 - sj, rows[inview] + 0.5 - si, s=60, marker='s',
+                          edgecolor="m", facecolor='none', linewidth=1.5)
 
 
+    def load_overlay(self):
+        """ Asks for a file with a changes table and highlights its cells. """
+        fname = QFileDialog.getOpenFileName(self, "Load overlay", "", "netCDF files (*.nc);;All files (*)")
+        if not fname: return
+        try:
+            n = self.dc.loadOverlay(str(fname))
+        except (ValueError, IOError, RuntimeError) as err:
+            QMessageBox.warning(self, "Load overlay", str(err))
+            return
+        self.render_view()
+        self.statusBar().showMessage('Overlay of {0} cells loaded from {1}'.format(n, fname), 2000)
+
+
+
+
+    @timed_interaction("edit")
     def update_value(self, inp=None):
         if inp == None:
             inp = self.inputbox.text()   # Get the value in the text box
@@ -633,6 +958,7 @@ class RMaskEditor(QMainWindow):
                 self.set_stats_info(self.dc.getViewStatistics())
                 self.inputbox.clear()        # Now clear the input box
                 self.render_view()           # Render the new view (which now contains the updated value)
+                self.render_region_stats()
                 self.main_frame.setFocus()   # Bring focus back to the view
 
 
@@ -671,23 +997,102 @@ class RMaskEditor(QMainWindow):
             self.valdisplay.setText("{0:3d}".format(int(self.dc.data[i_global, j_global].item())))
 
 
+    @timed_stage("stats panel")
     def set_stats_info(self, s):
         """
         Updates the statistics display panel with the stats for the view.
         ARGUMENTS
             s - a tuple with the min, max and mean of the view
         """
+        # The weighted global mean is kept up to date with the edits, so it is shown afresh
+        if self.dc.weighted: self.statsarray[5].setText("{0:3d}".format(int(self.dc.getGlobalMean())))
         self.statsarray[0].setText("{0:3d}".format(int(s[0])))
         self.statsarray[1].setText("{0:3d}".format(int(s[1])))
         self.statsarray[2].setText("{0:3d}".format(int(s[2])))
 
 
 
+    @timed_stage()
+    def render_region_stats(self):
+        """ Fills the region panel with the statistics of each region. """
+        rows = self.dc.regionstats.table()
+        self.regiontable.setRowCount(len(rows))
+        for k, (region, count, area, lat0, lat1, lon0, lon1) in enumerate(rows):
+            texts = [str(region), str(count), "" if area is None else "{0:.4g}".format(area*1e-6),
+                     "{0:.1f} .. {1:.1f}".format(lat0, lat1), "{0:.1f} .. {1:.1f}".format(lon0, lon1)]
+            for c, text in enumerate(texts):
+                item = QTableWidgetItem(text)
+                item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.regiontable.setItem(k, c, item)
+        self.regiontable.resizeColumnsToContents()
+
+
+
+    def toggle_weighted_stats(self):
+        """ Switches the means of the statistics panel between plain and area-weighted means. """
+        self.dc.weighted = not self.dc.weighted
+        self.dc.viewcache.clear()   # The prepared statistics are of the other kind
+        self.meanlabel.setText("Mean (area)" if self.dc.weighted else "Mean")
+        self.statsarray[5].setText("{0:3d}".format(int(self.dc.getGlobalMean())))
+        self.set_stats_info(self.dc.getViewStatistics())
+        msg = 'Means weighted by {0}'.format(self.dc.weights_source) if self.dc.weighted else 'Unweighted means'
+        self.statusBar().showMessage(msg, 2000)
+
+
+    def sync_session(self):
+        """ Updates the land mask with the edits that the other editors of the session made to the KMT. """
+        edits = self.dc.session.poll()
+        if not edits: return
+        n = self.dc.applySessionEdits(edits)
+        if n == 0: return
+        self.set_stats_info(self.dc.getViewStatistics())
+        self.render_view()
+        self.draw_preview_worldmap()
+        self.render_region_stats()
+        self.statusBar().showMessage('{0} cells changed between land and ocean in another editor'.format(n), 2000)
+
+
+    def view_colorizer(self):
+        """ Returns a function that colours a view as render_view does, for the prefetch thread. """
+        norm = mpl.colors.Normalize(vmin=0.0, vmax=50.0)
+        return lambda view: mpl.cm.Dark2(norm(view))
+
+
+    def prefetch_views(self):
+        """ Asks the prefetch thread to prepare the views around the current one. """
+        self.prefetch_colorize = self.view_colorizer()
+        self.prefetcher.request(self.dc.si, self.dc.sj, self.dc.nrows, self.dc.ncols, self.dc.ny, self.dc.nx)
+
+
+    def prefetch_view(self, si, sj):
+        """ Prepares a view in the prefetch thread. This must not touch any widgets. """
+        return self.dc.prepareView(si, sj, self.prefetch_colorize)
+
+
+    def toggle_latency_hud(self):
+        """ Shows or hides the latency display over the view. Showing it starts the timing of the interactions. """
+        if self.latency_hud is None:
+            self.latency_hud = QLabel(self.canvas)
+            self.latency_hud.setStyleSheet("QLabel { background-color: rgba(0, 0, 0, 170); color: white; "
+                                           "font-family: monospace; padding: 4px; }")
+            self.latency.listeners.append(self.update_latency_hud)
+        self.latency.enabled = True
+        self.latency_hud.setVisible(not self.latency_hud.isVisible())
+        self.update_latency_hud()
+
+
+    def update_latency_hud(self, kind=None, ms=None):
+        if self.latency_hud is None or not self.latency_hud.isVisible(): return
+        self.latency_hud.setText(self.latency.hud_text())
+        self.latency_hud.adjustSize()
+
+
     def on_about(self):
         msg = """ Edit 2D geophysical field.  """
         QMessageBox.about(self, "About", msg.strip())
 
 
+    @timed_interaction("save")
     def save_data(self):
         """
         Saves the data to the netCDF4 file from which input data was read in. First, the program asks
@@ -718,18 +1123,52 @@ class RMaskEditor(QMainWindow):
                 return
 
         # If all is well so far, we have an acceptable output filename and we can proceed with writing.
+        # The data is written by the background saver from a snapshot, so that editing can
+        # continue while the file is being written.
+        generation, data = self.dc.snapshot()
+        self.saver.submit(generation, write_rmask_file, self.dc.fname, ofile,
+                          max(self.dc.nrows, self.dc.ncols), data)
+        self.statusBar().showMessage('Saving to file: %s' % ofile)
 
-        # To simplify creation of the output filename, i first duplicate the original file, then overwrite
-        # the kmt array.
-        nccopy(self.dc.fname, ofile, quiet=True, clobber=True, zlib=False, shuffle=False, classic=1)
 
-        ncfile = Dataset(ofile, "a", format="NETCDF4")
-        ncfile.variables["kmt"][:,:] = np.flipud(self.dc.data)
-        self.unsaved_changes_exist = False
-        self.statusBar().showMessage('Saved to file: %s' % ofile, 2000)
+    def on_save_progress(self, msg):
+        self.statusBar().showMessage(msg)
+
+
+    def on_save_finished(self, generation, msg):
+        # Edits made after the snapshot was taken are still unsaved
+        if generation == self.dc.generation: self.unsaved_changes_exist = False
+        self.statusBar().showMessage(msg, 2000)
+
+
+    def on_save_failed(self, generation, msg):
+        # The failure has already been shown if the window was being closed when it came in
+        if self.saver.takeFailure() is None: return
+        self.show_save_failure(msg)
+
+
+    def show_save_failure(self, msg, closing=False):
+        self.statusBar().showMessage('Save failed', 2000)
+        if closing: msg = "The last save failed, so the window stays open. The edits are kept in the journal.\n\n" + str(msg)
+        QMessageBox.critical(self, "Save failed", str(msg))
 
 
 
+    def on_busy(self, busy):
+        """ Shows a busy cursor while any background task is running. """
+        if busy: QApplication.setOverrideCursor(QCursor(Qt.BusyCursor))
+        else: QApplication.restoreOverrideCursor()
+
+
+    def on_task_progress(self, name, msg, percent):
+        if percent >= 0: msg = '{0} ({1}%)'.format(msg or name, percent)
+        self.statusBar().showMessage(msg or '{0}...'.format(name))
+
+
+    def on_task_failed(self, name, msg):
+        self.statusBar().showMessage('{0} failed: {1}'.format(name, str(msg).strip().splitlines()[-1]), 5000)
+
+
 
     def create_action(self, text, slot=None, shortcut=None,
                       icon=None, tip=None, checkable=False,
@@ -764,13 +1203,20 @@ class RMaskEditor(QMainWindow):
             shortcut="Ctrl+S", slot=self.save_data,
             tip="Save the data array")
 
-        self.add_actions(self.file_menu, (load_file_action,))
+        load_overlay_action = self.create_action("Load &Overlay...",
+            shortcut="Ctrl+O", slot=self.load_overlay,
+            tip="Highlight the cells of a changes table, e.g. one made by ncdiff.py")
+
+        self.add_actions(self.file_menu, (load_file_action, load_overlay_action))
 
         self.help_menu = self.menuBar().addMenu("&Help")
         about_action = self.create_action("&About",
             shortcut='F1', slot=self.on_about,
             tip='About RMaskEditor')
-        self.add_actions(self.help_menu, (about_action,))
+        latency_action = self.create_action("&Latency HUD",
+            shortcut='F3', slot=self.toggle_latency_hud,
+            tip='Show how long each kind of interaction takes', checkable=True)
+        self.add_actions(self.help_menu, (about_action, latency_action))
 
 
     def closeEvent(self, event):
@@ -782,15 +1228,101 @@ class RMaskEditor(QMainWindow):
                 event.accept()
             else:
                 event.ignore()
+                return
 
+        # Wait for any save that is still being written
+        if self.saver.isBusy():
+            self.statusBar().showMessage('Waiting for save to finish...')
+            self.saver.wait()
 
-    def modify_selected_points(self, points):
+        # If a save failed, the edits since the last good save are only in the journal
+        failures = self.saver.takeFailures()
+        if failures:
+            self.show_save_failure(failures[-1][1], closing=True)
+            event.ignore()
+            return
+
+        self.prefetch_timer.stop()
+        self.prefetcher.wait()
+        self.tasks.cancelAll()
+        self.tasks.waitForDone()
+
+        # The session ended normally, so there is nothing left to recover
+        self.dc.journal.close(remove=True)
+        if self.latency_log: self.latency.dump(self.latency_log)
+        if self.dc.session is not None:
+            self.session_timer.stop()
+            self.dc.session.detach()
+
+
+    # SELECTIONS >>>>
+    def select_cells(self, points_i, points_j):
+        """ Combines the given global cells with the selection according to the selection mode. """
+        n = self.dc.selection.add(points_i, points_j, self.selection_mode)
+        self.statusBar().showMessage('{0} cells selected ({1}). Press Enter to set their region'.format(n, self.selection_mode), 2000)
+        self.render_view()
+
+
+    @timed_interaction("lasso")
+    def lasso_selected(self, points):
         """
-        ARGUMENTS
-            points - 
+        Called by the lasso tool with the (column, row) view indices of the cells inside the lasso.
         """
-        # First we convert from view coordinates to global coordinates
         points_i, points_j = self.dc.viewIndex2GlobalIndex(points[:,1], points[:,0])
+        self.select_cells(points_i, points_j)
+
+
+    @timed_interaction("select")
+    def rectangle_selected(self, eclick, erelease):
+        """
+        Called by the rectangle tool with the press and release events. The cells whose centres
+        lie within the rectangle are selected.
+        """
+        if None in (eclick.xdata, eclick.ydata, erelease.xdata, erelease.ydata): return
+        x0, x1 = sorted([eclick.xdata, erelease.xdata])
+        y0, y1 = sorted([eclick.ydata, erelease.ydata])
+        # Cell (row, col) covers [col, col+1] x [row, row+1] in the view
+        rows = np.arange(max(0, int(np.ceil(y0-0.5))), min(self.dc.nrows, int(np.floor(y1-0.5))+1))
+        cols = np.arange(max(0, int(np.ceil(x0-0.5))), min(self.dc.ncols, int(np.floor(x1-0.5))+1))
+        vi, vj = np.meshgrid(rows, cols, indexing="ij")
+        points_i, points_j = self.dc.viewIndex2GlobalIndex(vi.ravel(), vj.ravel())
+        self.select_cells(points_i, points_j)
+
+
+    def toggle_selection_tool(self):
+        """ Switches between the lasso and the rectangle selection tools. """
+        self.rman.set_active(not self.rman.active)
+        self.lman.active = not self.rman.active
+        self.statusBar().showMessage('{0} selection'.format("Rectangle" if self.rman.active else "Lasso"), 2000)
+
+
+    def cycle_selection_mode(self):
+        """ Switches to the next selection mode: union, subtract or replace. """
+        self.selection_mode = MODES[(MODES.index(self.selection_mode) + 1) % len(MODES)]
+        self.statusBar().showMessage('Selection mode: {0}'.format(self.selection_mode), 2000)
+
+
+    def flood_fill(self):
+        """ Asks for a fill mode, and selects the ocean connected to the cursor. """
+        modes = ["4-connected ocean", "8-connected ocean", "4-connected, same region only", "8-connected, same region only"]
+        mode, ok = QInputDialog.getItem(self, "Flood fill", "Fill:", modes, 0, False)
+        if not ok: return
+        mode = modes.index(str(mode))
+        ocean, ci, cj = self.dc.fillMask(bounded=mode >= 2)
+        if not ocean[ci, cj]:
+            self.statusBar().showMessage('The cursor is not over an ocean cell', 2000)
+            return
+        # A fill over a whole basin takes a moment, so it runs in the background on the mask,
+        # which is a copy. The cells are added to the selection on the GUI thread once found.
+        self.tasks.submit("Flood fill", lambda progress, *args: component(*args, wrap=True, progress=progress),
+                          (ocean, ci, cj, 8 if mode % 2 else 4), finished=lambda points: self.select_cells(*points))
+
+
+    def modify_selected_points(self):
+        """ Asks for a region value and sets the ocean cells of the selection to it as a single edit. """
+        if len(self.dc.selection) == 0:
+            self.statusBar().showMessage('Nothing selected. Use the lasso, R (rectangle) or F (flood fill) to select cells', 2000)
+            return
 
         # We prompt user to enter a value to define the oceanic region
         val, ok = QInputDialog.getText(self, "", "Enter oceanic region value:",)
@@ -798,11 +1330,15 @@ class RMaskEditor(QMainWindow):
             self.statusBar().showMessage('No ocean cells changed', 2000)
             return
         else:
-            self.dc.data[points_i,points_j] = int(str(val))
-            self.render_view(clear=False)
+            n = self.dc.modifySelection(int(str(val)))
+            self.unsaved_changes_exist = True
+            self.set_stats_info(self.dc.getViewStatistics())
+            self.render_view()
 
             self.draw_preview_worldmap()  # We update the preview map
-            self.statusBar().showMessage('{0} ocean cells changed'.format(len(points_i), 2000))
+            self.render_region_stats()
+            self.statusBar().showMessage('{0} ocean cells changed'.format(n), 2000)
+    # <<<< SELECTIONS
 
 
 
@@ -814,9 +1350,18 @@ def main():
     parser = argparse.ArgumentParser(description='RMaskEditor', add_help=False)
     parser.add_argument('fname', nargs=1, type=str, help='name of the netcdf4 data file')
     parser.add_argument('-s',    nargs=1, type=int, help='size of the view in number of pixels', default=[60])
+    parser.add_argument('--latency', nargs=1, type=str, help='time the interactions and write the timings to this .json or .csv file on exit', default=[None])
+    parser.add_argument('--shared', action='store_true', help='share the grid with the other editors open on the same file')
     args = parser.parse_args()
 
-    mw = RMaskEditor(args.fname[0], "kmt", dwx=args.s[0], dwy=args.s[0])
+    # The file is read in the background, so that the application does not freeze while it loads
+    try:
+        dc = run_with_progress(None, 'Reading {0}'.format(args.fname[0]),
+                               lambda progress, *dcargs: DataContainer(*dcargs, progress=progress), (args.s[0], args.s[0], args.fname[0], "kmt", args.shared))
+    except TaskCancelled:
+        return
+
+    mw = RMaskEditor(args.fname[0], "kmt", dwx=args.s[0], dwy=args.s[0], dc=dc, latency_log=args.latency[0])
     mw.show()     # Render the window
     mw.raise_()   # Bring the PyQt4 window to the front
     app.exec_()   # Run the application loop
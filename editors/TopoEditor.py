@@ -23,8 +23,21 @@ from mpl_toolkits.basemap import Basemap
 import matplotlib.patches as mpatches
 from matplotlib.collections import PatchCollection
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.widgets import RectangleSelector
 
 from cesmGUITools.utilities.topoutils import topography_cmap, make_balanced
+from cesmGUITools.utilities.bgsave import BackgroundSaver
+from cesmGUITools.utilities.gridio import read_topo_grid, write_topo_variable
+from cesmGUITools.utilities.areaweights import cell_weights, WeightedStats
+from cesmGUITools.utilities.viewcache import ViewCache, prepare_view, face_colors
+from cesmGUITools.utilities.prefetch import ViewPrefetcher
+from cesmGUITools.utilities.qtasks import TaskRunner, TaskCancelled, run_with_progress
+from cesmGUITools.utilities.latency import LatencyRecorder, timed_interaction, timed_stage
+from cesmGUITools.utilities.journal import EditJournal, read_journal, orphaned_journals, discard_journals
+from cesmGUITools.utilities.changelog import read_changes, latest_changes
+from cesmGUITools.utilities.lasso import LassoTool
+from cesmGUITools.utilities.smoothing import smooth_selection, KERNELS
+from cesmGUITools.utilities.bulkops import bulk_values, OPERATIONS
 
 mpl.rc('axes',edgecolor='w')
 
@@ -40,13 +53,15 @@ class DataContainer(object):
 			self.y = 0           # Y-position of the cursor
 
 
-	def __init__(self, nrows, ncols, fname, datavar, scale):
+	def __init__(self, nrows, ncols, fname, datavar, scale, progress=None):
 		"""
 		ARGUMENTS
 			nrows - number of rows for the view
 			ncols - number of columns for the view
 			fname - name of the data file.
 			scale - a multiplicative scale factor for the data to be visualized and edited
+			progress - optionally, the progress function of the task that reads the file in the
+					background (see qtasks.py), called between the stages of the reading
 		"""
 		self.fname   = fname
 		self.datavar = datavar
@@ -56,6 +71,16 @@ class DataContainer(object):
 
 		self.scale = scale
 		self.data*=scale
+		if progress: progress("Computing the area weights")
+
+		# Area weights for the statistics, used when the weighted statistics are switched on (W key)
+		weights, self.weights_source = cell_weights(self.fname, self.lats, flip=False)
+		self.wstats   = WeightedStats(self.data, weights)
+		self.weighted = False
+		# Views prepared in the background by the editor, see prepareView
+		self.viewcache = ViewCache()
+		# Times the stages of the interactions. Replaced by the recorder of the editor.
+		self.latency = LatencyRecorder()
 		
 		# Determining whether the longitude ranges from -180 to 180 or 0 to 360
 		# this will determine how we plot the preview plot
@@ -74,7 +99,15 @@ class DataContainer(object):
 		# Tracking which elements are changed
 		self.changes = np.zeros((self.ny*self.nx, 3), dtype=np.int32)
 		self.changes_row_idx = 0
-
+		# Cells highlighted from a changes table loaded from another file (e.g. made by ncdiff.py
+		# with --noflip). A (n, 2) array of i, j indices, or None.
+		self.overlay = None
+		# Incremented on every edit. A save records the generation of the snapshot it
+		# wrote so that edits made while the save was running are not lost track of.
+		self.generation = 0
+		# The write-ahead journal of edits. Set by the editor once it has dealt with any
+		# journal left behind by a previous session.
+		self.journal = None
 				
 		# A cursor object on the view
 		self.cursor = DataContainer.Cursor()
@@ -83,35 +116,50 @@ class DataContainer(object):
 	def __read_nc_file(self):
 		""" This subroutine reads the netCDF4 data file. It looks for common names
 		of the latitude and longitude variables in the file. If it cannot find any
-		one of these coordinates, then it raises and error. """
-		self.lons = None
-		self.lats = None
-		ncfile = Dataset(self.fname, "r", format="NETCDF4")
-		for var in ["longitudes", "longitude", "lons"]:
-			try:
-				self.lons = ncfile.variables[var][:]
-				self.lon_var = ncfile.variables[var].dimensions[0]
-			except:
-				pass
+		one of these coordinates, then it raises and error. The file is read in a background task
+		(see main), so the ValueError is left to the caller to report on the GUI thread. """
+		self.data, self.lons, self.lats, self.lon_var, self.lat_var = read_topo_grid(self.fname, self.datavar)
 
-		for var in ["latitudes", "latitude", "lats"]:
-			try:
-				self.lats = ncfile.variables[var][:]
-				self.lat_var = ncfile.variables[var].dimensions[0]
-			except:
-				pass
-
-		if (self.lats == None) or (self.lons == None):
-			ncfile.close()
-			QMessageBox.critical(QWidget(), 'Error', "Latitude and or longitude variables not found.", QMessageBox.Ok)
-			sys.exit()
-			
-		self.data = ncfile.variables[self.datavar][:,:]
-		ncfile.close()
+
+
+	@timed_stage()
+	def loadOverlay(self, fname):
+		"""
+		Loads the changes table of another file as an overlay of highlighted cells. The data is not changed.
+		The rows of the table are in the orientation of the file, as TopoEditor does not flip the data.
+		RETURNS
+			the number of cells in the overlay
+		RAISES
+			ValueError if the file has no changes table or it does not fit this grid
+		"""
+		changes, original = read_changes(fname)
+		if changes is None:
+			raise ValueError("{0} has no changes table".format(fname))
+		self.overlay = latest_changes(changes, self.data.shape)[:, 0:2].astype(np.intp)
+		return len(self.overlay)
 
 
 
-	def getViewStatistics(self): return (self.view.min(), self.view.max(), self.view.mean())
+	def getViewStatistics(self): return self.viewStatistics(self.view, self.si, self.sj)
+
+
+	def viewStatistics(self, view, si, sj):
+		""" Returns the min, max and mean of a view whose top left cell is (si, sj). """
+		mean = self.wstats.viewMean(view, si, sj) if self.weighted else view.mean()
+		return (view.min(), view.max(), mean)
+
+
+	def prepareView(self, si, sj, colorize=None):
+		"""
+		Prepares the view at (si, sj) for the view cache. This is called by the prefetch thread,
+		and only reads the data.
+		"""
+		return prepare_view(self.data, si, sj, self.nrows, self.ncols, self.viewStatistics, colorize)
+
+
+	def getGlobalMean(self):
+		""" Returns the mean of the whole grid, weighted by area if the weighted statistics are on. """
+		return self.wstats.mean() if self.weighted else self.data.mean()
 
 
 	def getCursor(self): return self.cursor
@@ -142,6 +190,7 @@ class DataContainer(object):
 			self.cursor.x = min(self.ncols-1, self.cursor.x + 1)
 
 	
+	@timed_stage()
 	def updateView(self, si, sj):
 		"""
 		Updates the data for the view. 
@@ -153,7 +202,9 @@ class DataContainer(object):
 		self.view = self.data[si:si+self.nrows, sj:sj+self.ncols].view()
 		self.si = si
 		self.sj = sj
-		return self.getViewStatistics()
+		# The statistics of a view prepared in the background are ready
+		item = self.viewcache.get((si, sj))
+		return item["stats"] if item is not None else self.getViewStatistics()
 	
 	
 	def moveView(self, move):
@@ -181,6 +232,7 @@ class DataContainer(object):
 			return self.updateView(new_si, self.sj)
 
 	
+	@timed_stage()
 	def modifyValue(self, input):
 		"""
 		Modify the value for a particular pixel. The location of the pixel is that
@@ -192,18 +244,117 @@ class DataContainer(object):
 		ci, cj = self.viewIndex2GlobalIndex(self.cursor.y, self.cursor.x)
 
 		_tmp = float(input)
+		old  = self.data[ci, cj]
 		self.data[ci, cj] = _tmp
+		self.wstats.update(ci, cj, old, self.data[ci, cj])
+		self.viewcache.invalidate(ci, cj)
 		self.changes[self.changes_row_idx, :] = ci, cj, _tmp
 		self.changes_row_idx += 1
+		self.generation += 1
+		if self.journal: self.journal.append_point(ci, cj, _tmp)
+
+
+	@timed_stage()
+	def modifyValues(self, points_i, points_j, vals):
+		"""
+		Sets a group of cells, such as a smoothed selection, as a single bulk edit.
+		ARGUMENTS
+			points_i, points_j - arrays with the global row and column indices of the cells
+			vals               - an array with the new value of each cell, or a single value
+		"""
+		old = self.data[points_i, points_j]
+		self.data[points_i, points_j] = vals
+		self.wstats.update(points_i, points_j, old, self.data[points_i, points_j])
+		self.viewcache.invalidate(points_i, points_j)
+		self.recordChanges(points_i, points_j, vals)
+		self.generation += 1
+		if self.journal: self.journal.append_bulk(points_i, points_j, vals)
+
+
+	def recordChanges(self, points_i, points_j, vals):
+		"""
+		Appends the edit of a group of cells to the changes table.
+		ARGUMENTS
+			points_i, points_j - arrays with the global row and column indices of the cells
+			vals               - an array with the new value of each cell, or a single value
+		"""
+		new = np.empty((len(points_i), 3))
+		new[:,0], new[:,1], new[:,2] = points_i, points_j, vals
+		if self.changes_row_idx + len(new) > self.changes.shape[0]:
+			# The table is full. Only the last edit of each cell is needed to highlight the
+			# edited cells, and there are at most ny*nx of those.
+			new = latest_changes(np.concatenate((self.changes[:self.changes_row_idx], new)), self.data.shape)
+			self.changes_row_idx = 0
+		self.changes[self.changes_row_idx:self.changes_row_idx+len(new), :] = new
+		self.changes_row_idx += len(new)
+
+
+	def smoothSelection(self, points_i, points_j, kernel="mean9", iterations=1, sigma=1.0):
+		"""
+		Smooths a group of cells in one step and records it as a single bulk edit.
+		See smoothing.smooth_selection for the arguments.
+		RETURNS
+			the new values of the cells
+		"""
+		vals = smooth_selection(self.data, points_i, points_j, kernel, iterations, sigma)
+		self.modifyValues(points_i, points_j, vals)
+		return vals
+
+
+	def applyOperation(self, points_i, points_j, op, value=None, lo=None, hi=None):
+		"""
+		Applies an arithmetic operation to a group of cells and records it as a single bulk edit.
+		See bulkops.bulk_values for the arguments. The values are in the scaled units of the editor.
+		RETURNS
+			the new values of the cells
+		"""
+		vals = bulk_values(self.data[points_i, points_j], op, value, lo, hi)
+		self.modifyValues(points_i, points_j, vals)
+		return vals
 
 
+	def readValues(self, fname, datavar, points_i, points_j):
+		"""
+		Returns the values of a group of cells of a variable in another file (or in the same one)
+		on the same grid, multiplied by the scale factor of the editor.
+		RAISES
+			ValueError if the variable is not on the same grid
+		"""
+		other = read_topo_grid(fname, datavar)[0]
+		if other.shape != self.data.shape:
+			raise ValueError("{0} in {1} has shape {2}, expected {3}".format(datavar, fname, other.shape, self.data.shape))
+		return other[points_i, points_j]*self.scale
+
+
+	def replayJournal(self, records):
+		"""
+		Re-applies edits recovered from the journal of a previous session.
+		ARGUMENTS
+			records - a list of (i, j, vals) tuples of arrays as returned by read_journal
+		RETURNS
+			the number of cells that were edited
+		"""
+		ncells = 0
+		for i, j, vals in records:
+			n = len(i)
+			old = self.data[i, j]
+			self.data[i, j] = vals
+			self.wstats.update(i, j, old, self.data[i, j])
+			self.viewcache.invalidate(i, j)
+			self.recordChanges(i, j, vals)
+			self.generation += 1
+			if self.journal: self.journal.append_bulk(i, j, vals)
+			ncells += n
+		return ncells
+
 
 	def getAverage(self, center=False):
 		"""
 		Returns the average value at the cursor computed from the values of the surrounding cells. This
-		is a 8 point average.
-		If center==True, then includes the cell at which the cursor is in the calculation of the average,
-		in which case it will be a 9 point average. 
+		is a 8 point average, (sum of the 3x3 block - centre)/8 (F key).
+		If center==True, then the cell at which the cursor is gets counted a second time,
+		(sum of the 3x3 block + centre)/9 (A key). The 'mean8' and 'akey' kernels of smoothing.py
+		give these averages over a whole selection.
 		"""
 		ci, cj = self.viewIndex2GlobalIndex(self.cursor.y, self.cursor.x)
 		_sum   = self.data[ci-1:ci+2,cj-1:cj+2].sum()
@@ -219,24 +370,49 @@ class DataContainer(object):
 		""" Converts an i,j index into the data window into an index for the
 		same element into the global data. """
 		return (self.si + i, self.sj + j)
-	
-	
 
-class TopoEditor(QMainWindow):    
 
-	def __init__(self, fname, datavar, dwx=60, dwy=60, scale=1.0):
+	def snapshot(self):
+		"""
+		Returns a snapshot of the edited state that can be written to disk while editing
+		continues. The scale factor is removed from the copy, so that it is ready to be written.
+		RETURNS
+			a tuple (generation, data)
+		"""
+		return (self.generation, self.data/self.scale)
+
+
+
+class TopoEditor(QMainWindow):
+
+	# The kind of interaction of each key, for the latency timings (see latency.py)
+	KEY_INTERACTIONS = {Qt.Key_H: "pan", Qt.Key_J: "pan", Qt.Key_K: "pan", Qt.Key_L: "pan",
+						Qt.Key_Up: "cursor", Qt.Key_Down: "cursor", Qt.Key_Left: "cursor", Qt.Key_Right: "cursor",
+						Qt.Key_V: "edit", Qt.Key_A: "edit", Qt.Key_F: "edit",
+						Qt.Key_G: "edit", Qt.Key_B: "edit"}
+
+	def __init__(self, fname, datavar, dwx=60, dwy=60, scale=1.0, dc=None, latency_log=None):
 		"""
 		ARGUMENTS:
 			fname    - Name of the netcdf4 file
 			datavar  - Name of the data variable in the file for which to plot
 			dwx, dwy - size of the DataContainer in number of array elements
 			scale    - A float that will be multiplied with the data to scale the data
+			dc       - the DataContainer, if it has already been read (see main)
+			latency_log - a .json or .csv file to write the timings of the interactions to on exit
 		"""
 		super(TopoEditor, self).__init__(None)
 		self.setWindowTitle('TopoEditor - {0}'.format(fname))
 		
 		#  Creating a variable that contains all the data
-		self.dc = DataContainer(dwy, dwx, fname, datavar, scale)
+		self.dc = dc if dc is not None else DataContainer(dwy, dwx, fname, datavar, scale)
+		# Times the interactions (see latency.py). Off unless a log file is given or the HUD is shown.
+		self.latency     = LatencyRecorder(enabled=latency_log is not None)
+		self.latency_log = latency_log
+		self.latency_hud = None
+		self.dc.latency  = self.latency
+		self.unsaved_changes_exist = False
+		self.setup_journal()
 		
 		self.cursor = self.dc.getCursor()  # Defining a cursor on the data
 		# This is the Rectangle boundary drawn on the world map that bounds the region
@@ -246,12 +422,33 @@ class TopoEditor(QMainWindow):
 		# The previously updated value
 		self.buffer_value = None
 
-		self.unsaved_changes_exist = False
+		# The cells selected with the lasso or the rectangle tool, as a tuple of arrays with
+		# their global row and column indices, or None
+		self.selection = None
 
 		# The netcdf variable name for saving the modified data. The user will be asked
 		# to enter the value when saving. 
 		self.save_var   = None
 
+		# Saves are written by a worker thread so that the window does not freeze
+		self.saver = BackgroundSaver(self)
+		self.connect(self.saver, SIGNAL("saveProgress(QString)"), self.on_save_progress)
+		self.connect(self.saver, SIGNAL("saveFinished(int, QString)"), self.on_save_finished)
+		self.connect(self.saver, SIGNAL("saveFailed(int, QString)"), self.on_save_failed)
+
+		# Long operations run on a thread pool. Their results are applied on the GUI thread.
+		self.tasks = TaskRunner(self)
+		self.connect(self.tasks, SIGNAL("busyChanged(bool)"), self.on_busy)
+		self.connect(self.tasks, SIGNAL("taskProgress(QString, QString, int)"), self.on_task_progress)
+		self.connect(self.tasks, SIGNAL("taskFailed(QString, QString)"), self.on_task_failed)
+
+		# The views around the current one are prepared in the background once a pan has settled
+		self.prefetch_colorize = None
+		self.prefetcher = ViewPrefetcher(self.dc.viewcache, self.prefetch_view, self)
+		self.prefetch_timer = QTimer(self)
+		self.prefetch_timer.setSingleShot(True)
+		self.connect(self.prefetch_timer, SIGNAL("timeout()"), self.prefetch_views)
+
 		self.maps = mpl.cm.datad.keys()  # The names of colormaps available
 		self.maps.sort() # Sorting them alphabetically for ease of use
 
@@ -262,10 +459,51 @@ class TopoEditor(QMainWindow):
 
 		self.draw_preview_worldmap()
 		self.render_view()
+		self.prefetch_timer.start(500)
 		self.statusBar().showMessage('TopoEditor 2015')
 	
 	
+	def setup_journal(self):
+		"""
+		Starts the write-ahead journal of edits. If journals were left behind by sessions that
+		did not exit normally, the user is offered to replay the edits recorded in them. The
+		journals of other editors that are still running (e.g. on a shared grid) are left alone.
+		"""
+		records = []
+		orphans = orphaned_journals(self.dc.fname, self.dc.datavar, "topo")
+		for pid in orphans:
+			try:
+				records += read_journal(self.dc.fname, self.dc.datavar, self.dc.data.shape, "topo", pid)
+			except ValueError as err:
+				QMessageBox.warning(self, "Journal", "Ignoring journal: {0}".format(err))
+
+		if records:
+			reply = QMessageBox.question(self, 'Recover edits',
+					"Found {0} unsaved edits from a previous session. Replay them?".format(len(records)),
+					QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+			if reply != QMessageBox.Yes: records = []
+
+		# The journal of this editor. The replayed edits are journalled again in it below, after
+		# which the old journals are removed.
+		self.dc.journal = EditJournal(self.dc.fname, self.dc.datavar, self.dc.data.shape, "topo")
+		if records:
+			self.dc.replayJournal(records)
+			self.unsaved_changes_exist = True
+		self.dc.journal.sync()
+		discard_journals(self.dc.fname, self.dc.datavar, "topo", orphans)
+
+		# The journal is fsync'ed on a timer so that many edits share a single fsync
+		self.journal_timer = QTimer(self)
+		self.connect(self.journal_timer, SIGNAL("timeout()"), self.dc.journal.sync)
+		self.journal_timer.start(1000)
+
+
 	def keyPressEvent(self, e):
+		with self.latency.interaction(self.KEY_INTERACTIONS.get(e.key(), "key")):
+			self.handle_key(e)
+
+
+	def handle_key(self, e):
 		if e.key() == Qt.Key_Equal:
 			# Pressing = for edit
 			self.inputbox.setFocus()
@@ -280,8 +518,20 @@ class TopoEditor(QMainWindow):
 		elif e.key() == Qt.Key_F:
 			# Get the 4-point average and update the value
 			self.update_value_2(self.dc.getAverage())
+		elif e.key() == Qt.Key_S:
+			self.toggle_selection_tool("lasso")
+		elif e.key() == Qt.Key_R:
+			self.toggle_selection_tool("rectangle")
+		elif e.key() == Qt.Key_X:
+			self.set_selection(None)
+		elif e.key() == Qt.Key_G:
+			self.smooth_selection()
+		elif e.key() == Qt.Key_B:
+			self.bulk_edit()
 		# elif e.key() == Qt.Key_C:
 		#     self.colormaps.setFocus()
+		elif e.key() == Qt.Key_W:
+			self.toggle_weighted_stats()
 		elif e.key() == Qt.Key_Escape:
 			# Pressing escape to refocus back to the main frame
 			self.main_frame.setFocus()
@@ -290,6 +540,7 @@ class TopoEditor(QMainWindow):
 			self.render_view()
 			self.render_edited_cells()
 			self.draw_preview_rectangle()
+			self.prefetch_timer.start(200)
 		else:
 			self.dc.updateCursorPosition(e)
 			self.draw_cursor()
@@ -323,6 +574,12 @@ class TopoEditor(QMainWindow):
 		# work.
 		#
 		self.axes = self.fig.add_subplot(111)
+		# The selection tools for region operations. They start inactive and are toggled
+		# with the S (lasso) and R (rectangle) keys.
+		self.lman = LassoTool(self.axes, self.dc.ncols, self.dc.nrows, self.lasso_selected)
+		self.lman.active = False
+		self.rman = RectangleSelector(self.axes, self.rectangle_selected)
+		self.rman.set_active(False)
 		# Turning off the axes ticks to maximize space. Also the labels were meaningless
 		# anyway because they were not representing the actual lat/lons. 
 		self.axes.get_xaxis().set_visible(False)
@@ -344,6 +601,7 @@ class TopoEditor(QMainWindow):
 
 		for i, name in enumerate(["Minimum", "Maximum", "Mean"]):
 			w = QLabel(name)
+			if name == "Mean": self.meanlabel = w
 			w.setFont(font)
 			self.statgrid.addWidget(w, i+2, 0, Qt.AlignLeft)
 
@@ -434,6 +692,7 @@ class TopoEditor(QMainWindow):
 		self.main_frame.setFocus()
 	
 	
+	@timed_stage("preview")
 	def draw_preview_worldmap(self):
 		"""
 		This function draws the world map in the preview window on the top right hand corner 
@@ -454,6 +713,7 @@ class TopoEditor(QMainWindow):
 		self.draw_preview_rectangle()
 	
 	
+	@timed_stage("preview")
 	def draw_preview_rectangle(self):
 		"""
 		This function draws the Rectangle, which indicates the current region being shown
@@ -475,6 +735,7 @@ class TopoEditor(QMainWindow):
 		self.preview.draw()
 		
 	
+	@timed_stage()
 	def draw_cursor(self, noremove=False):
 		if self.cursor.marker and (not noremove): self.cursor.marker.remove()
 		# The increment by 0.5 below is done so that the center of the marker is shifted 
@@ -487,12 +748,15 @@ class TopoEditor(QMainWindow):
 		self.canvas.draw()
 	
 
+	@timed_stage()
 	def render_edited_cells(self):
 		"""
 		This function draws a box around cells that have been edited, thereby highlighting
 		them from the other cells. 
 		"""
 		changes_row_idx = self.dc.changes_row_idx
+		self.render_selection()
+		self.render_overlay()
 
 		# We only need to go ahead if a change has been made, i.e. changes_row_idx is larger than 0
 		if changes_row_idx > 0:
@@ -520,13 +784,191 @@ class TopoEditor(QMainWindow):
 
 	
 	
+	@timed_stage()
+	def render_selection(self):
+		""" Draws a blue box around the selected cells that lie within the view. """
+		if self.selection is None: return
+		rows, cols = self.selection
+		si, sj     = self.dc.si, self.dc.sj
+		inview     = (rows >= si) & (rows < si+self.dc.nrows) & (cols >= sj) & (cols < sj+self.dc.ncols)
+		self.axes.scatter(cols[inview] + 0.5 - sj, rows[inview] + 0.5 - si, s=30, marker='s',
+						  edgecolor="b", facecolor='none', linewidth=1)
+		self.canvas.draw()
+
+
+	def render_overlay(self):
+		""" Draws a magenta box around the cells of the loaded overlay that lie within the view. """
+		if self.dc.overlay is None or len(self.dc.overlay) == 0: return
+		rows, cols = self.dc.overlay[:, 0], self.dc.overlay[:, 1]
+		si, sj     = self.dc.si, self.dc.sj
+		inview     = (rows >= si) & (rows < si+self.dc.nrows) & (cols >= sj) & (cols < sj+self.dc.ncols)
+		self.axes.scatter(cols[inview] + 0.5 - sj, rows[inview] + 0.5 - si, s=60, marker='s',
+						  edgecolor="m", facecolor='none', linewidth=1.5)
+		self.canvas.draw()
+
+
+	def load_overlay(self):
+		""" Asks for a file with a changes table and highlights its cells. """
+		fname = QFileDialog.getOpenFileName(self, "Load overlay", "", "netCDF files (*.nc);;All files (*)")
+		if not fname: return
+		try:
+			n = self.dc.loadOverlay(str(fname))
+		except (ValueError, IOError, RuntimeError) as err:
+			QMessageBox.warning(self, "Load overlay", str(err))
+			return
+		self.render_view()
+		self.render_edited_cells()
+		self.statusBar().showMessage('Overlay of {0} cells loaded from {1}'.format(n, fname), 2000)
+
+
+	# SELECTIONS >>>>
+	def toggle_selection_tool(self, tool):
+		"""
+		Switches the lasso or the rectangle selection tool on or off. At most one of them is on.
+		ARGUMENTS
+			tool - "lasso" or "rectangle"
+		"""
+		if tool == "lasso":
+			self.lman.active = not self.lman.active
+			self.rman.set_active(False)
+			on = self.lman.active
+		else:
+			self.rman.set_active(not self.rman.active)
+			self.lman.active = False
+			on = self.rman.active
+		self.statusBar().showMessage('{0} selection {1}'.format(tool.capitalize(), "on" if on else "off"), 2000)
+
+
+	def set_selection(self, points_i, points_j=None):
+		""" Replaces the selection by the given global cells, or clears it if points_i is None. """
+		if points_i is None or len(points_i) == 0:
+			self.selection = None
+			self.statusBar().showMessage('Selection cleared', 2000)
+		else:
+			self.selection = (np.asarray(points_i, dtype=np.intp), np.asarray(points_j, dtype=np.intp))
+			self.statusBar().showMessage('{0} cells selected'.format(len(points_i)), 2000)
+		self.render_view()
+		self.render_edited_cells()
+
+
+	@timed_interaction("lasso")
+	def lasso_selected(self, points):
+		"""
+		Called by the lasso tool with the (column, row) view indices of the cells inside the lasso.
+		"""
+		inview = (points[:,0] < self.dc.view.shape[1]) & (points[:,1] < self.dc.view.shape[0])
+		points_i, points_j = self.dc.viewIndex2GlobalIndex(points[inview,1], points[inview,0])
+		self.set_selection(points_i, points_j)
+
+
+	@timed_interaction("select")
+	def rectangle_selected(self, eclick, erelease):
+		"""
+		Called by the rectangle tool with the press and release events. The cells whose centres
+		lie within the rectangle are selected.
+		"""
+		if None in (eclick.xdata, eclick.ydata, erelease.xdata, erelease.ydata): return
+		x0, x1 = sorted([eclick.xdata, erelease.xdata])
+		y0, y1 = sorted([eclick.ydata, erelease.ydata])
+		# Cell (row, col) covers [col, col+1] x [row, row+1] in the view
+		rows = np.arange(max(0, int(np.ceil(y0-0.5))), min(self.dc.view.shape[0], int(np.floor(y1-0.5))+1))
+		cols = np.arange(max(0, int(np.ceil(x0-0.5))), min(self.dc.view.shape[1], int(np.floor(x1-0.5))+1))
+		vi, vj = np.meshgrid(rows, cols, indexing="ij")
+		points_i, points_j = self.dc.viewIndex2GlobalIndex(vi.ravel(), vj.ravel())
+		self.set_selection(points_i, points_j)
+
+
+	def smooth_selection(self):
+		"""
+		Asks for a kernel and the number of iterations and smooths the selected cells as one edit.
+		"""
+		if self.selection is None:
+			self.statusBar().showMessage('Nothing selected. Use S (lasso) or R (rectangle) to select cells', 2000)
+			return
+		kernel, ok = QInputDialog.getItem(self, "Smooth selection", "Kernel:", KERNELS, KERNELS.index("mean9"), False)
+		if not ok: return
+		kernel = str(kernel)
+		iterations, ok = QInputDialog.getInt(self, "Smooth selection", "Iterations:", 1, 1, 1000)
+		if not ok: return
+		sigma = 1.0
+		if kernel == "gaussian":
+			sigma, ok = QInputDialog.getDouble(self, "Smooth selection", "Standard deviation (cells):", 1.0, 0.1, 20.0, 1)
+			if not ok: return
+
+		points_i, points_j = self.selection
+		self.dc.smoothSelection(points_i, points_j, kernel, iterations, sigma)
+		self.unsaved_changes_exist = True
+		self.statusBar().showMessage('{0} cells smoothed ({1} x {2})'.format(len(points_i), iterations, kernel), 2000)
+		self.set_stats_info(self.dc.getViewStatistics())
+		self.render_view()
+		self.render_edited_cells()
+
+
+	def bulk_edit(self):
+		"""
+		Asks for an operation and its arguments and applies it to the selected cells as one edit.
+		"""
+		if self.selection is None:
+			self.statusBar().showMessage('Nothing selected. Use S (lasso) or R (rectangle) to select cells', 2000)
+			return
+		op, ok = QInputDialog.getItem(self, "Bulk edit", "Operation:", list(OPERATIONS), 0, False)
+		if not ok: return
+		op = str(op)
+		points_i, points_j = self.selection
+		value = lo = hi = None
+		prompts = {"set": "New value:", "add": "Value to add:", "scale": "Scale factor:",
+				   "min": "Smallest of each cell and:", "max": "Largest of each cell and:"}
+
+		if op in prompts:
+			value, ok = QInputDialog.getDouble(self, "Bulk edit", prompts[op], 0.0, -1e12, 1e12, 4)
+			if not ok: return
+		elif op == "clamp":
+			vals = self.dc.data[points_i, points_j]
+			lo, ok = QInputDialog.getDouble(self, "Bulk edit", "Lower limit:", float(vals.min()), -1e12, 1e12, 4)
+			if not ok: return
+			hi, ok = QInputDialog.getDouble(self, "Bulk edit", "Upper limit:", float(vals.max()), lo, 1e12, 4)
+			if not ok: return
+		else:
+			fname = QFileDialog.getOpenFileName(self, "Copy from file", self.dc.fname, "netCDF files (*.nc);;All files (*)")
+			if not fname: return
+			varname, ok = QInputDialog.getText(self, "Bulk edit", "Variable to copy from:", QLineEdit.Normal, self.dc.datavar)
+			if not ok: return
+			# The other file is read in the background. The edit is made once the values are in.
+			self.tasks.submit("Reading {0}".format(varname),
+							  lambda progress, *args: self.dc.readValues(*args),
+							  (str(fname), str(varname), points_i, points_j),
+							  finished=lambda vals: self.apply_bulk_edit(points_i, points_j, op, vals, lo, hi),
+							  failed=lambda err: QMessageBox.warning(self, "Bulk edit", str(err)))
+			return
+
+		self.apply_bulk_edit(points_i, points_j, op, value, lo, hi)
+
+
+	def apply_bulk_edit(self, points_i, points_j, op, value, lo, hi):
+		""" Applies a bulk operation to a group of cells as one edit. See DataContainer.applyOperation. """
+		self.dc.applyOperation(points_i, points_j, op, value, lo, hi)
+		self.unsaved_changes_exist = True
+		self.statusBar().showMessage('{0}: {1} cells changed'.format(op, len(points_i)), 2000)
+		self.set_stats_info(self.dc.getViewStatistics())
+		self.render_view()
+		self.render_edited_cells()
+	# <<<< SELECTIONS
+
+
+	@timed_stage()
 	def render_view(self):
 		self.axes.clear()
 		# Either select the colormap through the combo box or specify a custom colormap
 		# cmap = mpl.cm.get_cmap(self.maps[self.colormaps.currentIndex()])
 		cmap   = topography_cmap(80, end=0.85)
 		ll, ul = make_balanced(ll=-7.*self.dc.scale)
-		self.axes.pcolor(self.dc.view, cmap=cmap, edgecolors='w', linewidths=0.5, vmin=ll, vmax=ul)
+		with self.latency.stage("pcolor"):
+			cells = self.axes.pcolor(self.dc.view, cmap=cmap, edgecolors='w', linewidths=0.5, vmin=ll, vmax=ul)
+		# A view prepared in the background has its colours ready
+		item = self.dc.viewcache.peek((self.dc.si, self.dc.sj))
+		if item is not None and "rgba" in item:
+			cells.set_array(None)
+			cells.set_facecolor(face_colors(item, self.dc.view))
 		
 		# Setting the axes limits. This helps in setting the right orientation of the plot
 		# and in clontrolling how much extra space we want around the scatter plot.
@@ -535,13 +977,14 @@ class TopoEditor(QMainWindow):
 		# I am putting 4% space around the scatter plot
 		self.axes.set_ylim([int(tmp1*1.02), 0 - int(tmp1*0.02)])
 		self.axes.set_xlim([0 - int(tmp2*0.02), int(tmp2*1.02)])
-		self.canvas.draw()
-		self.fig.tight_layout()
+		with self.latency.stage("canvas.draw"): self.canvas.draw()
+		with self.latency.stage("tight_layout"): self.fig.tight_layout()
 		self.draw_cursor(noremove=True)
 	
 	
 
 
+	@timed_interaction("edit")
 	def update_value(self, inp=None):
 		if inp == None:
 			inp = self.inputbox.text()   # Get the value in the text box
@@ -580,17 +1023,21 @@ class TopoEditor(QMainWindow):
 		self.valdisplay.setText("{0}".format(self.dc.data[i_global, j_global]))
 	
 
+	@timed_stage("stats panel")
 	def set_stats_info(self, s):
 		"""
 		Updates the statistics display panel with the stats for the view.
 		ARGUMENTS
 			s - a tuple with the min, max and mean of the view
 		"""
+		# The weighted global mean is kept up to date with the edits, so it is shown afresh
+		if self.dc.weighted: self.statsarray[5].setText("{0:5.2f}".format(self.dc.getGlobalMean()))
 		self.statsarray[0].setText("{0:5.2f}".format(s[0]))
 		self.statsarray[1].setText("{0:5.2f}".format(s[1]))
 		self.statsarray[2].setText("{0:5.2f}".format(s[2]))
 
 
+	@timed_interaction("jump")
 	def onclick(self, event):
 		# 1. Get the global row, column indices of the point where mouse was clicked
 		if (event.xdata == None) or (event.ydata == None): return
@@ -605,15 +1052,66 @@ class TopoEditor(QMainWindow):
 		self.cursor.y = 0
 		# 5. Draw the cursor
 		self.draw_cursor()
+		# 6. Prepare the views around the new one
+		self.prefetch_timer.start(200)
 		# 6. Update the preview 
 		self.draw_preview_rectangle()
 
 	
+	def toggle_weighted_stats(self):
+		""" Switches the means of the statistics panel between plain and area-weighted means. """
+		self.dc.weighted = not self.dc.weighted
+		self.dc.viewcache.clear()   # The prepared statistics are of the other kind
+		self.meanlabel.setText("Mean (area)" if self.dc.weighted else "Mean")
+		self.statsarray[5].setText("{0:5.2f}".format(self.dc.getGlobalMean()))
+		self.set_stats_info(self.dc.getViewStatistics())
+		msg = 'Means weighted by {0}'.format(self.dc.weights_source) if self.dc.weighted else 'Unweighted means'
+		self.statusBar().showMessage(msg, 2000)
+
+
+	def view_colorizer(self):
+		""" Returns a function that colours a view as render_view does, for the prefetch thread. """
+		cmap   = topography_cmap(80, end=0.85)
+		ll, ul = make_balanced(ll=-7.*self.dc.scale)
+		norm   = mpl.colors.Normalize(vmin=ll, vmax=ul)
+		return lambda view: cmap(norm(view))
+
+
+	def prefetch_views(self):
+		""" Asks the prefetch thread to prepare the views around the current one. """
+		self.prefetch_colorize = self.view_colorizer()
+		self.prefetcher.request(self.dc.si, self.dc.sj, self.dc.nrows, self.dc.ncols, self.dc.ny, self.dc.nx)
+
+
+	def prefetch_view(self, si, sj):
+		""" Prepares a view in the prefetch thread. This must not touch any widgets. """
+		return self.dc.prepareView(si, sj, self.prefetch_colorize)
+
+
+	def toggle_latency_hud(self):
+		""" Shows or hides the latency display over the view. Showing it starts the timing of the interactions. """
+		if self.latency_hud is None:
+			self.latency_hud = QLabel(self.canvas)
+			self.latency_hud.setStyleSheet("QLabel { background-color: rgba(0, 0, 0, 170); color: white; "
+										   "font-family: monospace; padding: 4px; }")
+			self.latency.listeners.append(self.update_latency_hud)
+		self.latency.enabled = True
+		self.latency_hud.setVisible(not self.latency_hud.isVisible())
+		self.update_latency_hud()
+
+
+	def update_latency_hud(self, kind=None, ms=None):
+		if self.latency_hud is None or not self.latency_hud.isVisible(): return
+		self.latency_hud.setText(self.latency.hud_text())
+		self.latency_hud.adjustSize()
+
+
 	def on_about(self):
 		msg = """ Edit 2D geophysical field.  """
 		QMessageBox.about(self, "About", msg.strip())
 	
 	
+	@timed_interaction("save")
 	def save_data(self):
 		"""
 		Saves the data to the netCDF4 file from which input data was read in. First, the program asks
@@ -627,19 +1125,55 @@ class TopoEditor(QMainWindow):
 				self.save_var = None
 				return
 
-		ncfile = Dataset(self.dc.fname, "a", format="NETCDF4")
-		if not self.save_var in ncfile.variables.keys():
-			dvar = ncfile.createVariable(self.save_var, 'f4', (self.dc.lat_var, self.dc.lon_var), zlib=True)
-			dvar.units = "km"
-		else:
-			dvar = ncfile.variables[self.save_var]
-		dvar[:,:] = self.dc.data/self.dc.scale
-		ncfile.close()
-		self.unsaved_changes_exist = False
-		self.statusBar().showMessage('Saved to variable: %s' % self.save_var, 2000)
+		# The data is written by the background saver from a snapshot, so that editing can
+		# continue while the file is being written.
+		generation, data = self.dc.snapshot()
+		self.saver.submit(generation, write_topo_variable, self.dc.fname, self.save_var,
+						  self.dc.lat_var, self.dc.lon_var, max(self.dc.nrows, self.dc.ncols), data)
+		self.statusBar().showMessage('Saving to variable: %s' % self.save_var)
+
+
+	def on_save_progress(self, msg):
+		self.statusBar().showMessage(msg)
+
+
+	def on_save_finished(self, generation, msg):
+		# Edits made after the snapshot was taken are still unsaved
+		if generation == self.dc.generation: self.unsaved_changes_exist = False
+		self.statusBar().showMessage(msg, 2000)
+
+
+	def on_save_failed(self, generation, msg):
+		# The failure has already been shown if the window was being closed when it came in
+		if self.saver.takeFailure() is None: return
+		self.show_save_failure(msg)
+
+
+	def show_save_failure(self, msg, closing=False):
+		# The variable may not have been created, so the next save asks for its name again
+		self.save_var = None
+		self.statusBar().showMessage('Save failed', 2000)
+		if closing: msg = "The last save failed, so the window stays open. The edits are kept in the journal.\n\n" + str(msg)
+		QMessageBox.critical(self, "Save failed", str(msg))
 
 	
 	
+	def on_busy(self, busy):
+		""" Shows a busy cursor while any background task is running. """
+		if busy: QApplication.setOverrideCursor(QCursor(Qt.BusyCursor))
+		else: QApplication.restoreOverrideCursor()
+
+
+	def on_task_progress(self, name, msg, percent):
+		if percent >= 0: msg = '{0} ({1}%)'.format(msg or name, percent)
+		self.statusBar().showMessage(msg or '{0}...'.format(name))
+
+
+	def on_task_failed(self, name, msg):
+		self.statusBar().showMessage('{0} failed: {1}'.format(name, str(msg).strip().splitlines()[-1]), 5000)
+
+
+
 	def create_action(self, text, slot=None, shortcut=None, 
 					  icon=None, tip=None, checkable=False, 
 					  signal="triggered()"):
@@ -673,13 +1207,20 @@ class TopoEditor(QMainWindow):
 			shortcut="Ctrl+S", slot=self.save_data, 
 			tip="Save the data array")
 		
-		self.add_actions(self.file_menu, (load_file_action,))
+		load_overlay_action = self.create_action("Load &Overlay...",
+			shortcut="Ctrl+O", slot=self.load_overlay,
+			tip="Highlight the cells of a changes table, e.g. one made by ncdiff.py --noflip")
+		
+		self.add_actions(self.file_menu, (load_file_action, load_overlay_action))
 
 		self.help_menu = self.menuBar().addMenu("&Help")
 		about_action = self.create_action("&About", 
 			shortcut='F1', slot=self.on_about, 
 			tip='About TopoEditor')
-		self.add_actions(self.help_menu, (about_action,))
+		latency_action = self.create_action("&Latency HUD",
+			shortcut='F3', slot=self.toggle_latency_hud,
+			tip='Show how long each kind of interaction takes', checkable=True)
+		self.add_actions(self.help_menu, (about_action, latency_action))
 
 
 	def closeEvent(self, event):
@@ -691,6 +1232,28 @@ class TopoEditor(QMainWindow):
 				event.accept()
 			else:
 				event.ignore()
+				return
+
+		# Wait for any save that is still being written
+		if self.saver.isBusy():
+			self.statusBar().showMessage('Waiting for save to finish...')
+			self.saver.wait()
+
+		# If a save failed, the edits since the last good save are only in the journal
+		failures = self.saver.takeFailures()
+		if failures:
+			self.show_save_failure(failures[-1][1], closing=True)
+			event.ignore()
+			return
+
+		self.prefetch_timer.stop()
+		self.prefetcher.wait()
+		self.tasks.cancelAll()
+		self.tasks.waitForDone()
+
+		# The session ended normally, so there is nothing left to recover
+		self.dc.journal.close(remove=True)
+		if self.latency_log: self.latency.dump(self.latency_log)
 
 	
 	
@@ -702,10 +1265,21 @@ def main():
 	parser.add_argument('fname', nargs=1, type=str, help='name of the netcdf4 data file')
 	parser.add_argument('var',   nargs=1, type=str, help='name of the variable in the netcdf4 file')
 	parser.add_argument('-s',    nargs=1, type=int, help='size of the view in number of pixels', default=[60])
+	parser.add_argument('--latency', nargs=1, type=str, help='time the interactions and write the timings to this .json or .csv file on exit', default=[None])
 	parser.add_argument('--scale', nargs=1, type=float, help='multiplicative scaling factor for the data', default=[1.0])
 	args = parser.parse_args()
 
-	mw = TopoEditor(args.fname[0], args.var[0], dwx=args.s[0], dwy=args.s[0], scale=args.scale[0])
+	# The file is read in the background, so that the application does not freeze while it loads
+	try:
+		dc = run_with_progress(None, 'Reading {0}'.format(args.fname[0]),
+							   lambda progress, *dcargs: DataContainer(*dcargs, progress=progress), (args.s[0], args.s[0], args.fname[0], args.var[0], args.scale[0]))
+	except TaskCancelled:
+		return
+	except ValueError as err:
+		QMessageBox.critical(None, 'Error', str(err), QMessageBox.Ok)
+		return
+
+	mw = TopoEditor(args.fname[0], args.var[0], dwx=args.s[0], dwy=args.s[0], scale=args.scale[0], dc=dc, latency_log=args.latency[0])
 	mw.show()     # Render the window
 	mw.raise_()   # Bring the PyQt4 window to the front
 	app.exec_()   # Run the application loop
@@ -0,0 +1,56 @@
+import os, sys
+import numpy as np
+from netCDF4 import Dataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+from gridio import read_kmt_grid, write_kmt_file
+from changelog import read_changes, latest_changes, replay
+
+
+def write_kmt(fname, kmt):
+    with Dataset(fname, "w") as ncfile:
+        ncfile.createDimension("latitude", kmt.shape[0])
+        ncfile.createDimension("longitude", kmt.shape[1])
+        lats, lons = np.meshgrid(np.linspace(-80, 80, kmt.shape[0]), np.linspace(0, 350, kmt.shape[1]), indexing="ij")
+        ncfile.createVariable("ULAT", "f8", ("latitude", "longitude"))[:] = lats
+        ncfile.createVariable("ULON", "f8", ("latitude", "longitude"))[:] = lons
+        ncfile.createVariable("kmt", "i4", ("latitude", "longitude"))[:] = kmt
+
+
+def save(fname, ofile, changes):
+    """ Saves the edits of a changes table made to fname, as KMTEditor does. """
+    data = read_kmt_grid(fname, "kmt")[0]
+    orig = np.copy(data)
+    for i, j, v in changes: data[int(i), int(j)] = v
+    write_kmt_file(lambda msg: None, fname, ofile, True, True, 60, data, orig, changes)
+
+
+def test_shorter_table_replaces_a_longer_one(tmpdir):
+    fin, fixed, refixed = [str(tmpdir.join(n)) for n in ("in.nc", "fixed.nc", "refixed.nc")]
+    write_kmt(fin, np.full((6, 8), 10, dtype="i4"))
+    save(fin, fixed, np.array([[1, 1, 3], [2, 2, 5], [1, 1, 4], [1, 1, 3]], dtype="f8"))
+
+    # Reopening compacts the table, and another edit is made
+    changes = latest_changes(read_changes(fixed)[0], (6, 8))
+    changes = np.concatenate((changes, [[1, 1, 7]]))
+    data = read_kmt_grid(fixed, "kmt")[0]
+    data[1, 1] = 7
+    write_kmt_file(lambda msg: None, fixed, refixed, True, True, 60, data, read_changes(fixed)[1], changes)
+
+    stored = latest_changes(read_changes(refixed)[0], (6, 8))
+    assert stored.tolist() == [[2, 2, 5], [1, 1, 7]]
+    assert read_kmt_grid(refixed, "kmt")[0][1, 1] == 7
+
+
+def test_replay_onto_a_saved_file_appends_to_its_table(tmpdir):
+    fin, source, target, out = [str(tmpdir.join(n)) for n in ("in.nc", "source.nc", "target.nc", "out.nc")]
+    write_kmt(fin, np.full((6, 8), 10, dtype="i4"))
+    save(fin, source, np.array([[3, 3, 1]], dtype="f8"))
+    save(fin, target, np.array([[1, 1, 3], [1, 1, 4], [2, 2, 5]], dtype="f8"))
+    replay(source, target, out)
+
+    changes, original = read_changes(out)
+    assert changes.tolist() == [[1, 1, 3], [1, 1, 4], [2, 2, 5], [3, 3, 1]]
+    assert (original == 10).all()
+    data = read_kmt_grid(out, "kmt")[0]
+    assert (data[1, 1], data[2, 2], data[3, 3]) == (4, 5, 1)
@@ -0,0 +1,25 @@
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+from chunking import plan_chunks, plan_chunk_cache, CHUNK_BYTES
+
+
+SHAPE = (40, 62, 2400, 3600)   # A 3D field of tx0.1 with a time dimension
+
+
+def test_full_cache_holds_the_chunks_of_one_slab():
+    for pattern in ("full", "tile2d"):
+        chunks = plan_chunks(SHAPE, "f4", pattern)
+        size, nelems, preemption = plan_chunk_cache(SHAPE, "f4", chunks, "full", slab=[1, 1, 2400, 3600])
+        # One slab of 2400 x 3600 floats, rounded up to whole chunks
+        assert 2400*3600*4 <= size <= 2*2400*3600*4
+
+
+def test_full_cache_is_capped_by_the_budget():
+    chunks = plan_chunks(SHAPE, "f4", "timeseries")
+    budget = 64*1024*1024
+    size, nelems, preemption = plan_chunk_cache(SHAPE, "f4", chunks, "full", slab=[1, 1, 2400, 3600], budget=budget)
+    assert size == budget
+    size, nelems, preemption = plan_chunk_cache(SHAPE, "f4", chunks, "full", budget=1)
+    assert size == CHUNK_BYTES
@@ -0,0 +1,38 @@
+import os, sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+from gridops import label, component
+from kmtcheck import PathologyScanner
+
+
+class Stop(Exception):
+    pass
+
+
+def stopper(calls):
+    """ A progress function that raises on its calls-th call, as a cancelled task's does. """
+    def progress(msg="", percent=-1):
+        calls[0] -= 1
+        if calls[0] == 0: raise Stop()
+    return progress
+
+
+def test_label_reports_progress_and_can_be_stopped():
+    # A serpentine takes several passes of the union-find
+    mask = np.zeros((40, 40), dtype=bool)
+    mask[::2, :] = True
+    mask[1::4, -1] = mask[3::4, 0] = True
+    calls = [10**6]
+    labels, n = label(mask, progress=stopper(calls))
+    assert n == 1 and calls[0] < 10**6
+    with pytest.raises(Stop):
+        component(mask, 0, 0, progress=stopper([2]))
+
+
+def test_scanner_can_be_stopped():
+    kmt = np.zeros((20, 30), dtype=np.int32)
+    kmt[2:18, 2:28] = 10
+    with pytest.raises(Stop):
+        PathologyScanner(kmt, progress=stopper([2]))
@@ -0,0 +1,50 @@
+import os, sys, time, threading
+import numpy as np
+from netCDF4 import Dataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+import gridsession
+from gridsession import GridSession, session_path
+
+
+def write_kmt(fname, kmt):
+    with Dataset(fname, "w") as ncfile:
+        ncfile.createDimension("latitude", kmt.shape[0])
+        ncfile.createDimension("longitude", kmt.shape[1])
+        lats, lons = np.meshgrid(np.linspace(-80, 80, kmt.shape[0]), np.linspace(0, 350, kmt.shape[1]), indexing="ij")
+        ncfile.createVariable("ULAT", "f8", ("latitude", "longitude"))[:] = lats
+        ncfile.createVariable("ULON", "f8", ("latitude", "longitude"))[:] = lons
+        ncfile.createVariable("kmt", "i4", ("latitude", "longitude"))[:] = kmt
+
+
+def test_attach_does_not_remove_a_session_being_started(tmpdir, monkeypatch):
+    fname = str(tmpdir.join("kmt.nc"))
+    write_kmt(fname, np.full((6, 8), 10, dtype="i4"))
+    monkeypatch.setattr(gridsession.tempfile, "tempdir", str(tmpdir))
+
+    # The two editors are threads here. The first stands for another (live) process.
+    getpid = os.getpid
+    monkeypatch.setattr(gridsession.os, "getpid",
+                        lambda: os.getppid() if threading.current_thread().name == "first" else getpid())
+    # The first editor is slow to join the session it has just started, after mapping its arrays
+    load = np.load
+    def slow_load(fname, *args, **kwargs):
+        a = load(fname, *args, **kwargs)
+        if threading.current_thread().name == "first" and fname.endswith("lats.npy"): time.sleep(0.3)
+        return a
+    monkeypatch.setattr(gridsession.np, "load", slow_load)
+
+    sessions = {}
+    first = threading.Thread(name="first", target=lambda: sessions.update(first=GridSession.attach(fname)))
+    first.start()
+    time.sleep(0.1)
+    second = GridSession.attach(fname)
+    first.join()
+
+    assert sessions["first"].path == second.path
+    second.data[2, 3] = 4
+    assert sessions["first"].data[2, 3] == 4
+    sessions["first"].detach()
+    assert os.path.isdir(second.path)
+    second.detach()
+    assert not os.path.isdir(session_path(fname, "kmt"))
@@ -0,0 +1,61 @@
+import os, sys, subprocess
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+import journal
+from journal import EditJournal, read_journal, journal_path, orphaned_journals, discard_journals
+
+
+def test_journals_of_different_editors_are_kept_apart(tmpdir):
+    fname = str(tmpdir.join("kmt.nc"))
+    kmt = EditJournal(fname, "kmt", (6, 8), "kmt")
+    kmt.append_point(1, 2, 30.)
+    kmt.close()
+    rmask = EditJournal(fname, "kmt", (6, 8), "rmask")
+    rmask.append_bulk([3, 4], [5, 6], 2.)
+    rmask.close()
+
+    (i, j, v), = read_journal(fname, "kmt", (6, 8), "kmt")
+    assert (i[0], j[0], v[0]) == (1, 2, 30.)
+    (i, j, v), = read_journal(fname, "kmt", (6, 8), "rmask")
+    assert list(i) == [3, 4] and list(v) == [2., 2.]
+    assert read_journal(fname, "kmt", (6, 8), "topo") == []
+
+
+def test_journal_of_another_editor_is_rejected(tmpdir):
+    fname = str(tmpdir.join("kmt.nc"))
+    EditJournal(fname, "kmt", (6, 8), "kmt").close()
+    os.rename(journal_path(fname, "kmt", "kmt"), journal_path(fname, "kmt", "rmask"))
+    with pytest.raises(ValueError):
+        read_journal(fname, "kmt", (6, 8), "rmask")
+
+
+def journal_of(fname, pid, monkeypatch, vals):
+    """ Writes a journal as the editor of process pid would. """
+    monkeypatch.setattr(journal.os, "getpid", lambda: pid)
+    jrnl = EditJournal(fname, "kmt", (6, 8), "kmt")
+    jrnl.append_bulk([1, 2], [3, 4], vals)
+    jrnl.close()
+    monkeypatch.undo()
+
+
+def test_editors_have_journals_of_their_own(tmpdir, monkeypatch):
+    fname = str(tmpdir.join("kmt.nc"))
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    dead, live = proc.pid, os.getppid()
+    journal_of(fname, dead, monkeypatch, 5.)
+    journal_of(fname, live, monkeypatch, 7.)
+
+    # This editor's journal does not replace those of the others
+    EditJournal(fname, "kmt", (6, 8), "kmt").close()
+    assert sorted(orphaned_journals(fname, "kmt", "kmt")) == sorted([dead, os.getpid()])
+    (i, j, v), = read_journal(fname, "kmt", (6, 8), "kmt", dead)
+    assert list(v) == [5., 5.]
+
+    # Only the journal of the editor that is gone is removed
+    discard_journals(fname, "kmt", "kmt", [dead, os.getpid()])
+    assert not os.path.exists(journal_path(fname, "kmt", "kmt", dead))
+    assert os.path.exists(journal_path(fname, "kmt", "kmt", live))
+    assert os.path.exists(journal_path(fname, "kmt", "kmt"))
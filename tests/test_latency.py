@@ -0,0 +1,22 @@
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+import latency
+from latency import LatencyRecorder
+
+
+def test_count_covers_the_whole_session():
+    recorder = LatencyRecorder(enabled=True, window=4, maxrecords=3)
+    for n in range(10):
+        with recorder.interaction("pan"):
+            with recorder.stage("pcolor"): pass
+    assert len(recorder.records) == 3
+    assert recorder.summary()["pan"]["count"] == 10
+
+
+def test_fallback_clock_is_monotonic():
+    clock = latency._clock_gettime()
+    if clock is None: return   # Not Linux or macOS
+    t0 = clock()
+    time.sleep(0.01)
+    assert 0.005 < clock() - t0 < 1.
@@ -0,0 +1,36 @@
+import os, sys
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+from ncbatch import ncbatch, output_names
+
+
+def write(fname, value):
+    with Dataset(fname, "w") as ncfile:
+        ncfile.createDimension("x", 3)
+        ncfile.createVariable("v", "f4", ("x",))[:] = value
+
+
+def test_outputs_of_one_directory_go_straight_into_outdir():
+    assert output_names(["in/a.nc", "in/b.nc"], "out") == [os.path.join("out", "a.nc"), os.path.join("out", "b.nc")]
+
+
+def test_inputs_of_the_same_name_keep_their_directories(tmpdir):
+    files = []
+    for n, run in enumerate(("run1", "run2")):
+        tmpdir.mkdir(run)
+        files.append(str(tmpdir.join(run, "a.nc")))
+        write(files[-1], n)
+    outdir = str(tmpdir.join("out"))
+    results = ncbatch(files, outdir, nprocs=2, quiet=True)
+    assert sorted(r["status"] for r in results) == ["done", "done"]
+    for n, run in enumerate(("run1", "run2")):
+        with Dataset(os.path.join(outdir, run, "a.nc")) as ncfile:
+            assert (ncfile.variables["v"][:] == n).all()
+
+
+def test_colliding_outputs_are_refused():
+    with pytest.raises(ValueError):
+        output_names(["a.nc", "./a.nc"], "out")
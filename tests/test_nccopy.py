@@ -0,0 +1,89 @@
+import os, sys
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+import nccopy as nccopy_module
+from nccopy import nccopy, _pipelined_copy
+from copystats import CopyStats
+
+
+def write_packed(fname, fill=True, missing=False):
+    """ Writes a packed short variable with one cell equal to -32767. """
+    ncfile = Dataset(fname, "w", format="NETCDF3_CLASSIC")
+    ncfile.createDimension("x", 4)
+    var = ncfile.createVariable("v", "i2", ("x",), fill_value=-32767 if fill else None)
+    var.scale_factor = 0.01
+    var.add_offset   = 10.
+    if missing: var.missing_value = np.int16(-32767)
+    var.set_auto_maskandscale(False)
+    var[:] = np.array([0, 100, -32767, 200], dtype="i2")
+    ncfile.close()
+
+
+def read(fname):
+    with Dataset(fname) as ncfile: return ncfile.variables["v"][:]
+
+
+def test_unpack_masks_fill_values(tmpdir):
+    for nworkers in (0, 2):
+        fin, fout = str(tmpdir.join("in.nc")), str(tmpdir.join("out%d.nc" % nworkers))
+        write_packed(fin)
+        nccopy(fin, fout, quiet=True, nworkers=nworkers)
+        data = read(fout)
+        assert np.ma.getmaskarray(data).tolist() == [False, False, True, False]
+        np.testing.assert_allclose(data.compressed(), [10., 11., 12.], rtol=1e-6)
+
+
+def test_unpack_masks_default_fill_values(tmpdir):
+    fin, fout = str(tmpdir.join("in.nc")), str(tmpdir.join("out.nc"))
+    write_packed(fin, fill=False)
+    nccopy(fin, fout, quiet=True)
+    assert np.ma.getmaskarray(read(fout)).tolist() == [False, False, True, False]
+
+
+def test_unpack_sets_missing_values(tmpdir):
+    fin, fout = str(tmpdir.join("in.nc")), str(tmpdir.join("out.nc"))
+    write_packed(fin, missing=True)
+    nccopy(fin, fout, quiet=True)
+    with Dataset(fout) as ncfile:
+        var = ncfile.variables["v"]
+        var.set_auto_mask(False)
+        np.testing.assert_allclose(var[:], [10., 11., 1.e30, 12.], rtol=1e-6)
+        assert var.missing_value == 1.e30
+
+
+def _dying_reader(filein, tasks, results):
+    os._exit(3)
+
+
+def test_pipeline_fails_when_a_reader_cannot_open_the_input(tmpdir):
+    fin, fout = str(tmpdir.join("in.nc")), str(tmpdir.join("out.nc"))
+    write_packed(fin)
+    nccopy(fin, fout, quiet=True)
+    with pytest.raises(RuntimeError):
+        _pipelined_copy(str(tmpdir.join("missing.nc")), fout, [("v", [(slice(0, 4),)], 0, True, None, False)],
+                        2, True, CopyStats(fin, fout), lambda varname, nbytes: None)
+
+
+def test_pipeline_fails_when_a_reader_dies(tmpdir, monkeypatch):
+    fin, fout = str(tmpdir.join("in.nc")), str(tmpdir.join("out.nc"))
+    write_packed(fin)
+    nccopy(fin, fout, quiet=True)
+    monkeypatch.setattr(nccopy_module, "_pipeline_reader", _dying_reader)
+    with pytest.raises(RuntimeError):
+        _pipelined_copy(fin, fout, [("v", [(slice(0, 4),)], 0, True, None, False)],
+                        2, True, CopyStats(fin, fout), lambda varname, nbytes: None, poll=0.1)
+
+
+def test_rechunked_copy_keeps_the_values(tmpdir):
+    fin, fout = str(tmpdir.join("in.nc")), str(tmpdir.join("out.nc"))
+    data = np.random.RandomState(0).rand(3, 130, 170).astype("f4")
+    with Dataset(fin, "w") as ncfile:
+        for name, n in zip(("t", "y", "x"), data.shape): ncfile.createDimension(name, n)
+        ncfile.createVariable("v", "f4", ("t", "y", "x"))[:] = data
+    nccopy(fin, fout, quiet=True, chunking="tile2d", tile=50, membudget=0.05)
+    with Dataset(fout) as ncfile:
+        assert ncfile.variables["v"].chunking() == [1, 50, 50]
+        np.testing.assert_array_equal(ncfile.variables["v"][:], data)
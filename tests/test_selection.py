@@ -0,0 +1,37 @@
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+from selection import Selection
+
+
+def test_matches_a_boolean_mask():
+    ny, nx = 37, 53    # Not a multiple of 8 columns
+    rng  = np.random.RandomState(3)
+    sel  = Selection(ny, nx)
+    mask = np.zeros((ny, nx), dtype=bool)
+    for mode in ["union", "union", "subtract", "union", "replace", "subtract", "union"]:
+        i0, j0 = rng.randint(0, ny-5), rng.randint(0, nx-9)
+        i = rng.randint(i0, min(ny, i0+12), 40)
+        j = rng.randint(j0, min(nx, j0+20), 40)
+        if mode == "replace": mask[:] = False
+        mask[i, j] = mode != "subtract"
+        assert sel.add(i, j, mode) == mask.sum()
+        rows, cols = sel.indices()
+        assert np.array_equal(rows, np.nonzero(mask)[0]) and np.array_equal(cols, np.nonzero(mask)[1])
+
+    # Each selected cell has four edges, shared with its selected neighbours
+    segments = sel.outline(0, 0, ny, nx)
+    pad = np.pad(mask, 1, mode="constant")
+    assert len(segments) == (pad[1:-1, :-1] != pad[1:-1, 1:]).sum() + (pad[:-1, 1:-1] != pad[1:, 1:-1]).sum()
+    # A view hanging over the edge of the grid
+    segments = sel.outline(ny-10, nx-10, 20, 20)
+    assert len(segments) == 0 or segments.max() <= 20
+
+    sel.clear()
+    assert len(sel) == 0 and not sel.bits.any()
+
+
+def test_bitmap_is_packed():
+    sel = Selection(2400, 3600)
+    assert sel.bits.nbytes == 2400*3600//8
@@ -0,0 +1,24 @@
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities"))
+from smoothing import smooth_selection
+
+
+DATA = np.arange(36, dtype=np.float64).reshape(6, 6)**1.5
+
+
+def test_interior_means():
+    block = DATA[1:4, 2:5]
+    # The F key of TopoEditor, (sum of the 3x3 block - centre)/8
+    assert np.allclose(smooth_selection(DATA, [2], [3], "mean8"), (block.sum() - DATA[2, 3])/8.)
+    # The A key of TopoEditor, (sum of the 3x3 block + centre)/9
+    assert np.allclose(smooth_selection(DATA, [2], [3], "akey"), (block.sum() + DATA[2, 3])/9.)
+    # The plain mean of the 3x3 block
+    assert np.allclose(smooth_selection(DATA, [2], [3], "mean9"), block.mean())
+
+
+def test_edges_average_the_neighbours_that_exist():
+    assert np.allclose(smooth_selection(DATA, [0], [0], "mean9"), DATA[0:2, 0:2].mean())
+    assert np.allclose(smooth_selection(DATA, [5], [3], "mean8"), (DATA[4:6, 2:5].sum() - DATA[5, 3])/5.)
+    assert np.allclose(smooth_selection(DATA, [5], [3], "akey"), (DATA[4:6, 2:5].sum() + DATA[5, 3])/6.)
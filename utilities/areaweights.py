@@ -0,0 +1,92 @@
+"""
+Area-weighted statistics for the statistics panels of the editors. On a latitude-longitude or a
+displaced-pole grid the cells differ in area, so the plain mean over the cells over-weights the
+high latitudes. The weights are the cell areas (TAREA or UAREA) when the file has them, and
+cos(latitude) otherwise.
+
+The weights are read once, as float32, and the weighted sum over the whole grid is updated from
+the cells each edit changes, so that the weighted global mean costs nothing per edit or pan.
+"""
+
+import numpy as np
+
+from gridio import read_cell_area
+
+
+AREA_NAMES = ("TAREA", "UAREA")
+
+
+
+def cell_weights(fname, lats, flip=True, names=AREA_NAMES):
+    """
+    Returns the weights of the cells of a grid.
+    ARGUMENTS
+        fname - the file of the grid, which is searched for an area variable
+        lats  - the latitudes of the cells, a 2D array or the 1D latitudes of the rows
+        flip  - whether the arrays of the editor are flipped (see gridio.read_kmt_grid)
+        names - the names of the area variables, in order of preference
+    RETURNS
+        a tuple (weights, source) with a float32 array of the shape of the grid (or of shape (ny, 1)
+        for 1D latitudes) and the name of the area variable used, or "cos(lat)"
+    """
+    area, name = read_cell_area(fname, names, flip)
+    lats = np.ma.filled(lats, 0).astype(np.float64)
+    shape = lats.shape if lats.ndim == 2 else None
+    if area is not None and (shape is None or area.shape == shape):
+        return area.astype(np.float32), name
+    w = np.cos(np.radians(lats)).clip(0).astype(np.float32)
+    if lats.ndim == 1: w = w[:, np.newaxis]
+    return w, "cos(lat)"
+
+
+
+class WeightedStats(object):
+    """
+    The weighted mean of a 2D field over its unmasked cells, kept up to date with its edits.
+    """
+
+    def __init__(self, data, weights):
+        """
+        ARGUMENTS
+            data    - the 2D (possibly masked) field
+            weights - the weights of cell_weights. A weights array of shape (ny, 1) is used for all
+                      the columns, and is expanded to the shape of the grid.
+        """
+        self.weights = np.asarray(weights, dtype=np.float32) * np.ones(data.shape, dtype=np.float32)
+        valid = ~np.ma.getmaskarray(data)
+        w = np.where(valid, self.weights, 0).astype(np.float64)
+        self.wsum  = w.sum()
+        self.wxsum = (w*np.ma.filled(data, 0)).sum()
+
+
+    def update(self, i, j, old, new):
+        """
+        Updates the weighted sum after an edit.
+        ARGUMENTS
+            i, j - the global indices of the cells the edit set
+            old  - the (masked) values of the cells before the edit
+            new  - the (masked) values of the cells after the edit
+        """
+        i, j = np.atleast_1d(i).astype(np.intp), np.atleast_1d(j).astype(np.intp)
+        old, new = np.ma.atleast_1d(old), np.ma.atleast_1d(new)
+        # A cell listed more than once is counted once
+        first = np.unique(np.ravel_multi_index((i, j), self.weights.shape), return_index=True)[1]
+        if len(first) < len(i): i, j, old, new = i[first], j[first], old[first], new[first]
+        w  = self.weights[i, j].astype(np.float64)
+        wo = np.where(np.ma.getmaskarray(old), 0, w)
+        wn = np.where(np.ma.getmaskarray(new), 0, w)
+        self.wsum  += wn.sum() - wo.sum()
+        self.wxsum += (wn*np.ma.filled(new, 0)).sum() - (wo*np.ma.filled(old, 0)).sum()
+
+
+    def mean(self):
+        """ Returns the weighted mean over the whole grid. """
+        return self.wxsum/self.wsum if self.wsum > 0 else np.nan
+
+
+    def viewMean(self, view, si, sj):
+        """ Returns the weighted mean of a view whose top left cell is (si, sj). """
+        w = self.weights[si:si+view.shape[0], sj:sj+view.shape[1]]
+        w = np.where(np.ma.getmaskarray(view), 0, w).astype(np.float64)
+        total = w.sum()
+        return (w*np.ma.filled(view, 0)).sum()/total if total > 0 else np.nan
@@ -0,0 +1,101 @@
+from PyQt4.QtCore import QThread, QMutex, SIGNAL
+import traceback
+
+
+class BackgroundSaver(QThread):
+    """
+    A worker thread that writes snapshots of the editor data to disk so that the GUI
+    thread is not blocked by nccopy, compression and HDF5 flushes.
+
+    Save requests are executed one at a time, in the order in which they were submitted,
+    so that two saves never write to the same file concurrently.
+
+    Signals emitted (old-style PyQt4 signals):
+        saveProgress(QString)       - a short message describing the current stage
+        saveFinished(int, QString)  - the generation of the saved snapshot, and a message
+        saveFailed(int, QString)    - the generation of the snapshot, and the error message
+
+    A failed save is also kept until the editor takes it with takeFailure, so that the editor
+    can find out about a failure whose saveFailed signal has not been delivered yet, e.g. when
+    it waits for the last save before closing.
+    """
+    def __init__(self, parent=None):
+        super(BackgroundSaver, self).__init__(parent)
+        self.mutex   = QMutex()
+        self.pending = []      # Jobs waiting to run, each a tuple (generation, func, args)
+        self.busy    = False   # True from the moment a job is submitted until the queue is empty
+        self.failures = []     # (generation, message) of the failed saves not yet taken, oldest first
+
+
+    def submit(self, generation, func, *args):
+        """
+        Queues a save job.
+        ARGUMENTS
+            generation - the edit generation of the snapshot that is being saved
+            func       - the function that does the writing. It is called as func(progress, *args)
+                         where progress is a function that accepts a message string. It must
+                         not touch any Qt widgets since it runs in the worker thread.
+            args       - the snapshot and any other arguments for func
+        """
+        self.mutex.lock()
+        self.pending.append((generation, func, args))
+        start_thread = not self.busy
+        self.busy    = True
+        self.mutex.unlock()
+
+        if start_thread:
+            self.wait()   # The previous run() may still be returning
+            self.start()
+
+
+    def isBusy(self):
+        self.mutex.lock()
+        busy = self.busy
+        self.mutex.unlock()
+        return busy
+
+
+    def takeFailure(self):
+        """
+        RETURNS
+            the (generation, message) of the oldest failed save not yet taken, or None
+        """
+        self.mutex.lock()
+        failure = self.failures.pop(0) if self.failures else None
+        self.mutex.unlock()
+        return failure
+
+
+    def takeFailures(self):
+        """ Returns the list of all the failed saves not yet taken, oldest first. """
+        self.mutex.lock()
+        failures, self.failures = self.failures, []
+        self.mutex.unlock()
+        return failures
+
+
+    def progress(self, msg):
+        self.emit(SIGNAL("saveProgress(QString)"), msg)
+
+
+    def run(self):
+        while True:
+            self.mutex.lock()
+            job = self.pending.pop(0) if self.pending else None
+            if job is None:
+                self.busy = False
+                self.mutex.unlock()
+                return
+            self.mutex.unlock()
+
+            generation, func, args = job
+            try:
+                msg = func(self.progress, *args)
+            except Exception:
+                msg = traceback.format_exc()
+                self.mutex.lock()
+                self.failures.append((generation, msg))
+                self.mutex.unlock()
+                self.emit(SIGNAL("saveFailed(int, QString)"), generation, msg)
+            else:
+                self.emit(SIGNAL("saveFinished(int, QString)"), generation, msg or "")
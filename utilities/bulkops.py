@@ -0,0 +1,51 @@
+"""
+Arithmetic on a set of cells at once, for the bulk edits of the editors and of the edit engine.
+Each operation maps the current values of the cells to their new values with one numpy operation.
+"""
+
+import numpy as np
+
+
+# The operations and the arguments they take
+OPERATIONS = ("set", "add", "scale", "clamp", "min", "max", "copy")
+
+
+
+def bulk_values(old, op, value=None, lo=None, hi=None):
+    """
+    Computes the new values of a set of cells.
+    ARGUMENTS
+        old    - an array with the current values of the cells
+        op     - one of OPERATIONS:
+                   set   - every cell becomes value
+                   add   - value is added to every cell
+                   scale - every cell is multiplied by value
+                   clamp - the cells are limited to the range lo..hi (either may be None)
+                   min   - every cell becomes the smaller of itself and value
+                   max   - every cell becomes the larger of itself and value
+                   copy  - value is an array with the new value of each cell, e.g. read from
+                           another variable
+    RETURNS
+        an array with the new values, in the order of old
+    RAISES
+        ValueError if the operation is unknown or is missing its argument
+    """
+    old = np.asarray(old, dtype=np.float64)
+    if op not in OPERATIONS:
+        raise ValueError("Unknown operation {0}. Must be one of {1}".format(op, OPERATIONS))
+    if op == "clamp":
+        if lo is None and hi is None:
+            raise ValueError("clamp needs a lower or an upper limit")
+        return np.clip(old, -np.inf if lo is None else lo, np.inf if hi is None else hi)
+    if value is None:
+        raise ValueError("{0} needs a value".format(op))
+
+    if op == "set":   return np.full(old.shape, float(value))
+    if op == "add":   return old + value
+    if op == "scale": return old * value
+    if op == "min":   return np.minimum(old, value)
+    if op == "max":   return np.maximum(old, value)
+    value = np.asarray(value, dtype=np.float64)
+    if value.shape != old.shape:
+        raise ValueError("copy needs {0} values, got {1}".format(old.size, value.size))
+    return value
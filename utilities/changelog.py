@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+changelog.py
+
+Reads the 'changes' table that KMTEditor stores in the files it saves, and replays it onto
+another file, e.g. to carry hand edits over to a regenerated KMT of the same grid:
+
+    python changelog.py gx1v6_kmt_fixed.nc gx1v6_kmt_new.nc -o gx1v6_kmt_new_fixed.nc
+
+The (i, j) indices of the table are in the orientation the editors work in, i.e. with the
+northernmost row first (see gridio.read_kmt_grid).
+"""
+
+from netCDF4 import Dataset
+import numpy as np
+import sys, argparse
+
+from gridio import read_kmt_grid, write_kmt_file
+
+
+
+def read_changes(fname):
+    """
+    Reads the changes table of a file saved by KMTEditor.
+    RETURNS
+        a tuple (changes, original) where changes is the (n, 3) array of (i, j, val) rows in the
+        order the edits were made, and original is the flipped 'original_kmt' array (or None if
+        the file has none). changes is None if the file has no changes table. Blank (fill
+        value) rows, which are left over from a longer table, are skipped.
+    """
+    ncfile = Dataset(fname, "r")
+    changes = original = None
+    if "changes" in ncfile.variables:
+        table   = np.ma.masked_invalid(ncfile.variables["changes"][:,:]).reshape(-1, 3)
+        blank   = np.ma.getmaskarray(table).any(axis=1)
+        changes = np.asarray(np.ma.filled(table, 0), dtype=np.float64)[~blank]
+    if "original_kmt" in ncfile.variables:
+        original = np.flipud(ncfile.variables["original_kmt"][:,:])
+    ncfile.close()
+    return changes, original
+
+
+
+def latest_changes(changes, shape):
+    """
+    Reduces a changes table to one row per cell, the last edit of each cell, in the order of
+    those last edits. A cell that was edited many times is then set only once when replaying.
+    """
+    i = changes[:,0].astype(np.intp)
+    j = changes[:,1].astype(np.intp)
+    if np.any((i < 0) | (i >= shape[0]) | (j < 0) | (j >= shape[1])):
+        raise ValueError("The changes table has cells outside of the {0}x{1} grid".format(*shape))
+    # np.unique returns the first occurrence, so the table is searched back to front
+    lin = np.ravel_multi_index((i, j), shape)[::-1]
+    last = len(lin) - 1 - np.unique(lin, return_index=True)[1]
+    return changes[np.sort(last)]
+
+
+
+def find_conflicts(base, changes, original):
+    """
+    Finds the edited cells whose value in base differs from their value in the original data
+    the edits were made to. Replaying an edit onto such a cell may overwrite a change made to
+    the base independently of the editing.
+    ARGUMENTS
+        base     - the 2D array the changes are replayed onto
+        changes  - a table as returned by latest_changes
+        original - the 2D array the changes were originally made to
+    RETURNS
+        an (m, 5) array of (i, j, base value, original value, new value) rows
+    """
+    i = changes[:,0].astype(np.intp)
+    j = changes[:,1].astype(np.intp)
+    b = np.ma.filled(base, 0)[i, j].astype(np.float64)
+    o = np.ma.filled(original, 0)[i, j].astype(np.float64)
+    c = b != o
+    return np.column_stack((i[c], j[c], b[c], o[c], changes[c,2]))
+
+
+
+def apply_changes(data, changes, skip=None):
+    """
+    Applies a changes table to an array in place with a single scatter.
+    ARGUMENTS
+        data    - the 2D array to edit
+        changes - a table as returned by latest_changes (one row per cell)
+        skip    - optionally, an (m, >=2) array whose first two columns are cells to leave alone,
+                  such as the conflicts returned by find_conflicts
+    RETURNS
+        the rows of changes that were applied
+    """
+    if skip is not None and len(skip):
+        lin  = np.ravel_multi_index((changes[:,0].astype(np.intp), changes[:,1].astype(np.intp)), data.shape)
+        skp  = np.ravel_multi_index((skip[:,0].astype(np.intp), skip[:,1].astype(np.intp)), data.shape)
+        skipped = np.zeros(data.size, dtype=bool)
+        skipped[skp] = True
+        changes = changes[~skipped[lin]]
+    i = changes[:,0].astype(np.intp)
+    j = changes[:,1].astype(np.intp)
+    data[i, j] = changes[:,2].astype(data.dtype)
+    return changes
+
+
+
+def replay(source, target, ofile, datavar="kmt", clobber=False, skip_conflicts=False, tile=60):
+    """
+    Replays the edits saved in source onto target, and writes the result to ofile in the format
+    of KMTEditor, so that the file records target as its original data and the replayed edits
+    as its changes. If target was itself saved by KMTEditor, its original data is kept and the
+    replayed edits are appended to its own changes.
+    ARGUMENTS
+        source  - a file saved by KMTEditor
+        target  - a file on the same grid
+        ofile   - name of the output file
+        skip_conflicts - if True, cells whose value in target differs from the value in the
+                         original data of source are left alone
+    RETURNS
+        a tuple (number of edits applied, conflicts), see find_conflicts. conflicts is None
+        if source does not have the original data to compare with.
+    """
+    changes, original = read_changes(source)
+    if changes is None:
+        raise ValueError("{0} has no changes table".format(source))
+    data, lons, lats = read_kmt_grid(target, datavar)
+    changes  = latest_changes(changes, data.shape)
+
+    conflicts = None
+    if original is not None:
+        if original.shape != data.shape:
+            raise ValueError("{0} and {1} are not on the same grid".format(source, target))
+        conflicts = find_conflicts(data, changes, original)
+
+    orig_data = np.copy(data)
+    applied = apply_changes(data, changes, conflicts if skip_conflicts else None)
+    target_changes, target_original = read_changes(target)
+    table = applied
+    if target_changes is not None and target_original is not None:
+        table, orig_data = np.concatenate((target_changes, applied)), target_original
+    write_kmt_file(lambda msg: None, target, ofile, clobber, True, tile, data, orig_data, table)
+    return len(applied), conflicts
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay the edits saved by KMTEditor onto another file')
+    parser.add_argument('source', nargs=1, type=str, help='file saved by KMTEditor')
+    parser.add_argument('target', nargs=1, type=str, help='file to replay the edits onto')
+    parser.add_argument('-o', nargs=1, type=str, required=True, help='name of the output file')
+    parser.add_argument('--var', nargs=1, type=str, help='name of the edited variable', default=["kmt"])
+    parser.add_argument('--clobber', action='store_true', help='overwrite the output file')
+    parser.add_argument('--skip-conflicts', action='store_true',
+                        help='do not edit cells whose value differs from the original the edits were made to')
+    args = parser.parse_args()
+
+    napplied, conflicts = replay(args.source[0], args.target[0], args.o[0], args.var[0],
+                                 clobber=args.clobber, skip_conflicts=args.skip_conflicts)
+    sys.stdout.write('applied %d edits\n' % napplied)
+    if conflicts is None:
+        sys.stdout.write('%s has no original_kmt, conflicts were not checked\n' % args.source[0])
+    elif len(conflicts):
+        sys.stdout.write('%d conflicts%s:\n' % (len(conflicts), ' (skipped)' if args.skip_conflicts else ''))
+        sys.stdout.write('%6s %6s %10s %10s %10s\n' % ('i', 'j', 'target', 'original', 'edit'))
+        for row in conflicts:
+            sys.stdout.write('%6d %6d %10g %10g %10g\n' % tuple(row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import numpy as np
+
+
+# The access patterns that the chunk planner knows about:
+#   tile2d     - 2D windows of about tile x tile cells over the last two dimensions, as
+#                read by the editors (the -s option of the editors sets the window size)
+#   timeseries - the full length of the leading (time) dimension at a few spatial points
+#   full       - the whole variable, read in order
+ACCESS_PATTERNS = ("tile2d", "timeseries", "full")
+
+CHUNK_BYTES = 1024*1024   # Target size of a chunk. HDF5 works best with chunks of roughly 1MB or less.
+
+
+
+def plan_chunks(shape, dtype, access="tile2d", tile=60, target=CHUNK_BYTES):
+    """
+    Picks a chunk shape for a variable.
+    ARGUMENTS
+        shape  - shape of the variable
+        dtype  - data type of the variable
+        access - the expected access pattern, one of ACCESS_PATTERNS
+        tile   - for 'tile2d', the size of the window in number of cells
+        target - the chunk size in bytes that is aimed for
+    RETURNS
+        a list with the chunk size along each dimension, or None for a scalar variable
+    """
+    if access not in ACCESS_PATTERNS:
+        raise ValueError("Unknown access pattern {0}. Must be one of {1}".format(access, ACCESS_PATTERNS))
+    ndim = len(shape)
+    if ndim == 0: return None
+
+    # An unlimited dimension may still be empty, but chunk sizes must be at least 1
+    shape    = [max(1, int(n)) for n in shape]
+    itemsize = np.dtype(dtype).itemsize
+    nelems   = max(1, target // itemsize)   # Number of elements in a chunk of the target size
+
+    if access == "tile2d":
+        # A tile x tile window at any offset touches at most 2 chunks along each of the last two
+        # dimensions. The leading dimensions are chunked one index at a time, since a window only
+        # ever shows one 2D slice.
+        chunks = [1]*ndim
+        side   = min(tile, int(np.sqrt(nelems)))
+        for d in range(max(0, ndim-2), ndim):
+            chunks[d] = min(shape[d], side)
+
+    elif access == "timeseries":
+        # The whole leading dimension goes into each chunk, and the remaining elements of the chunk
+        # are spread evenly over the trailing dimensions.
+        chunks = [1]*ndim
+        chunks[0] = min(shape[0], nelems)
+        if ndim > 1:
+            side = max(1, int((nelems // chunks[0]) ** (1./(ndim-1))))
+            for d in range(1, ndim):
+                chunks[d] = min(shape[d], side)
+
+    else:
+        # Contiguous runs of the variable in storage order: the trailing dimensions are taken in
+        # full for as long as they fit, and the first one that does not fit is split.
+        chunks = [1]*ndim
+        for d in range(ndim-1, -1, -1):
+            chunks[d] = max(1, min(shape[d], nelems))
+            nelems  //= chunks[d]
+            if chunks[d] < shape[d] or nelems <= 1: break
+    return chunks
+
+
+
+def plan_chunk_cache(shape, dtype, chunks, access="tile2d", tile=60, slab=None, budget=None):
+    """
+    Picks the size of the HDF5 chunk cache of a variable for the given access pattern, so that
+    all the chunks needed by one read stay in the cache.
+    ARGUMENTS
+        shape, dtype, access, tile - as for plan_chunks
+        chunks - the chunk sizes of the variable
+        slab   - for 'full', the shape of the hyperslabs in which the variable is read or written.
+                 The cache holds the chunks that one hyperslab covers, rather than a whole row of
+                 chunks across the trailing dimensions.
+        budget - if given, the cache is made no larger than these many bytes
+    RETURNS
+        a tuple (size, nelems, preemption) that can be passed to Variable.set_var_chunk_cache
+    """
+    if not chunks: return (CHUNK_BYTES, 521, 0.75)
+    shape  = [max(1, int(n)) for n in shape]
+    nchunk = [int(np.ceil(float(n)/c)) for n, c in zip(shape, chunks)]
+    chunkbytes = np.dtype(dtype).itemsize * int(np.prod(chunks))
+
+    if access == "tile2d":
+        # The chunks touched by a window at any offset, and by its neighbours one pan away
+        nslots = 1
+        for d in range(max(0, len(shape)-2), len(shape)):
+            nslots *= min(nchunk[d], 2*(tile//chunks[d] + 2))
+    elif access == "timeseries":
+        nslots = nchunk[0]
+    elif slab is not None:
+        # The chunks a hyperslab covers at any offset: n cells span up to (n+c-2)//c + 1 chunks of c
+        nslots = 1
+        for d in range(len(shape)):
+            nslots *= min(nchunk[d], (max(1, int(slab[d])) + chunks[d] - 2)//chunks[d] + 1)
+    else:
+        # One row of chunks across the trailing dimensions
+        nslots = int(np.prod(nchunk[1:])) if len(shape) > 1 else 1
+
+    size   = max(CHUNK_BYTES, nslots*chunkbytes)
+    if budget is not None: size = min(size, max(CHUNK_BYTES, int(budget)))
+    # The number of hash slots should be a lot larger than the number of chunks in the cache
+    nelems = max(521, 10*min(nslots, size//chunkbytes + 1) + 1)
+    return (size, nelems, 0.75)
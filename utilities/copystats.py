@@ -0,0 +1,88 @@
+import json, time
+
+
+class CopyStats(object):
+    """
+    Timings and byte counts of an nccopy run, kept per variable and per stage, so that one
+    can tell whether a copy is bound by reading, unpacking/quantizing, writing or syncing.
+
+    bytes_in counts the (possibly packed) values read from the input file and bytes_out the
+    values handed to the output file, both before compression. The sizes of the files
+    themselves are set by nccopy at the end, from which the compression ratio follows.
+    """
+    STAGES = ("read", "unpack", "write", "sync", "copy")
+
+    def __init__(self, filein=None, fileout=None):
+        self.filein     = filein
+        self.fileout    = fileout
+        self.variables  = {}      # varname -> dict of stage times and byte counts
+        self.order      = []      # variable names in the order they were copied
+        self.filesize_in  = 0
+        self.filesize_out = 0
+        self.t0      = time.time()
+        self.elapsed = 0.
+
+
+    def _var(self, varname):
+        if varname not in self.variables:
+            self.variables[varname] = dict([(s, 0.) for s in CopyStats.STAGES], bytes_in=0, bytes_out=0)
+            self.order.append(varname)
+        return self.variables[varname]
+
+
+    def add_time(self, varname, stage, seconds):
+        self._var(varname)[stage] += seconds
+
+
+    def add_bytes(self, varname, nin, nout):
+        v = self._var(varname)
+        v["bytes_in"]  += nin
+        v["bytes_out"] += nout
+
+
+    def finish(self, filesize_in, filesize_out):
+        """ Records the sizes of the input and output files and the total elapsed time. """
+        self.filesize_in  = filesize_in
+        self.filesize_out = filesize_out
+        self.elapsed      = time.time() - self.t0
+
+
+    def totals(self):
+        """ Returns a dict with the stage times and byte counts summed over all the variables. """
+        tot = dict([(s, 0.) for s in CopyStats.STAGES], bytes_in=0, bytes_out=0)
+        for v in self.variables.values():
+            for k in tot: tot[k] += v[k]
+        return tot
+
+
+    def as_dict(self):
+        """ Returns the statistics as a dict that can be written as JSON. """
+        return {"filein": self.filein, "fileout": self.fileout,
+                "elapsed": self.elapsed,
+                "filesize_in": self.filesize_in, "filesize_out": self.filesize_out,
+                "ratio": float(self.filesize_in)/self.filesize_out if self.filesize_out else 0.,
+                "MB_per_s": self.filesize_in/1048576./self.elapsed if self.elapsed else 0.,
+                "totals": self.totals(),
+                "variables": self.variables}
+
+
+    def dump(self, fname):
+        """ Writes the statistics to the JSON file fname. """
+        with open(fname, "w") as fh: json.dump(self.as_dict(), fh, indent=2, sort_keys=True)
+
+
+    def table(self):
+        """ Returns the statistics as a human readable table. """
+        fmt  = "{0:16s} {1:>8s} {2:>8s} {3:>8s} {4:>8s} {5:>8s} {6:>10s} {7:>10s}\n"
+        rows = [fmt.format("variable", "read s", "unpack s", "write s", "sync s", "copy s", "MB in", "MB out")]
+        def row(name, v):
+            return fmt.format(name[:16], *(["%.3f" % v[s] for s in CopyStats.STAGES] +
+                                           ["%.2f" % (v["bytes_in"]/1048576.), "%.2f" % (v["bytes_out"]/1048576.)]))
+        # The time taken by the file as a whole goes last
+        for varname in sorted(self.order, key=lambda name: name == "(file)"):
+            rows.append(row(varname, self.variables[varname]))
+        rows.append(row("TOTAL", self.totals()))
+        d = self.as_dict()
+        rows.append("{0:.2f} s, {1:.1f} MB/s, file {2:.2f} MB -> {3:.2f} MB (ratio {4:.2f})\n".format(
+                    d["elapsed"], d["MB_per_s"], self.filesize_in/1048576., self.filesize_out/1048576., d["ratio"]))
+        return "".join(rows)
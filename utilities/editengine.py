@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+"""
+editengine.py
+
+Applies scripted edits to a KMT, region mask or topography grid without the GUI, so that
+the fixes made to one grid can be re-applied to a new one. It reads and writes the files
+in the same way as the editors (see gridio), and records the edits in the same 'changes'
+table, so a file written here can be opened in the editors like any other saved file.
+It does not need PyQt or Basemap.
+
+An edit script is a JSON list of edits. Each edit selects some cells and says what to do
+with them, e.g.
+    [{"points": [[10, 20], [10, 21]], "set": 0},
+     {"rect": [100, 110, 200, 230], "set": 12, "where": "ocean"},
+     {"polygon": [[-60, 300], [-55, 300], [-55, 310]], "coords": "latlon", "average": true},
+     {"rect": [0, 50, 0, 320], "copy": {"file": "gx1v6_kmt.nc", "var": "kmt"}}]
+
+Selections (row index i, column index j, in the orientation the editors show the data,
+i.e. with the northernmost row first)
+    points  - a list of [i, j] pairs, or of [lat, lon] pairs when "coords" is "latlon", in
+              which case the nearest cell to each point is selected
+    rect    - [i0, i1, j0, j1], the cells i0 <= i < i1 and j0 <= j < j1, or, when "coords"
+              is "latlon", [lat0, lat1, lon0, lon1] with the cells whose centre lies within.
+              lon0 > lon1 selects a box that crosses the dateline.
+    polygon - a list of [i, j] or [lat, lon] vertices, the cells whose centre lies inside
+    where   - optional, "ocean" or "land" restricts the selection to cells with a non-zero
+              or a zero value (KMT and region mask only)
+Operations
+    set     - a value assigned to all the selected cells
+    copy    - {"file": ..., "var": ...}, the values of the same cells in another file
+    average - true, or {"center": true/false}, replaces each cell by the average of the cells
+              around it. For the KMT and region mask this is the rounded mean of the non-land
+              cells of the 3x3 block, as with the 'A' key of KMTEditor and RMaskEditor. For
+              topography it is the mean of the 8 neighbours, as with the 'F' key of TopoEditor,
+              or with "center": true the plain mean of all 9 cells. (TopoEditor's 'A' key counts
+              the centre twice, (sum of the 3x3 block + centre)/9, which is not offered here.)
+              All the averages of one edit are computed from the values before the edit.
+    add, scale, min, max - a value added to, multiplied with, or compared with each cell
+    clamp   - [lo, hi], limits the cells to that range. Either limit may be null.
+"""
+
+from netCDF4 import Dataset
+import numpy as np
+import sys, os, time, json, shutil, argparse
+
+from gridio import read_kmt_grid, read_topo_grid, write_kmt_file, write_rmask_file, write_topo_variable
+from changelog import read_changes, latest_changes
+from bulkops import bulk_values
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+KINDS = ("kmt", "rmask", "topo")
+
+
+
+def points_in_polygon(x, y, vx, vy):
+    """
+    Tests which points lie inside a polygon with the even-odd rule.
+    ARGUMENTS
+        x, y   - arrays with the coordinates of the points
+        vx, vy - the coordinates of the vertices of the polygon
+    RETURNS
+        a boolean array of the same shape as x
+    """
+    inside = np.zeros(np.shape(x), dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for k in range(len(vx)):
+            x1, y1, x2, y2 = vx[k], vy[k], vx[k-1], vy[k-1]
+            # The edge crosses the horizontal line through the point to the right of the point
+            crosses = (y1 > y) != (y2 > y)
+            inside ^= crosses & (x < x1 + (y - y1)*(x2 - x1)/(y2 - y1))
+    return inside
+
+
+
+def _xyz(lats, lons):
+    """ Returns the positions on the unit sphere of points given in degrees. """
+    lat = np.deg2rad(np.asarray(lats, dtype=np.float64).ravel())
+    lon = np.deg2rad(np.asarray(lons, dtype=np.float64).ravel())
+    return np.column_stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)))
+
+
+
+def _wrap(lons, ref):
+    """ Shifts longitudes by multiples of 360 so that they lie within 180 degrees of ref. """
+    return (np.asarray(lons, dtype=np.float64) - ref + 180.) % 360. - 180. + ref
+
+
+
+class EditEngine(object):
+    """
+    Holds a grid and the edits made to it, like the DataContainer of the editors but without
+    the view and the cursor. Edits are applied to whole sets of cells at once.
+    """
+
+    def __init__(self, fname, datavar="kmt", kind="kmt"):
+        """
+        ARGUMENTS
+            fname   - name of the data file
+            datavar - name of the variable to edit
+            kind    - the editor whose file format is used, one of KINDS
+        """
+        if kind not in KINDS:
+            raise ValueError("Unknown kind {0}. Must be one of {1}".format(kind, KINDS))
+        self.fname   = fname
+        self.datavar = datavar
+        self.kind    = kind
+
+        if kind == "topo":
+            data, lons, lats, self.lon_var, self.lat_var = read_topo_grid(fname, datavar)
+            self.lats, self.lons = np.meshgrid(np.ma.filled(lats), np.ma.filled(lons), indexing="ij")
+            self.data = np.ma.filled(data).astype(np.float64)
+        else:
+            self.data, lons, lats = read_kmt_grid(fname, datavar)
+            self.lons = np.ma.filled(lons).astype(np.float64)
+            self.lats = np.ma.filled(lats).astype(np.float64)
+            if kind == "rmask":
+                # As in RMaskEditor: land is masked and cannot be edited, and the ocean
+                # starts out with a default region value
+                self.data = np.ma.array(self.data, mask=(self.data == 0))
+                self.data.harden_mask()
+                self.data[:,:] = 50
+
+        self.orig_data = np.copy(self.data)
+        self.ny, self.nx = self.data.shape
+        # KMT levels and region numbers are integers, edited values are truncated like in the editors
+        self.integer = kind != "topo"
+        self.tree    = None   # KD-tree of the cell centres, built on the first lat/lon point lookup
+        self.edits   = []     # The (n, 3) i, j, val blocks of the changes table, one per edit
+
+        if kind == "kmt":
+            # Like KMTEditor, carry on from the changes recorded in a file saved by KMTEditor
+            changes, original = read_changes(fname)
+            if original is not None and original.shape == self.data.shape: self.orig_data = original
+            if changes is not None and len(changes): self.edits.append(latest_changes(changes, self.data.shape))
+
+
+    @property
+    def changes(self):
+        """ The (i, j, val) table of all the edits, in the format of the editors' changes table. """
+        if not self.edits: return np.zeros((0, 3))
+        return np.concatenate(self.edits)
+
+
+    # SELECTIONS >>>>
+    def nearestCells(self, lats, lons):
+        """ Returns the (i, j) indices of the cells whose centres are nearest to the given points. """
+        pts = _xyz(lats, lons)
+        if cKDTree is not None:
+            if self.tree is None: self.tree = cKDTree(_xyz(self.lats, self.lons))
+            idx = self.tree.query(pts)[1]
+        else:
+            # Without scipy the points are matched against all the cells, a block at a time
+            cells = _xyz(self.lats, self.lons)
+            idx   = np.concatenate([np.argmax(np.dot(cells, pts[k:k+64].T), axis=0)
+                                    for k in range(0, len(pts), 64)]) if len(pts) else np.zeros(0, dtype=int)
+        return np.unravel_index(idx, (self.ny, self.nx))
+
+
+    def select(self, edit):
+        """
+        Returns the (i, j) index arrays of the cells selected by an edit (see the module docstring).
+        """
+        latlon = edit.get("coords", "ij") == "latlon"
+        if "points" in edit:
+            pts = np.asarray(edit["points"], dtype=np.float64).reshape(-1, 2)
+            if latlon:
+                i, j = self.nearestCells(pts[:,0], pts[:,1])
+            else:
+                i, j = pts[:,0].astype(np.intp), pts[:,1].astype(np.intp)
+                if np.any((i < 0) | (i >= self.ny) | (j < 0) | (j >= self.nx)):
+                    raise ValueError("Points outside of the {0}x{1} grid".format(self.ny, self.nx))
+
+        elif "rect" in edit:
+            a0, a1, b0, b1 = edit["rect"]
+            if latlon:
+                inlat = (self.lats >= min(a0, a1)) & (self.lats <= max(a0, a1))
+                lons  = self.lons % 360.
+                b0, b1 = b0 % 360., b1 % 360.
+                inlon = ((lons >= b0) & (lons <= b1)) if b0 <= b1 else ((lons >= b0) | (lons <= b1))
+                i, j  = np.nonzero(inlat & inlon)
+            else:
+                i, j = np.mgrid[max(0, int(a0)):min(self.ny, int(a1)), max(0, int(b0)):min(self.nx, int(b1))]
+
+        elif "polygon" in edit:
+            verts = np.asarray(edit["polygon"], dtype=np.float64).reshape(-1, 2)
+            if latlon:
+                # Longitudes are compared within 180 degrees of the first vertex so that
+                # polygons that cross the dateline work
+                vlon = _wrap(verts[:,1], verts[0,1])
+                inlat = (self.lats >= verts[:,0].min()) & (self.lats <= verts[:,0].max())
+                lons  = _wrap(self.lons, verts[0,1])
+                cand  = np.nonzero(inlat & (lons >= vlon.min()) & (lons <= vlon.max()))
+                hit   = points_in_polygon(lons[cand], self.lats[cand], vlon, verts[:,0])
+            else:
+                # Only the cells within the bounding box of the polygon are tested
+                i0, j0 = np.maximum(0, np.floor(verts.min(axis=0)).astype(int))
+                i1, j1 = np.ceil(verts.max(axis=0)).astype(int) + 1
+                cand = np.mgrid[i0:min(self.ny, i1), j0:min(self.nx, j1)]
+                cand = (cand[0].ravel(), cand[1].ravel())
+                hit  = points_in_polygon(cand[1], cand[0], verts[:,1], verts[:,0])
+            i, j = cand[0][hit], cand[1][hit]
+
+        else:
+            raise ValueError("The edit {0} has no points, rect or polygon".format(edit))
+
+        i, j = np.ravel(i), np.ravel(j)
+        where = edit.get("where")
+        if where is not None:
+            if where not in ("ocean", "land"):
+                raise ValueError("'where' must be 'ocean' or 'land', not {0}".format(where))
+            land = np.ma.filled(self.orig_data, 0)[i, j] == 0
+            keep = ~land if where == "ocean" else land
+            i, j = i[keep], j[keep]
+        return i, j
+    # <<<< SELECTIONS
+
+
+    # OPERATIONS >>>>
+    def setValues(self, i, j, vals):
+        """
+        Assigns values to a set of cells with a single scatter and records them in the changes table.
+        ARGUMENTS
+            i, j - arrays with the row and column indices of the cells
+            vals - an array with a value for each cell, or a single value for all of them
+        RETURNS
+            the number of cells edited
+        """
+        i = np.asarray(i, dtype=np.intp).ravel()
+        j = np.asarray(j, dtype=np.intp).ravel()
+        v = np.empty(i.size, dtype=np.float64)
+        v[:] = vals
+        if self.integer: v = np.trunc(v)
+        if self.kind == "rmask":
+            # Land cells are masked and keep their value
+            keep = ~np.ma.getmaskarray(self.data)[i, j]
+            i, j, v = i[keep], j[keep], v[keep]
+        if i.size == 0: return 0
+        self.data[i, j] = v.astype(self.data.dtype)
+        self.edits.append(np.column_stack((i, j, v)))
+        return i.size
+
+
+    def getAverages(self, i, j, center=None):
+        """
+        Returns the average of the cells around each of a set of cells: for the KMT and region mask
+        the mean of the non-land cells of the 3x3 block around the cell (including the cell),
+        rounded to the nearest integer, as the 'A' key of KMTEditor and RMaskEditor. For topography
+        it is the mean of the 8 neighbours by default, as the 'F' key of TopoEditor, or the plain
+        mean of all 9 cells if center is True (not the 'A' key of TopoEditor, which counts the
+        centre twice). Neighbours outside the grid are left out. A cell without any neighbours to
+        average keeps its value.
+        """
+        if center is None: center = self.kind != "topo"
+        vals = np.ma.filled(self.data, 0).astype(np.float64)
+        if self.kind == "topo":
+            valid = np.ones(vals.shape, dtype=bool)
+        else:
+            valid = (vals != 0) & ~np.ma.getmaskarray(self.data)
+
+        total = np.zeros(i.size)
+        count = np.zeros(i.size)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                if di == 0 and dj == 0 and not center: continue
+                ii, jj = i + di, j + dj
+                inside = (ii >= 0) & (ii < self.ny) & (jj >= 0) & (jj < self.nx)
+                ii, jj = np.clip(ii, 0, self.ny-1), np.clip(jj, 0, self.nx-1)
+                use    = inside & valid[ii, jj]
+                total += np.where(use, vals[ii, jj], 0.)
+                count += use
+        avg = np.where(count > 0, total/np.maximum(count, 1), vals[i, j])
+        return np.round(avg) if self.integer else avg
+
+
+    def readValues(self, fname, datavar, i, j):
+        """ Returns the values of a set of cells of a variable in another file on the same grid. """
+        if self.kind == "topo":
+            other = read_topo_grid(fname, datavar)[0]
+        else:
+            other = read_kmt_grid(fname, datavar)[0]
+        if other.shape != self.data.shape:
+            raise ValueError("{0} in {1} has shape {2}, expected {3}".format(datavar, fname, other.shape, self.data.shape))
+        return np.ma.filled(other, 0)[i, j]
+
+
+    def apply(self, edit):
+        """
+        Applies one edit (a dict, see the module docstring).
+        RETURNS
+            the number of cells edited
+        """
+        i, j = self.select(edit)
+        if "set" in edit:
+            vals = edit["set"]
+        elif "copy" in edit:
+            vals = self.readValues(edit["copy"]["file"], edit["copy"].get("var", self.datavar), i, j)
+        elif "average" in edit:
+            opts = edit["average"] if isinstance(edit["average"], dict) else {}
+            vals = self.getAverages(i, j, opts.get("center"))
+        elif "clamp" in edit:
+            vals = bulk_values(np.ma.filled(self.data, 0)[i, j], "clamp", lo=edit["clamp"][0], hi=edit["clamp"][1])
+        else:
+            ops = [op for op in ("add", "scale", "min", "max") if op in edit]
+            if not ops:
+                raise ValueError("The edit {0} has no set, copy, average, add, scale, clamp, min or max operation".format(edit))
+            vals = bulk_values(np.ma.filled(self.data, 0)[i, j], ops[0], edit[ops[0]])
+        return self.setValues(i, j, vals)
+
+
+    def applyScript(self, script):
+        """
+        Applies the edits of a script, in order.
+        ARGUMENTS
+            script - a list of edits, or the name of a JSON file holding one
+        RETURNS
+            a tuple (number of edits, number of cells edited)
+        """
+        if not isinstance(script, list):
+            with open(script) as fh: script = json.load(fh)
+        ncells = 0
+        for edit in script:
+            ncells += self.apply(edit)
+        return len(script), ncells
+    # <<<< OPERATIONS
+
+
+    def save(self, ofile, clobber=False, tile=60, save_var=None, quiet=True):
+        """
+        Writes the edited grid in the same format as the corresponding editor.
+        ARGUMENTS
+            ofile    - name of the output file
+            clobber  - whether an existing output file may be overwritten
+            tile     - the output is chunked for editor windows of this size
+            save_var - topography only, the variable the data is saved to (default: the edited variable)
+            quiet    - if False, the progress is printed
+        RETURNS
+            the message of the writer
+        """
+        progress = (lambda msg: None) if quiet else (lambda msg: sys.stdout.write(msg + "\n"))
+        if self.kind == "kmt":
+            return write_kmt_file(progress, self.fname, ofile, clobber, True, tile,
+                                  self.data, self.orig_data, self.changes)
+
+        if os.path.exists(ofile) and not clobber and os.path.abspath(ofile) != os.path.abspath(self.fname):
+            raise IOError("{0} exists and clobber=False".format(ofile))
+        if self.kind == "rmask":
+            return write_rmask_file(progress, self.fname, ofile, tile, self.data)
+
+        # TopoEditor saves into a variable of the file it edits, so the output starts as a copy of the input
+        if os.path.abspath(ofile) != os.path.abspath(self.fname): shutil.copyfile(self.fname, ofile)
+        return write_topo_variable(progress, ofile, save_var or self.datavar, self.lat_var, self.lon_var,
+                                   tile, self.data)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply an edit script to a KMT, region mask or topography file')
+    parser.add_argument('fname', nargs=1, type=str, help='name of the netcdf data file')
+    parser.add_argument('script', nargs=1, type=str, help='JSON file with the edits')
+    parser.add_argument('-o', nargs=1, type=str, required=True, help='name of the output file')
+    parser.add_argument('--kind', nargs=1, type=str, choices=KINDS, help='format of the file', default=["kmt"])
+    parser.add_argument('--var', nargs=1, type=str, help='name of the variable to edit', default=["kmt"])
+    parser.add_argument('--save-var', nargs=1, type=str, help='topography: variable to save to', default=[None])
+    parser.add_argument('--clobber', action='store_true', help='overwrite the output file')
+    parser.add_argument('-s', nargs=1, type=int, help='editor view size the output is chunked for', default=[60])
+    args = parser.parse_args()
+
+    engine = EditEngine(args.fname[0], args.var[0], args.kind[0])
+    t0 = time.time()
+    nedits, ncells = engine.applyScript(args.script[0])
+    sys.stdout.write('applied %d edits to %d cells in %.3f s\n' % (nedits, ncells, time.time()-t0))
+    sys.stdout.write(engine.save(args.o[0], clobber=args.clobber, tile=args.s[0], save_var=args.save_var[0]) + '\n')
+
+
+if __name__ == "__main__":
+    main()
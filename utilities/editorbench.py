@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+"""
+editorbench.py
+
+A benchmark of KMTEditor, RMaskEditor and TopoEditor that runs without anyone at the keyboard.
+Each editor is opened on synthetic grids of realistic sizes (see synthgrids.py) and driven with
+a scripted session of key presses: pans, a sweep of the cursor across the view, edits, lassos
+(RMaskEditor and TopoEditor) and saves. For every editor and grid it reports
+
+    - the time to the first frame, from creating the editor (which reads the file) until its
+      window has been drawn
+    - the median, 95th percentile and maximum latency of each kind of interaction, from the
+      editor's own LatencyRecorder (see latency.py), and the time until each save is written
+    - the peak resident memory of the process
+
+Every case runs in a process of its own, so that the peak memory is that of a single editor.
+PyQt4 needs an X server: if DISPLAY is not set, a virtual one is started with Xvfb.
+
+    python editorbench.py --output today.json
+    python editorbench.py --baseline today.json --threshold 1.25
+
+The report of one run is the baseline of a later one. With --baseline, the cases are compared
+metric by metric and the exit status is 1 if any of them got slower (or bigger) by more than
+the threshold ratio. --large adds the tx0.1v2 and 1-arc-minute grids, which take a while, and
+over a GB of memory.
+"""
+
+from collections import OrderedDict
+import numpy as np
+import sys, os, json, time, shutil, tempfile, argparse, platform, subprocess, resource
+
+from latency import clock
+import synthgrids
+
+
+EDITORS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "editors")
+
+# For each editor: the variable it edits, the grids it opens, the value its edits set, and the
+# key that acts on a lasso selection (None for an editor without a lasso)
+EDITORS = OrderedDict([
+    ("KMTEditor",   {"datavar": "kmt",  "grids": "pop",  "value": "20",     "lasso": None}),
+    ("RMaskEditor", {"datavar": "kmt",  "grids": "pop",  "value": "3",      "lasso": "Return"}),
+    ("TopoEditor",  {"datavar": "topo", "grids": "topo", "value": "-250.0", "lasso": "G"}),
+])
+GRIDS       = {"pop": ["gx3v7", "gx1v6"], "topo": ["1deg", "0.25deg"]}
+LARGE_GRIDS = {"pop": ["tx0.1v2"], "topo": ["1min"]}
+
+# The scripted session, as (action, argument) steps. Keys are named as in Qt.Key_<name>.
+SCRIPT = [("keys",  ["L"]*8 + ["J"]*8 + ["H"]*8 + ["K"]*8),                         # pans
+          ("keys",  ["Right"]*40 + ["Down"]*40 + ["Left"]*40 + ["Up"]*40),           # cursor sweep
+          ("edits", 20),                                                             # Right, then V
+          ("lasso", 3),
+          ("save",  1),
+          ("edits", 10),
+          ("save",  1)]
+
+# Answers to the dialogs the script runs into, by a part of their label. Any other dialog is
+# answered with its default.
+ANSWERS = {"region value": "3", "output file": "{workdir}/output.nc", "variable name": "topo_bench"}
+
+# Latencies below this many ms are not compared with the baseline, as they are mostly noise
+MIN_MS = 2.0
+
+
+
+def _which(program):
+    for d in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(d, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK): return path
+    return None
+
+
+
+def ensure_display():
+    """
+    Makes sure there is an X display for PyQt4, which (unlike Qt5) has no offscreen platform.
+    RETURNS
+        the Xvfb process that was started, or None if DISPLAY was already set
+    RAISES
+        RuntimeError if there is no display and Xvfb cannot be found
+    """
+    if os.environ.get("DISPLAY"): return None
+    xvfb = _which("Xvfb")
+    if xvfb is None:
+        raise RuntimeError("PyQt4 needs an X display. Set DISPLAY, install Xvfb or run under xvfb-run.")
+    for n in range(99, 199):
+        if os.path.exists("/tmp/.X11-unix/X{0}".format(n)) or os.path.exists("/tmp/.X{0}-lock".format(n)): continue
+        proc = subprocess.Popen([xvfb, ":{0}".format(n), "-screen", "0", "1600x1200x24", "-nolisten", "tcp"],
+                                stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        for _ in range(50):
+            if os.path.exists("/tmp/.X11-unix/X{0}".format(n)): break
+            if proc.poll() is not None: break
+            time.sleep(0.1)
+        if proc.poll() is None:
+            os.environ["DISPLAY"] = ":{0}".format(n)
+            return proc
+    raise RuntimeError("Could not start Xvfb")
+
+
+
+def peak_rss_mb():
+    """ Returns the peak resident memory of this process in MB. """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1048576. if sys.platform == "darwin" else rss/1024.   # bytes on macOS, kB elsewhere
+
+
+
+def scripted_dialogs(qtgui, answers, messages):
+    """
+    Returns stand-ins for QInputDialog and QMessageBox that answer without showing anything:
+    getText from answers (a dict of label part -> text), the other input dialogs with their
+    defaults, and every question with Yes. The messages shown are appended to messages.
+    """
+    class ScriptedInputDialog(qtgui.QInputDialog):
+        @staticmethod
+        def getText(parent, title, label, *args, **kwargs):
+            for part, text in answers.items():
+                if part in str(label): return text, True
+            messages.append("Unanswered dialog: {0}".format(label))
+            return "", False
+
+        @staticmethod
+        def getItem(parent, title, label, items, current=0, *args, **kwargs):
+            return list(items)[current], True
+
+        @staticmethod
+        def getInt(parent, title, label, value=0, *args, **kwargs):
+            return value, True
+
+        @staticmethod
+        def getDouble(parent, title, label, value=0.0, *args, **kwargs):
+            return value, True
+
+    class ScriptedMessageBox(qtgui.QMessageBox):
+        @staticmethod
+        def question(*args, **kwargs):
+            return qtgui.QMessageBox.Yes
+
+        @staticmethod
+        def _shown(parent, title, text, *args, **kwargs):
+            messages.append("{0}: {1}".format(title, text))
+            return qtgui.QMessageBox.Ok
+
+        about = information = warning = critical = _shown
+
+    return ScriptedInputDialog, ScriptedMessageBox
+
+
+
+def run_case(editor, fname, size=60, settle=0.3):
+    """
+    Runs the scripted session in one editor, in this process.
+    ARGUMENTS
+        editor - one of EDITORS
+        fname  - the input file. The editor works on a copy of it in a temporary directory.
+        size   - the size of the view in cells
+        settle - seconds for which events are processed after each step, so that timers (e.g. the
+                 prefetching) fire as they would between the key presses of a user. Not timed.
+    RETURNS
+        a dict of the results
+    """
+    from PyQt4.QtCore import Qt, QEvent
+    from PyQt4.QtGui import QApplication, QKeyEvent
+    import PyQt4.QtGui as qtgui
+
+    spec    = EDITORS[editor]
+    workdir = tempfile.mkdtemp(prefix="editorbench")
+    result  = OrderedDict([("editor", editor), ("file", os.path.basename(fname)), ("size", size)])
+    try:
+        # The copy has a name without dots, which the editors use to make the output file names
+        work = os.path.join(workdir, "input.nc")
+        shutil.copyfile(fname, work)
+        app = QApplication.instance() or QApplication([])
+
+        t0 = clock()
+        sys.path.insert(0, EDITORS_DIR)
+        module = __import__(editor)
+        result["import_s"] = clock() - t0
+
+        messages = []
+        answers  = dict((k, v.format(workdir=workdir)) for k, v in ANSWERS.items())
+        module.QInputDialog, module.QMessageBox = scripted_dialogs(qtgui, answers, messages)
+
+        t0 = clock()
+        mw = getattr(module, editor)(work, spec["datavar"], dwx=size, dwy=size)
+        mw.show()
+        app.processEvents()
+        result["first_frame_s"] = clock() - t0
+        result["first_frame_rss_mb"] = peak_rss_mb()
+        mw.latency.enabled = True
+        if hasattr(mw, "ofile"): mw.ofile = os.path.join(workdir, "output.nc")
+
+        def wait(seconds):
+            t = clock()
+            while clock() - t < seconds: app.processEvents()
+
+        def press(name):
+            mw.keyPressEvent(QKeyEvent(QEvent.KeyPress, getattr(Qt, "Key_" + name), Qt.NoModifier))
+            app.processEvents()
+
+        writes = []
+        for action, arg in SCRIPT:
+            if action == "keys":
+                for name in arg: press(name)
+            elif action == "edits":
+                for n in range(arg):
+                    press("Right")
+                    mw.buffer_value = spec["value"]
+                    press("V")
+            elif action == "lasso" and spec["lasso"]:
+                for n in range(arg):
+                    # A polygon around the middle of the view, as the lasso tool would hand over
+                    c, r = size/2. + n, size/4.
+                    phi  = np.linspace(0, 2*np.pi, 24, endpoint=False)
+                    verts = list(zip(c + r*np.cos(phi), c + r*np.sin(phi)))
+                    mw.lman.lasso = None
+                    mw.lman.callback(verts)
+                    app.processEvents()
+                    press(spec["lasso"])
+                    press("X")
+            elif action == "save":
+                for n in range(arg):
+                    t = clock()
+                    mw.save_data()
+                    mw.saver.wait()
+                    app.processEvents()
+                    writes.append(1000.*(clock() - t))
+            wait(settle)
+
+        result["interactions"] = mw.latency.summary()
+        result["save_written_ms"] = writes
+        result["messages"] = messages
+        mw.unsaved_changes_exist = False
+        mw.close()
+        app.processEvents()
+        result["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+
+def run_cases(cases, size=60, timeout=3600, out=sys.stdout):
+    """
+    Runs each (editor, grid, fname) case in a process of its own.
+    RETURNS
+        an OrderedDict of the results of each case, by 'editor/grid'. A case that failed has an
+        'error' instead.
+    """
+    results = OrderedDict()
+    for editor, grid, fname in cases:
+        key = "{0}/{1}".format(editor, grid)
+        out.write("Running {0}\n".format(key))
+        out.flush()
+        fd, tmp = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        cmd = [sys.executable, os.path.abspath(__file__), "--case", editor, fname, tmp, "-s", str(size)]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        t0 = time.time()
+        while proc.poll() is None and time.time() - t0 < timeout: time.sleep(0.2)
+        if proc.poll() is None:
+            proc.kill()
+            results[key] = {"error": "Timed out after {0} s".format(timeout)}
+        else:
+            log = proc.communicate()[0].decode("utf-8", "replace")
+            try:
+                with open(tmp) as fh: results[key] = json.load(fh, object_pairs_hook=OrderedDict)
+            except ValueError:
+                results[key] = {"error": log.strip()[-2000:] or "Exited with {0}".format(proc.returncode)}
+        os.remove(tmp)
+    return results
+
+
+
+def metrics(result):
+    """ Flattens the result of a case into an OrderedDict of metric name -> value, for comparisons. """
+    m = OrderedDict()
+    if "error" in result: return m
+    m["first_frame_s"] = result["first_frame_s"]
+    m["peak_rss_mb"]   = result["peak_rss_mb"]
+    for kind, s in result["interactions"].items():
+        m[kind + " p50 ms"] = s["p50"]
+        m[kind + " p95 ms"] = s["p95"]
+    if result["save_written_ms"]: m["save written ms"] = max(result["save_written_ms"])
+    return m
+
+
+
+def compare(report, baseline, threshold=1.25):
+    """
+    Compares the cases of a report with those of a baseline report.
+    ARGUMENTS
+        threshold - the ratio (new/old) above which a metric is a regression
+    RETURNS
+        a list of (case, metric, old, new, ratio, regressed) tuples, for the metrics in both
+    """
+    rows = []
+    for key, result in report["cases"].items():
+        old = metrics(baseline["cases"].get(key, {"error": None}))
+        for name, new in metrics(result).items():
+            if name not in old or not old[name] > 0 or np.isnan(new): continue
+            ratio = new/old[name]
+            noise = name.endswith("ms") and max(new, old[name]) < MIN_MS
+            rows.append((key, name, old[name], new, ratio, ratio > threshold and not noise))
+    return rows
+
+
+
+def print_report(report, out=sys.stdout):
+    """ Prints the results of each case as a table. """
+    fmt = "{0:24s} {1:>14s} {2:>6s} {3:>9s} {4:>9s} {5:>9s}\n"
+    for key, result in report["cases"].items():
+        if "error" in result:
+            out.write("{0}: FAILED\n{1}\n\n".format(key, result["error"]))
+            continue
+        out.write("{0}: first frame {1:.2f} s, peak RSS {2:.0f} MB\n".format(key, result["first_frame_s"], result["peak_rss_mb"]))
+        out.write(fmt.format("", "interaction", "n", "p50 ms", "p95 ms", "max ms"))
+        for kind, s in result["interactions"].items():
+            out.write(fmt.format("", kind, str(s["count"]), "%.1f" % s["p50"], "%.1f" % s["p95"], "%.1f" % s["max"]))
+        if result["save_written_ms"]:
+            out.write(fmt.format("", "save written", str(len(result["save_written_ms"])),
+                                 "%.1f" % np.median(result["save_written_ms"]), "", "%.1f" % max(result["save_written_ms"])))
+        for msg in result["messages"]: out.write("  ! {0}\n".format(msg))
+        out.write("\n")
+
+
+
+def print_comparison(rows, threshold, out=sys.stdout):
+    """ Prints the comparison with the baseline. Regressions are marked with a '!'. """
+    fmt = "{0:1s} {1:24s} {2:20s} {3:>10s} {4:>10s} {5:>7s}\n"
+    out.write(fmt.format("", "case", "metric", "baseline", "now", "ratio"))
+    for key, name, old, new, ratio, regressed in rows:
+        out.write(fmt.format("!" if regressed else "", key, name, "%.2f" % old, "%.2f" % new, "%.2f" % ratio))
+    out.write("{0} of {1} metrics regressed by more than {2:.0%}\n".format(
+              sum(r[-1] for r in rows), len(rows), threshold - 1))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the editors on synthetic grids')
+    parser.add_argument('--dir', nargs=1, type=str, help='directory of the synthetic grids, which are written if missing',
+                        default=[os.path.join(tempfile.gettempdir(), "cesmgui-benchgrids")])
+    parser.add_argument('--editors', nargs='+', choices=list(EDITORS), help='editors to benchmark', default=list(EDITORS))
+    parser.add_argument('--large', action='store_true', help='also benchmark the tx0.1v2 and 1min grids')
+    parser.add_argument('-s', nargs=1, type=int, help='size of the view in number of pixels', default=[60])
+    parser.add_argument('--output', nargs=1, type=str, help='write the report to this JSON file')
+    parser.add_argument('--baseline', nargs=1, type=str, help='compare with the report in this JSON file')
+    parser.add_argument('--threshold', nargs=1, type=float, help='ratio to the baseline above which a metric has regressed', default=[1.25])
+    parser.add_argument('--timeout', nargs=1, type=float, help='time limit of each case in seconds', default=[3600])
+    parser.add_argument('--case', nargs=3, type=str, help=argparse.SUPPRESS)   # editor fname output, run by the benchmark itself
+    args = parser.parse_args()
+
+    if args.case:
+        editor, fname, output = args.case
+        result = run_case(editor, fname, args.s[0])
+        with open(output, "w") as fh: json.dump(result, fh, indent=1)
+        return
+
+    grids = dict((k, list(v) + (LARGE_GRIDS[k] if args.large else [])) for k, v in GRIDS.items())
+    files = synthgrids.generate(args.dir[0], grids["pop"], grids["topo"], quiet=False)
+    cases = [(editor, grid, files[grid]) for editor in args.editors for grid in grids[EDITORS[editor]["grids"]]]
+
+    xvfb = ensure_display()
+    try:
+        results = run_cases(cases, args.s[0], args.timeout[0])
+    finally:
+        if xvfb is not None: xvfb.terminate()
+
+    report = OrderedDict([("date", time.strftime("%Y-%m-%d %H:%M:%S")), ("host", platform.node()),
+                          ("python", platform.python_version()), ("size", args.s[0]), ("cases", results)])
+    print_report(report)
+    if args.output:
+        with open(args.output[0], "w") as fh: json.dump(report, fh, indent=1)
+
+    failed = any("error" in r for r in results.values())
+    if args.baseline:
+        with open(args.baseline[0]) as fh: baseline = json.load(fh)
+        rows = compare(report, baseline, args.threshold[0])
+        print_comparison(rows, args.threshold[0])
+        failed = failed or any(r[-1] for r in rows)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Reading and writing of the 2D grids edited by the editors. Nothing in here depends on
+PyQt or Basemap, so that the same readers and writers can be used by the editors, which
+call the writers from their background save thread, and by the command line tools.
+"""
+
+from netCDF4 import Dataset
+import numpy as np
+import time
+
+from nccopy import nccopy
+from chunking import plan_chunks
+
+
+LON_NAMES = ["longitudes", "longitude", "lons"]
+LAT_NAMES = ["latitudes", "latitude", "lats"]
+
+
+
+def read_kmt_grid(fname, datavar):
+    """
+    Reads a variable on the POP grid (such as the KMT) together with the ULON and ULAT
+    coordinates. The arrays are flipped so that the latitudes go from 90:-90, which is the
+    orientation the editors work in, and in which the (i, j) indices of the 'changes' table
+    are recorded.
+    RETURNS
+        a tuple (data, lons, lats) of 2D arrays
+    """
+    ncfile = Dataset(fname, "r", format="NETCDF4")
+    data   = np.flipud(ncfile.variables[datavar][:,:])
+    lons   = np.flipud(ncfile.variables["ULON"][:,:])
+    lats   = np.flipud(ncfile.variables["ULAT"][:,:])
+    ncfile.close()
+    return data, lons, lats
+
+
+
+def read_cell_area(fname, names=("TAREA",), flip=True):
+    """
+    Reads the area of the grid cells from the first of the given variables found in a file.
+    ARGUMENTS
+        names - the names of the area variables to look for, in order of preference
+        flip  - if True, the array is flipped as in read_kmt_grid
+    RETURNS
+        a tuple (area, name) with the 2D area in m^2 (POP stores it in cm^2) and the name of the
+        variable it was read from, or (None, None) if the file has none of them
+    """
+    ncfile = Dataset(fname, "r", format="NETCDF4")
+    for name in names:
+        if name in ncfile.variables:
+            var   = ncfile.variables[name]
+            area  = np.ma.filled(var[:,:], 0).astype(np.float64)
+            units = getattr(var, "units", "cm^2" if name in ("TAREA", "UAREA") else "m^2")
+            ncfile.close()
+            if units.strip().startswith("cm"): area *= 1e-4
+            return (np.flipud(area) if flip else area), name
+    ncfile.close()
+    return None, None
+
+
+
+def read_topo_grid(fname, datavar):
+    """
+    Reads a variable on a regular latitude-longitude grid. It looks for common names of the
+    latitude and longitude variables in the file.
+    RETURNS
+        a tuple (data, lons, lats, lon_var, lat_var) where lons and lats are 1D arrays and
+        lon_var and lat_var are the names of the longitude and latitude dimensions
+    RAISES
+        ValueError if the latitude or longitude variable is not found
+    """
+    lons = lats = lon_var = lat_var = None
+    ncfile = Dataset(fname, "r", format="NETCDF4")
+    for var in LON_NAMES:
+        if var in ncfile.variables:
+            lons    = ncfile.variables[var][:]
+            lon_var = ncfile.variables[var].dimensions[0]
+
+    for var in LAT_NAMES:
+        if var in ncfile.variables:
+            lats    = ncfile.variables[var][:]
+            lat_var = ncfile.variables[var].dimensions[0]
+
+    if (lats is None) or (lons is None):
+        ncfile.close()
+        raise ValueError("Latitude and or longitude variables not found.")
+
+    data = ncfile.variables[datavar][:,:]
+    ncfile.close()
+    return data, lons, lats, lon_var, lat_var
+
+
+
+def write_kmt_file(progress, fname, ofile, clobber, copy_input, tile, data, orig_data, changes):
+    """
+    Writes a snapshot of the KMT data to the output file. This runs in the background
+    save thread and therefore must not touch any widgets.
+    ARGUMENTS
+        progress   - a function that accepts a status message
+        fname      - name of the input file
+        ofile      - name of the output file
+        clobber    - whether an existing output file may be overwritten
+        copy_input - if True, the input file is first duplicated to the output file
+        tile       - size of the editor's view, the output is chunked for windows of this size
+        data, orig_data, changes - the snapshot returned by DataContainer.snapshot
+    RETURNS
+        a message for the status bar
+    """
+    if copy_input:
+        # To simplify creation of the output filename, i first duplicate the original file, then overwrite
+        # the kmt array.
+        progress("Saving: copying {0}".format(fname))
+        nccopy(fname, ofile, quiet=True, clobber=clobber, zlib=False, shuffle=False, classic=1,
+               chunking="tile2d", tile=tile,
+               progress=lambda varname, done, total: progress("Saving: copying {0} ({1}%)".format(fname, 100*done//max(total, 1))))
+
+    progress("Saving: writing KMT to {0}".format(ofile))
+    ncfile = Dataset(ofile, "a", format="NETCDF4")
+    alldimensions = ncfile.dimensions
+    allvariables  = ncfile.variables
+    if not "changes" in alldimensions: ncfile.createDimension("changes", None)
+    if not "i" in alldimensions: ncfile.createDimension("i", 3)
+
+
+    if not "original_kmt" in allvariables:
+        okmt   = ncfile.createVariable("original_kmt", "f4", ("latitude", "longitude"),
+                                       chunksizes=plan_chunks(orig_data.shape, "f4", "tile2d", tile))
+        okmt.description   = "Original KMT data from which this file was created by KMTEditor.py"
+        okmt[:,:]          = np.flipud(orig_data)
+
+    if not "changes" in allvariables:
+        cngvar = ncfile.createVariable("changes", "f8", ("changes", "i"))
+        cngvar.description = "changes to original data leading to present data. (i,j,val)"
+    else:
+        cngvar = allvariables["changes"]
+    if len(changes): cngvar[:len(changes),:] = changes
+    # An unlimited dimension cannot shrink, so the rows left over from a longer table (e.g. the
+    # table of the input before it was compacted) are blanked. read_changes skips blank rows.
+    if len(cngvar) > len(changes): cngvar[len(changes):,:] = np.ma.masked
+
+
+    kmtvar             = ncfile.variables["kmt"]
+    kmtvar[:,:]        = np.flipud(data)
+    kmtvar.description = "Created by KMTEditor.py"
+
+    ncfile.history     = "Created by KMTEditor.py"
+    ncfile.input_file  = fname
+    ncfile.created     = time.ctime()
+    progress("Saving: flushing {0}".format(ofile))
+    ncfile.close()
+    return 'Saved to file: %s' % ofile
+
+
+
+def write_rmask_file(progress, fname, ofile, tile, data):
+    """
+    Writes a snapshot of the region mask to the output file. This runs in the background
+    save thread and therefore must not touch any widgets.
+    ARGUMENTS
+        progress - a function that accepts a status message
+        fname    - name of the input file
+        ofile    - name of the output file
+        tile     - size of the editor's view, the output is chunked for windows of this size
+        data     - the snapshot of the data returned by DataContainer.snapshot
+    RETURNS
+        a message for the status bar
+    """
+    # To simplify creation of the output filename, i first duplicate the original file, then overwrite
+    # the kmt array.
+    progress("Saving: copying {0}".format(fname))
+    nccopy(fname, ofile, quiet=True, clobber=True, zlib=False, shuffle=False, classic=1,
+           chunking="tile2d", tile=tile,
+           progress=lambda varname, done, total: progress("Saving: copying {0} ({1}%)".format(fname, 100*done//max(total, 1))))
+
+    progress("Saving: writing region mask to {0}".format(ofile))
+    ncfile = Dataset(ofile, "a", format="NETCDF4")
+    ncfile.variables["kmt"][:,:] = np.flipud(data)
+    progress("Saving: flushing {0}".format(ofile))
+    ncfile.close()
+    return 'Saved to file: %s' % ofile
+
+
+
+def write_topo_variable(progress, fname, save_var, lat_var, lon_var, tile, data):
+    """
+    Writes a snapshot of the data to a variable in the input file. This runs in the
+    background save thread and therefore must not touch any widgets.
+    ARGUMENTS
+        progress - a function that accepts a status message
+        fname    - name of the netCDF4 file
+        save_var - name of the variable to save the data to
+        lat_var, lon_var - names of the latitude and longitude dimensions
+        tile     - size of the editor's view, a new variable is chunked for windows of this size
+        data     - the snapshot of the data returned by DataContainer.snapshot
+    RETURNS
+        a message for the status bar
+    """
+    progress("Saving: writing variable {0}".format(save_var))
+    ncfile = Dataset(fname, "a", format="NETCDF4")
+    if not save_var in ncfile.variables.keys():
+        dvar = ncfile.createVariable(save_var, 'f4', (lat_var, lon_var), zlib=True,
+                                     chunksizes=plan_chunks(data.shape, 'f4', "tile2d", tile))
+        dvar.units = "km"
+    else:
+        dvar = ncfile.variables[save_var]
+    dvar[:,:] = data
+    progress("Saving: flushing {0}".format(fname))
+    ncfile.close()
+    return 'Saved to variable: %s' % save_var
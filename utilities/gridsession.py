@@ -0,0 +1,214 @@
+"""
+A grid session shared by the editors that are open on the same POP grid file, e.g. KMTEditor
+editing the KMT while RMaskEditor edits the region mask of the same grid.
+
+The first editor to attach reads the file once into a session directory: the (flipped) KMT, the
+original KMT, ULAT and ULON, each as a .npy file. Every editor that attaches maps these files
+into memory (np.load with mmap_mode), so the processes share a single copy of the arrays. The
+KMT is mapped read-write. An edit made by one editor is therefore in the arrays of all the others
+at once, and is also appended to a change log in the session directory. The editors poll the
+log (from a QTimer) to update whatever they derive from the KMT, such as the land mask of the
+region mask, without reading the file again.
+
+The session directory is removed when the last editor detaches. A session left behind by editors
+that did not detach (e.g. after a crash) is discarded by the next editor that attaches, as its
+unsaved edits are recovered from the journal of the editor instead (see journal.py). Attaching
+and detaching hold a lock file next to the session directory (flock), so that an editor never
+removes a session that another editor has just started or joined.
+
+Nothing in here depends on Qt.
+"""
+
+import os, struct, zlib, shutil, hashlib, tempfile, fcntl
+import numpy as np
+
+from gridio import read_kmt_grid
+
+
+
+def session_path(fname, datavar):
+    """
+    Returns the session directory for variable datavar of file fname. The path depends on the
+    modification time of the file, so a file written since a session started gets a new session.
+    """
+    fname = os.path.abspath(fname)
+    key   = "{0}:{1}:{2}".format(fname, datavar, os.path.getmtime(fname))
+    return os.path.join(tempfile.gettempdir(), "cesmgui-session-" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+
+
+
+def _lock(path):
+    """ Waits for the lock of the session at path. RETURNS the open lock file, for _unlock. """
+    fh = open(path + ".lock", "a")
+    fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+    return fh
+
+
+
+def _unlock(fh):
+    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+    fh.close()
+
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == 1   # EPERM: the process exists but belongs to someone else
+    return True
+
+
+
+class GridSession(object):
+    """
+    An editor's attachment to a shared grid session. Use GridSession.attach to create one.
+
+    Change log layout (little endian): a sequence of records, each
+        header  - count n (uint32), crc32 of the payload (uint32), pid of the writer (int32)
+        payload - n int32 row indices, n int32 column indices, n float64 old values and n float64
+                  new values
+    Each record is written with a single write to a file opened for appending, so the records of
+    different processes do not interleave.
+    """
+    RECORD = struct.Struct("<IIi")
+    ARRAYS = ("kmt", "orig", "lons", "lats")
+
+
+    def __init__(self, path):
+        self.path = path
+        self.pid  = os.getpid()
+        self.data = np.load(os.path.join(path, "kmt.npy"),  mmap_mode="r+")   # Shared, and written to by edits
+        self.orig = np.load(os.path.join(path, "orig.npy"), mmap_mode="r")
+        self.lons = np.load(os.path.join(path, "lons.npy"), mmap_mode="r")
+        self.lats = np.load(os.path.join(path, "lats.npy"), mmap_mode="r")
+
+        open(os.path.join(path, "members", str(self.pid)), "w").close()
+        self.log    = open(os.path.join(path, "changes.log"), "ab", 0)   # Unbuffered, one write per record
+        # The edits logged before this editor attached are already in the shared arrays
+        self.offset = self.log.tell()
+
+
+    @classmethod
+    def attach(cls, fname, datavar="kmt"):
+        """
+        Attaches to the session of a grid file, starting the session if there is none.
+        RETURNS
+            a GridSession
+        """
+        path = session_path(fname, datavar)
+        # The lock is held until this editor is a member, so that between the check for live members
+        # and joining, no other editor can remove the session or start one of its own
+        lock = _lock(path)
+        try:
+            if os.path.isdir(path) and not cls._members(path):
+                cls._remove(path)   # Left behind by editors that are gone
+            if not os.path.isdir(path):
+                # The session is written to a directory of its own and then renamed into place, so
+                # an editor never maps a half-written session
+                tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + ".", dir=os.path.dirname(path))
+                try:
+                    data, lons, lats = read_kmt_grid(fname, datavar)
+                    data = np.ma.filled(data, 0)
+                    for name, a in zip(cls.ARRAYS, (data, data, np.ma.filled(lons, 0), np.ma.filled(lats, 0))):
+                        np.save(os.path.join(tmp, name + ".npy"), np.ascontiguousarray(a))
+                    os.mkdir(os.path.join(tmp, "members"))
+                    open(os.path.join(tmp, "changes.log"), "wb").close()
+                    os.rename(tmp, path)
+                except Exception:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    raise
+            return cls(path)
+        finally:
+            _unlock(lock)
+
+
+    @staticmethod
+    def _members(path):
+        """ Returns the pids of the live editors attached to a session. """
+        try:
+            pids = [int(p) for p in os.listdir(os.path.join(path, "members"))]
+        except OSError:
+            return []
+        return [pid for pid in pids if _alive(pid)]
+
+
+    @staticmethod
+    def _remove(path):
+        # The directory is renamed out of the way first, so that no editor attaches to it meanwhile
+        trash = tempfile.mkdtemp(prefix="cesmgui-trash.", dir=os.path.dirname(path))
+        try:
+            os.rename(path, os.path.join(trash, "session"))
+        except OSError:
+            pass
+        shutil.rmtree(trash, ignore_errors=True)
+
+
+    def members(self):
+        """ Returns the number of editors attached to the session, this one included. """
+        return len(self._members(self.path))
+
+
+    def publish(self, i, j, old, new):
+        """
+        Logs an edit of the shared KMT, which has already been made to self.data.
+        ARGUMENTS
+            i, j - the global indices of the edited cells
+            old  - the values of the cells before the edit
+            new  - the values of the cells after the edit
+        """
+        i = np.asarray(i, dtype="<i4").ravel()
+        j = np.asarray(j, dtype="<i4").ravel()
+        o = np.empty(i.size, dtype="<f8")
+        n = np.empty(i.size, dtype="<f8")
+        o[:] = np.ma.filled(old, 0)
+        n[:] = np.ma.filled(new, 0)
+        payload = i.tobytes() + j.tobytes() + o.tobytes() + n.tobytes()
+        self.log.write(GridSession.RECORD.pack(i.size, zlib.crc32(payload) & 0xffffffff, self.pid) + payload)
+
+
+    def poll(self):
+        """
+        Reads the edits that the other editors have logged since the last call.
+        RETURNS
+            a list of (i, j, old, new) tuples of arrays, one for each edit, in the order the edits
+            were made. The edits are already in self.data.
+        """
+        with open(os.path.join(self.path, "changes.log"), "rb") as fh:
+            fh.seek(self.offset)
+            buf = fh.read()
+
+        edits, pos = [], 0
+        while pos + GridSession.RECORD.size <= len(buf):
+            n, crc, pid = GridSession.RECORD.unpack_from(buf, pos)
+            start, end  = pos + GridSession.RECORD.size, pos + GridSession.RECORD.size + 24*n
+            if end > len(buf): break   # The record is still being written
+            payload = buf[start:end]
+            if zlib.crc32(payload) & 0xffffffff != crc: break
+            pos = end
+            if pid == self.pid: continue
+            i = np.frombuffer(payload, dtype="<i4", count=n, offset=0).astype(np.intp)
+            j = np.frombuffer(payload, dtype="<i4", count=n, offset=4*n).astype(np.intp)
+            o = np.frombuffer(payload, dtype="<f8", count=n, offset=8*n)
+            v = np.frombuffer(payload, dtype="<f8", count=n, offset=16*n)
+            edits.append((i, j, o, v))
+        self.offset += pos
+        return edits
+
+
+    def detach(self):
+        """ Detaches from the session, and removes the session if this was the last editor attached. """
+        if self.log.closed: return
+        self.log.close()
+        self.data.flush()
+        # The arrays are unmapped before the files may be removed
+        self.data = self.orig = self.lons = self.lats = None
+        lock = _lock(self.path)
+        try:
+            try:
+                os.remove(os.path.join(self.path, "members", str(self.pid)))
+            except OSError:
+                pass
+            if not self._members(self.path): self._remove(self.path)
+        finally:
+            _unlock(lock)
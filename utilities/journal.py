@@ -0,0 +1,193 @@
+import os, struct, zlib
+import numpy as np
+
+from gridsession import _alive
+
+
+# The editors that keep journals. RMaskEditor and KMTEditor edit the same variable of the same
+# file (the region mask is derived from the KMT), so the journals are told apart by the editor.
+KINDS = ("kmt", "rmask", "topo")
+
+
+
+def journal_path(fname, datavar, kind, pid=None):
+    """
+    Returns the name of the sidecar journal file of editor kind for variable datavar in file fname.
+    Every editor process has a journal of its own (several may edit one grid, see gridsession.py),
+    told apart by pid, which is the current process by default.
+    """
+    return "{0}.{1}.{2}.{3}.journal".format(fname, datavar, kind, os.getpid() if pid is None else pid)
+
+
+
+def orphaned_journals(fname, datavar, kind):
+    """
+    Finds the journals of editor kind for variable datavar in file fname that were left behind by
+    editors that are no longer running. The journals of the editors still running are left alone.
+    RETURNS
+        a list of the pids of the journals, oldest journal first
+    """
+    folder = os.path.dirname(fname) or "."
+    prefix = "{0}.{1}.{2}.".format(os.path.basename(fname), datavar, kind)   # as in journal_path
+    found  = []
+    for name in os.listdir(folder):
+        if not (name.startswith(prefix) and name.endswith(".journal")): continue
+        try:
+            pid = int(name[len(prefix):-len(".journal")])
+        except ValueError:
+            continue
+        path = os.path.join(folder, name)
+        # A journal with the pid of this process was left by an editor whose pid has been reused
+        if pid == os.getpid() or not _alive(pid): found.append((os.path.getmtime(path), pid))
+    return [pid for _, pid in sorted(found)]
+
+
+
+def discard_journals(fname, datavar, kind, pids):
+    """ Removes the journals of the given pids (see orphaned_journals), except that of this process. """
+    for pid in pids:
+        if pid == os.getpid(): continue
+        try:
+            os.remove(journal_path(fname, datavar, kind, pid))
+        except OSError:
+            pass
+
+
+
+class EditJournal(object):
+    """
+    A write-ahead journal of the edits made to a 2D variable. Each edit is appended to a
+    sidecar file next to the input file as a small binary record, so that the edits made
+    since the last save can be recovered if the editor crashes or is killed.
+
+    Appending only packs the record into the file buffer. The expensive fsync is done by
+    sync(), which the editors call from a timer, so that several edits share one fsync.
+
+    File layout (little endian):
+        header - magic (8 bytes), ny (uint32), nx (uint32), variable name (64 bytes),
+                 editor kind (8 bytes, one of KINDS)
+        record - kind (uint8), count n (uint32), crc32 of the payload (uint32), payload
+                 where the payload is n int32 row indices, n int32 column indices and
+                 n float64 values. A point edit is simply a record with n = 1.
+    """
+    MAGIC  = b"CGTJRNL2"
+    HEADER = struct.Struct("<8sII64s8s")
+    RECORD = struct.Struct("<BII")
+
+    POINT  = 1   # A single cell edited with modifyValue
+    BULK   = 2   # Several cells edited at once, e.g. with the lasso
+
+
+    def __init__(self, fname, datavar, shape, kind):
+        """
+        Creates a new (empty) journal of this process, replacing one left by an earlier process of the same pid.
+        ARGUMENTS
+            fname   - name of the data file being edited
+            datavar - name of the variable being edited
+            shape   - shape (ny, nx) of the variable
+            kind    - the editor, one of KINDS
+        """
+        if kind not in KINDS:
+            raise ValueError("Unknown editor {0}. Must be one of {1}".format(kind, KINDS))
+        self.path  = journal_path(fname, datavar, kind)
+        self.fh    = open(self.path, "wb")
+        self.fh.write(EditJournal.HEADER.pack(EditJournal.MAGIC, shape[0], shape[1], datavar.encode("utf-8"),
+                                              kind.encode("utf-8")))
+        self.dirty = True
+        self.sync()
+
+
+    def append_point(self, i, j, val):
+        """ Journals the edit of cell (i, j) to value val. """
+        self._append(EditJournal.POINT, 1, struct.pack("<iid", i, j, val))
+
+
+    def append_bulk(self, i, j, vals):
+        """
+        Journals a bulk edit.
+        ARGUMENTS
+            i, j - arrays with the row and column indices of the edited cells
+            vals - either an array with the new value of each cell, or a single value
+                   that was assigned to all the cells
+        """
+        i = np.asarray(i, dtype="<i4").ravel()
+        j = np.asarray(j, dtype="<i4").ravel()
+        v = np.empty(i.size, dtype="<f8")
+        v[:] = vals
+        self._append(EditJournal.BULK, i.size, i.tobytes() + j.tobytes() + v.tobytes())
+
+
+    def _append(self, kind, n, payload):
+        self.fh.write(EditJournal.RECORD.pack(kind, n, zlib.crc32(payload) & 0xffffffff))
+        self.fh.write(payload)
+        self.dirty = True
+
+
+    def sync(self):
+        """ Flushes the journal to disk. Does nothing if nothing was appended since the last call. """
+        if not self.dirty: return
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.dirty = False
+
+
+    def close(self, remove=False):
+        """
+        ARGUMENTS
+            remove - if True, the journal file is deleted after it is closed. This is done when the
+                     editor exits normally, as there is then nothing to recover.
+        """
+        if self.fh.closed: return
+        self.sync()
+        self.fh.close()
+        if remove and os.path.exists(self.path): os.remove(self.path)
+
+
+
+def read_journal(fname, datavar, shape, kind, pid=None):
+    """
+    Reads the journal of edits made by editor kind to variable datavar in file fname. Reading
+    stops at the first incomplete or corrupt record, which is where the editor was interrupted.
+    ARGUMENTS
+        fname   - name of the data file
+        datavar - name of the variable
+        shape   - the shape (ny, nx) of the variable, used to check that the journal matches the data
+        kind    - the editor, one of KINDS
+        pid     - the process that wrote the journal, see orphaned_journals
+    RETURNS
+        a list of (i, j, vals) tuples of arrays, one for each journalled edit, in the order the
+        edits were made. An empty list is returned if there is no journal.
+    RAISES
+        ValueError if the journal does not belong to this variable and editor or has a different shape
+    """
+    path = journal_path(fname, datavar, kind, pid)
+    if not os.path.exists(path): return []
+
+    with open(path, "rb") as fh:
+        buf = fh.read()
+
+    if len(buf) < EditJournal.HEADER.size:
+        return []
+    magic, ny, nx, name, jkind = EditJournal.HEADER.unpack_from(buf, 0)
+    name  = name.rstrip(b"\0").decode("utf-8")
+    jkind = jkind.rstrip(b"\0").decode("utf-8")
+    if magic != EditJournal.MAGIC or name != datavar or (ny, nx) != tuple(shape) or jkind != kind:
+        raise ValueError("Journal {0} does not match the {1} edits of variable {2} of shape {3}".format(
+                         path, kind, datavar, tuple(shape)))
+
+    records = []
+    pos = EditJournal.HEADER.size
+    while pos + EditJournal.RECORD.size <= len(buf):
+        kind, n, crc = EditJournal.RECORD.unpack_from(buf, pos)
+        start = pos + EditJournal.RECORD.size
+        end   = start + 16*n
+        if (kind not in (EditJournal.POINT, EditJournal.BULK)) or (end > len(buf)): break
+        payload = buf[start:end]
+        if (zlib.crc32(payload) & 0xffffffff) != crc: break
+
+        i = np.frombuffer(payload, dtype="<i4", count=n, offset=0)
+        j = np.frombuffer(payload, dtype="<i4", count=n, offset=4*n)
+        v = np.frombuffer(payload, dtype="<f8", count=n, offset=8*n)
+        records.append((i, j, v))
+        pos = end
+    return records
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+kmtcheck.py
+
+Finds the cells of a POP KMT field that usually need fixing:
+    isolated - ocean cells without any ocean neighbour
+    channel  - ocean cells with land on both sides, east and west or north and south, i.e.
+               channels and inlets that are one cell wide
+    pit      - ocean cells deeper than all of their neighbours
+    lake     - ocean cells that are not connected to the main (largest) body of ocean
+Neighbours are the four cells that share an edge, and the grid is periodic in longitude.
+
+    python kmtcheck.py gx1v6_kmt.nc
+
+KMTEditor uses PathologyScanner to jump from one problem to the next with the N and P keys.
+"""
+
+import numpy as np
+import sys, argparse
+
+from gridops import label, shift
+from gridio import read_kmt_grid
+
+
+KINDS = ("isolated", "channel", "pit", "lake")
+EDGE_NEIGHBOURS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+
+
+
+def local_pathologies(kmt, wrap=True):
+    """
+    Finds the pathologies that depend only on the neighbours of a cell (all but lakes).
+    ARGUMENTS
+        kmt  - 2D array of the number of ocean levels, 0 on land
+        wrap - if True, the first and last columns are neighbours
+    RETURNS
+        a dict mapping 'isolated', 'channel' and 'pit' to boolean arrays
+    """
+    ocean = kmt > 0
+    n, s, w, e = [shift(ocean, di, dj, False, wrap) for di, dj in EDGE_NEIGHBOURS]
+    deepest = np.max([shift(kmt, di, dj, 0, wrap) for di, dj in EDGE_NEIGHBOURS], axis=0)
+
+    isolated = ocean & ~(n | s | w | e)
+    channel  = ocean & ~isolated & ((~w & ~e) | (~n & ~s))
+    pit      = ocean & ~isolated & (kmt > deepest)
+    return {"isolated": isolated, "channel": channel, "pit": pit}
+
+
+
+class PathologyScanner(object):
+    """
+    Keeps track of the problem cells of a KMT field as it is edited. The problems are indexed
+    by their position in row-major order, so the next or previous problem from any cell is found
+    with a binary search. After a cell is edited, only its neighbourhood is checked again, except
+    for lakes, which are relabelled when an ocean cell becomes land, as that can split the ocean.
+    """
+
+    def __init__(self, kmt, wrap=True, progress=None):
+        """
+        ARGUMENTS
+            kmt      - the 2D KMT array. The scanner keeps a reference to it, so that it sees the edits.
+            wrap     - if True, the grid is periodic in longitude
+            progress - optionally, the progress function of a background task, see scan
+        """
+        self.kmt   = kmt
+        self.wrap  = wrap
+        self.ny, self.nx = kmt.shape
+        self.flags  = None   # kind -> boolean array
+        self.labels = None   # labels of the connected bodies of ocean
+        self.main   = 0      # label of the main body of ocean
+        self.index  = None   # sorted row-major indices of all the problem cells
+        self.scan(progress)
+
+
+    def _filled(self, a):
+        return np.ma.filled(a, 0)
+
+
+    def _label(self, progress=None):
+        self.labels, n = label(self._filled(self.kmt) > 0, 4, self.wrap, progress)
+        counts    = np.bincount(self.labels.ravel(), minlength=n+1)
+        counts[0] = 0
+        self.main = int(np.argmax(counts)) if n else 0
+        self.flags["lake"] = (self.labels > 0) & (self.labels != self.main)
+
+
+    def scan(self, progress=None):
+        """
+        Checks the whole grid. progress, if given, is called as progress(message, percent) between
+        the steps, e.g. the progress function of a background task (see qtasks.py), which raises
+        to stop the scan once the task has been cancelled.
+        """
+        if progress: progress("Checking the cells", 0)
+        self.flags = local_pathologies(self._filled(self.kmt), self.wrap)
+        if progress: progress("Finding lakes", 50)
+        self._label(progress)
+        self._reindex()
+
+
+    def _reindex(self):
+        self.index = np.flatnonzero(np.any([self.flags[k] for k in KINDS], axis=0))
+
+
+    def update(self, i, j):
+        """ Checks the neighbourhood of cell (i, j) again after it has been edited. """
+        # The flags of the cell and of its neighbours can change. They depend on the cells up to
+        # two away from (i, j), which are cut out of the grid (wrapping around in longitude).
+        r0 = max(0, i-2)
+        c0 = j-2 if self.wrap else max(0, j-2)
+        cols = np.arange(c0, j+3 if self.wrap else min(self.nx, j+3))
+        sub  = self._filled(self.kmt[r0:min(self.ny, i+3)][:, cols % self.nx])
+        flags = local_pathologies(sub, wrap=False)
+
+        wi = np.arange(max(0, i-1), min(self.ny, i+2))
+        wj = np.arange(j-1, j+2)
+        if not self.wrap: wj = wj[(wj >= 0) & (wj < self.nx)]
+        si, sj = np.ix_(wi - r0, wj - c0)
+        wi, wj = np.ix_(wi, wj % self.nx)
+        for kind in flags:
+            self.flags[kind][wi, wj] = flags[kind][si, sj]
+
+        was_ocean = self.labels[i, j] > 0
+        is_ocean  = self._filled(self.kmt[i, j]) > 0
+        if was_ocean and not is_ocean:
+            # The ocean may have been split in two
+            self._label()
+            self._reindex()
+            return
+        if is_ocean and not was_ocean:
+            # The new ocean cell joins the bodies of ocean around it into one
+            around = set()
+            for di, dj in EDGE_NEIGHBOURS:
+                ii, jj = i+di, j+dj
+                if self.wrap: jj %= self.nx
+                if 0 <= ii < self.ny and 0 <= jj < self.nx and self.labels[ii, jj] > 0:
+                    around.add(int(self.labels[ii, jj]))
+            if not around:
+                self.labels[i, j] = self.labels.max() + 1
+            else:
+                target = self.main if self.main in around else min(around)
+                for lab in around - set([target]):
+                    self.labels[self.labels == lab] = target
+                self.labels[i, j] = target
+            self.flags["lake"] = (self.labels > 0) & (self.labels != self.main)
+            self._reindex()
+            return
+
+        # Only the cells around (i, j) changed
+        cells = np.ravel_multi_index(np.broadcast_arrays(wi, wj), (self.ny, self.nx)).ravel()
+        flagged = np.any([self.flags[k].ravel()[cells] for k in KINDS], axis=0)
+        self.index = np.union1d(np.setdiff1d(self.index, cells), cells[flagged])
+
+
+    def problemsAt(self, i, j):
+        """ Returns the list of the kinds of problem of cell (i, j). """
+        return [k for k in KINDS if self.flags[k][i, j]]
+
+
+    def counts(self):
+        """ Returns a dict with the number of cells of each kind of problem. """
+        return dict((k, int(self.flags[k].sum())) for k in KINDS)
+
+
+    def next(self, i, j, step=1):
+        """
+        Returns the (i, j) of the next problem cell after cell (i, j) in row-major order, or the
+        previous one if step is negative, wrapping around the grid. Returns None if there are no problems.
+        """
+        if len(self.index) == 0: return None
+        lin = i*self.nx + j
+        if step > 0:
+            k = np.searchsorted(self.index, lin, side="right") % len(self.index)
+        else:
+            k = np.searchsorted(self.index, lin, side="left") - 1
+        return divmod(int(self.index[k]), self.nx)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find isolated points, narrow channels, pits and lakes in a KMT field')
+    parser.add_argument('fname', nargs=1, type=str, help='name of the netcdf KMT file')
+    parser.add_argument('--var', nargs=1, type=str, help='name of the KMT variable', default=["kmt"])
+    parser.add_argument('--nowrap', action='store_true', help='the grid is not periodic in longitude')
+    parser.add_argument('--list', action='store_true', help='list the problem cells (i, j as in KMTEditor)')
+    args = parser.parse_args()
+
+    kmt = read_kmt_grid(args.fname[0], args.var[0])[0]
+    scanner = PathologyScanner(kmt, wrap=not args.nowrap)
+    counts  = scanner.counts()
+    for kind in KINDS:
+        sys.stdout.write('%-10s %8d\n' % (kind, counts[kind]))
+    if args.list:
+        for lin in scanner.index:
+            i, j = divmod(int(lin), scanner.nx)
+            sys.stdout.write('%6d %6d %s\n' % (i, j, ",".join(scanner.problemsAt(i, j))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+A lasso for selecting the cells shown in an editor's view with the mouse.
+"""
+
+import numpy as np
+from matplotlib.widgets import Lasso
+
+
+
+def polygon_cells(verts, nx, ny):
+    """
+    Finds the cells of a view that lie inside a polygon. A cell (column x, row y) covers
+    [x, x+1] x [y, y+1] in the view and is inside if its centre (x+0.5, y+0.5) is, by the
+    even-odd rule, as for the rectangle selection of the editors. The polygon is filled one
+    scanline (row) at a time within its bounding box, so the cost depends on the size of the
+    polygon and not of the view.
+    ARGUMENTS
+        verts  - a sequence of (x, y) vertices of the polygon, which is closed implicitly
+        nx, ny - the number of columns and rows of the view. Cells outside of it are left out.
+    RETURNS
+        an (n, 2) integer array of the (column, row) of the cells inside, sorted by row and column
+    """
+    # Shifted by half a cell, the centres of the cells are the integer points
+    verts  = np.asarray(verts, dtype=np.float64).reshape(-1, 2) - 0.5
+    x0, y0 = verts[:,0], verts[:,1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+
+    # Each edge crosses the rows min(y0, y1) <= y < max(y0, y1). Counting the lower end only
+    # makes every row cross the closed polygon an even number of times.
+    lo = np.maximum(np.ceil(np.minimum(y0, y1)), 0).astype(np.intp)
+    hi = np.minimum(np.ceil(np.maximum(y0, y1)), ny).astype(np.intp)
+    count = np.maximum(hi - lo, 0)
+    if count.sum() == 0: return np.zeros((0, 2), dtype=np.intp)
+
+    edge = np.repeat(np.arange(len(verts)), count)
+    y    = np.repeat(lo, count) + (np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count))
+    x    = x0[edge] + (y - y0[edge])*(x1[edge] - x0[edge])/(y1[edge] - y0[edge])
+
+    # Within a row, the crossings pair up into spans xa <= x < xb that are inside the polygon
+    order = np.lexsort((x, y))
+    y, x  = y[order], x[order]
+    ya    = y[0::2]
+    xa    = np.clip(np.ceil(x[0::2]), 0, nx).astype(np.intp)
+    xb    = np.clip(np.ceil(x[1::2]), 0, nx).astype(np.intp)
+
+    # The spans are painted into the bounding box of the rows with a running sum
+    r0, r1 = ya.min(), ya.max() + 1
+    inside = np.zeros((r1 - r0, nx + 1), dtype=np.int32)
+    np.add.at(inside, (ya - r0, xa), 1)
+    np.add.at(inside, (ya - r0, xb), -1)
+    rows, cols = np.nonzero(np.cumsum(inside, axis=1)[:, :nx] > 0)
+    return np.c_[cols, rows + r0]
+
+
+
+class LassoTool(object):
+    def __init__(self, ax, nx, ny, callback):
+        """
+        ARGUMENTS
+            nx  - number of columns in the view window
+            ny  - number of rows in the view window
+            callback - a function from the main program that the LassoTool class
+                   calls when it has selected a list of points inside a lasso
+        """
+        self.axes   = ax
+        self.canvas = ax.figure.canvas
+        self.main_app_callback = callback
+        # The lasso only reacts to mouse presses while the tool is active
+        self.active = True
+        self.nx = nx
+        self.ny = ny
+
+        self.cid = self.canvas.mpl_connect('button_press_event', self.onpress)
+
+
+    def callback(self, verts):
+        """
+        This function is called by the matplotlib lasso widget when the lasso is released.
+        ARGUMENTS
+            verts - a list of tuples which collectively defines a path
+        """
+        # Selecting points that lie inside the lasso >>>>
+        # The selected points are indexed as (x_index, y_index), equivalently as
+        # (column_index, row_index) in the view.
+        selected_points = polygon_cells(verts, self.nx, self.ny)
+        # <<<< Selecting points that lie inside the lasso
+        
+        self.canvas.draw_idle()
+        # self.canvas.widgetlock.release(self.lasso)
+        del self.lasso
+        # Now that we are done with the lasso stuff, we call back an appropriate 
+        # function in the main program (this function was passed as an argument
+        # to the constructor for LassoTool)
+        self.main_app_callback(selected_points)
+
+    def onpress(self, event):
+        """
+        This function is called by matplotlib when a button is pressed on the view
+        window.
+        ARGUMENT
+            event - matplotlib passes the event as the argument to this function
+        """
+        # if self.canvas.widgetlock.locked(): 
+        #     print "here"
+        #     return
+        if (not self.active) or (event.inaxes is None): return
+        self.lasso = Lasso(event.inaxes, (event.xdata, event.ydata), self.callback)
+        # acquire a lock on the widget drawing
+        # self.canvas.widgetlock(self.lasso)
@@ -0,0 +1,263 @@
+"""
+Timing of the interactions with the editors (cursor moves, pans, edits, lassos, saves), to find out
+which stage of a slow key press is slow: updating the view, its statistics, pcolor, contour,
+tight_layout or one of the canvas redraws.
+
+An interaction is timed from the moment the editor starts handling it until it is done, and the
+stages inside it (which may be nested) are timed separately. For every kind of interaction, and
+every stage of it, the recorder keeps the latest timings, from which it reports rolling medians,
+95th percentiles and maxima. All the timings can also be written to a JSON or CSV file.
+
+When the recorder is disabled, the decorators only check a flag, and the context managers return
+a shared object that does nothing, so the editors can be instrumented at no noticeable cost.
+
+Nothing in here depends on Qt.
+"""
+
+from collections import deque, OrderedDict
+import functools
+import time, json, csv, sys, ctypes, ctypes.util
+import numpy as np
+
+
+
+def _clock_gettime():
+    """
+    Returns a monotonic clock made from clock_gettime(CLOCK_MONOTONIC) of the C library, for Python 2,
+    whose time module has none, or None where there is no such function.
+    """
+    CLOCK_MONOTONIC = 1 if sys.platform.startswith("linux") else 6 if sys.platform == "darwin" else None
+    if CLOCK_MONOTONIC is None: return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    # clock_gettime is in librt before glibc 2.17
+    for lib in ("c", "rt"):
+        try:
+            func = ctypes.CDLL(ctypes.util.find_library(lib)).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        func.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        ts = timespec()
+        if func(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0: continue
+
+        def monotonic():
+            func(CLOCK_MONOTONIC, ctypes.byref(ts))
+            return ts.tv_sec + ts.tv_nsec*1e-9
+        return monotonic
+    return None
+
+
+# A monotonic clock, so that the timings are not thrown off by changes of the system time.
+# time.time is used only where there is none at all.
+clock = getattr(time, "perf_counter", None) or getattr(time, "monotonic", None) or _clock_gettime() or time.time
+
+
+
+class _Nothing(object):
+    """ A context manager that does nothing, returned by a disabled recorder. """
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+_NOTHING = _Nothing()
+
+
+
+class _Timer(object):
+    """ Times one interaction or stage for a LatencyRecorder. """
+    def __init__(self, recorder, kind, name):
+        self.recorder = recorder
+        self.kind     = kind    # the kind of interaction, or None for a stage
+        self.name     = name
+
+    def __enter__(self):
+        self.t0 = clock()
+        if self.kind is not None: self.recorder._begin(self.kind, self.t0)
+        return self
+
+    def __exit__(self, *exc):
+        ms = 1000.*(clock() - self.t0)
+        if self.kind is not None: self.recorder._end(ms)
+        else: self.recorder._stage(self.name, ms)
+        return False
+
+
+
+class LatencyRecorder(object):
+    """
+    Records the time taken by the interactions with an editor and by their stages, in milliseconds.
+
+        with recorder.interaction("pan"):
+            with recorder.stage("updateView"): ...
+            with recorder.stage("pcolor"): ...
+
+    An interaction started inside another one is part of the outer one, e.g. the edit that a key
+    press makes. A stage outside of any interaction, e.g. a redraw from a timer, is recorded as an
+    interaction of kind "other". A stage that occurs several times in one interaction (such as
+    canvas.draw) is counted as the sum of its times.
+    """
+
+    def __init__(self, enabled=False, window=256, maxrecords=100000):
+        """
+        ARGUMENTS
+            enabled    - whether anything is recorded. May be changed at any time.
+            window     - the number of latest timings the percentiles are computed from
+            maxrecords - the number of interactions kept for dump. The oldest are dropped first.
+        """
+        self.enabled   = enabled
+        self.window    = window
+        self.totals    = OrderedDict()   # kind -> deque of the total times
+        self.counts    = {}              # kind -> number of interactions over the whole session
+        self.stages    = OrderedDict()   # (kind, stage) -> deque of the stage times
+        self.records   = deque(maxlen=maxrecords)  # (start, kind, total, stages) for each interaction
+        self.listeners = []    # functions called with (kind, total) after each interaction, e.g. a HUD
+        self.t_start   = clock()
+        self.current   = None  # [kind, start, OrderedDict of stage times] of the running interaction
+        self.depth     = 0
+
+
+    def interaction(self, kind):
+        """ Returns a context manager that times an interaction of the given kind. """
+        if not self.enabled: return _NOTHING
+        return _Timer(self, kind, None)
+
+
+    def stage(self, name):
+        """ Returns a context manager that times a stage of the current interaction. """
+        if not self.enabled: return _NOTHING
+        if self.current is None: return _OtherStage(self, name)
+        return _Timer(self, None, name)
+
+
+    def _begin(self, kind, t0):
+        self.depth += 1
+        if self.depth == 1: self.current = [kind, t0, OrderedDict()]
+
+
+    def _end(self, ms):
+        self.depth = max(0, self.depth - 1)
+        if self.depth > 0 or self.current is None: return
+        kind, t0, stages = self.current
+        self.current = None
+        self.totals.setdefault(kind, deque(maxlen=self.window)).append(ms)
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        for name, sms in stages.items():
+            self.stages.setdefault((kind, name), deque(maxlen=self.window)).append(sms)
+        self.records.append((t0 - self.t_start, kind, ms, stages))
+        for listener in self.listeners: listener(kind, ms)
+
+
+    def _stage(self, name, ms):
+        if self.current is None: return   # The interaction ended inside the stage
+        stages = self.current[2]
+        stages[name] = stages.get(name, 0.) + ms
+
+
+    def summary(self):
+        """
+        RETURNS
+            an OrderedDict with, for each kind of interaction, a dict with its 'count' (over the whole
+            session), and 'p50', 'p95' and 'max' over the latest timings, as well as 'stages', a
+            dict with the same statistics for each of its stages
+        """
+        out = OrderedDict()
+        for kind, times in self.totals.items():
+            out[kind] = dict(_percentiles(times), count=self.counts.get(kind, 0), stages=OrderedDict())
+        for (kind, name), times in self.stages.items():
+            out[kind]["stages"][name] = _percentiles(times)
+        return out
+
+
+    def hud_text(self):
+        """ Returns the summary as lines of text for an on-screen display. """
+        lines = ["{0:<10} {1:>6} {2:>8} {3:>8} {4:>8}".format("ms", "n", "p50", "p95", "max")]
+        for kind, s in self.summary().items():
+            lines.append("{0:<10} {1:>6} {2:>8.1f} {3:>8.1f} {4:>8.1f}".format(kind, s["count"], s["p50"], s["p95"], s["max"]))
+            # The slowest stages are the ones worth looking at
+            slowest = sorted(s["stages"].items(), key=lambda item: -item[1]["p95"])[:3]
+            for name, st in slowest:
+                lines.append("  {0:<14.14} {1:>8.1f} {2:>8.1f} {3:>8.1f}".format(name, st["p50"], st["p95"], st["max"]))
+        return "\n".join(lines)
+
+
+    def dump(self, fname):
+        """
+        Writes the timings to a file. A .csv file gets one row per interaction and stage, with the
+        columns start (s since the recorder was created), interaction, stage ('total' for the whole
+        interaction) and ms. Any other file gets JSON, with the summary and every interaction.
+        """
+        if fname.lower().endswith(".csv"):
+            with open(fname, "w") as fh:
+                writer = csv.writer(fh)
+                writer.writerow(["start", "interaction", "stage", "ms"])
+                for t, kind, ms, stages in self.records:
+                    writer.writerow(["{0:.4f}".format(t), kind, "total", "{0:.3f}".format(ms)])
+                    for name, sms in stages.items():
+                        writer.writerow(["{0:.4f}".format(t), kind, name, "{0:.3f}".format(sms)])
+            return
+        out = {"summary": self.summary(),
+               "interactions": [{"start": round(t, 4), "interaction": kind, "ms": round(ms, 3),
+                                 "stages": OrderedDict((n, round(v, 3)) for n, v in stages.items())}
+                                for t, kind, ms, stages in self.records]}
+        with open(fname, "w") as fh:
+            json.dump(out, fh, indent=1)
+
+
+
+class _OtherStage(object):
+    """ Times a stage outside of any interaction as an interaction of kind "other". """
+    def __init__(self, recorder, name):
+        self.outer = _Timer(recorder, "other", None)
+        self.inner = _Timer(recorder, None, name)
+
+    def __enter__(self):
+        self.outer.__enter__()
+        self.inner.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.inner.__exit__(*exc)
+        self.outer.__exit__(*exc)
+        return False
+
+
+
+def _percentiles(times):
+    a = np.fromiter(times, dtype=np.float64)
+    if a.size == 0: return {"p50": np.nan, "p95": np.nan, "max": np.nan}
+    p50, p95 = np.percentile(a, [50, 95])
+    return {"p50": float(p50), "p95": float(p95), "max": float(a.max())}
+
+
+
+def timed_interaction(kind):
+    """
+    Decorates a method of an object with a 'latency' LatencyRecorder, so that each call is timed as
+    an interaction of the given kind.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def timed(self, *args, **kwargs):
+            if not self.latency.enabled: return method(self, *args, **kwargs)
+            with self.latency.interaction(kind):
+                return method(self, *args, **kwargs)
+        return timed
+    return decorate
+
+
+
+def timed_stage(name=None):
+    """
+    Decorates a method of an object with a 'latency' LatencyRecorder, so that each call is timed as
+    a stage, named after the method unless a name is given.
+    """
+    def decorate(method):
+        stage = name or method.__name__
+        @functools.wraps(method)
+        def timed(self, *args, **kwargs):
+            if not self.latency.enabled: return method(self, *args, **kwargs)
+            with self.latency.stage(stage):
+                return method(self, *args, **kwargs)
+        return timed
+    return decorate
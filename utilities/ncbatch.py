@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""
+ncbatch.py
+
+Runs nccopy over many files at once with a pool of worker processes. Outputs that are
+already up to date are skipped, a failure on one file does not stop the others, and a
+summary of the throughput of the whole batch is printed at the end.
+
+Example:
+    python ncbatch.py -o compressed/ -n 8 "run1/*.nc" "run2/*.nc"
+"""
+
+import sys, os, glob, time, argparse, traceback
+import multiprocessing
+
+from nccopy import nccopy
+
+
+SKIP_MODES = ("mtime", "size", "none")
+
+
+
+def expand_inputs(patterns, listfiles=()):
+    """
+    Expands the input file names.
+    ARGUMENTS
+        patterns  - file names or glob patterns
+        listfiles - names of text files that list one input file name per line
+    RETURNS
+        a sorted list of the input file names, without duplicates
+    """
+    names = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches and os.path.exists(pattern): matches = [pattern]
+        names.update(matches)
+    for listfile in listfiles:
+        with open(listfile) as fh:
+            names.update(line.strip() for line in fh if line.strip() and not line.startswith("#"))
+    return sorted(names)
+
+
+
+def output_name(filein, outdir, suffix="", subdir=""):
+    """ Returns the name of the output file for filein: outdir/subdir/<basename of filein><suffix>. """
+    base, ext = os.path.splitext(os.path.basename(filein))
+    return os.path.normpath(os.path.join(outdir, subdir, base + suffix + ext))
+
+
+
+def output_names(files, outdir, suffix=""):
+    """
+    Returns the names of the output files for a list of input files. The outputs keep the layout
+    of the inputs below the deepest directory that holds all of them, so that inputs with the same
+    name in different directories (run1/a.nc and run2/a.nc) go to different outputs (outdir/run1/a.nc
+    and outdir/run2/a.nc). Inputs that are all in one directory go straight into outdir.
+    RAISES
+        ValueError if two inputs would still be written to the same output
+    """
+    dirs = [os.path.dirname(os.path.abspath(filein)) for filein in files]
+    root = os.path.dirname(os.path.commonprefix([d + os.sep for d in dirs])) if dirs else ""
+    names = [output_name(filein, outdir, suffix, os.path.relpath(d, root)) for filein, d in zip(files, dirs)]
+
+    seen = {}
+    for filein, fileout in zip(files, names):
+        key = os.path.abspath(fileout)
+        if key in seen:
+            raise ValueError("ncbatch: {0} and {1} would both be written to {2}".format(seen[key], filein, fileout))
+        seen[key] = filein
+    return names
+
+
+
+def up_to_date(filein, fileout, mode="mtime"):
+    """
+    Returns True if fileout does not have to be made again.
+    ARGUMENTS
+        mode - 'mtime': fileout is not empty and is newer than filein
+               'size' : fileout is not empty (for when the modification times are not
+                        preserved, e.g. after copying the files around)
+               'none' : never up to date
+    """
+    if mode not in SKIP_MODES:
+        raise ValueError("Unknown skip mode {0}. Must be one of {1}".format(mode, SKIP_MODES))
+    if mode == "none" or not os.path.exists(fileout): return False
+    if os.path.getsize(fileout) == 0: return False
+    if mode == "size": return True
+    return os.path.getmtime(fileout) >= os.path.getmtime(filein)
+
+
+
+def _convert(job):
+    """
+    Converts one file in a worker process. The output is written under a temporary name and
+    renamed when complete, so an interrupted conversion never looks up to date.
+    RETURNS
+        a dict with the file names, the status ('done' or 'failed'), the time taken, the
+        sizes of the input and output files and the error message of a failure.
+    """
+    filein, fileout, kwargs = job
+    result = {"filein": filein, "fileout": fileout, "status": "done", "seconds": 0.,
+              "bytes_in": os.path.getsize(filein) if os.path.exists(filein) else 0, "bytes_out": 0, "error": None}
+    tmpout = fileout + ".part"
+    t0 = time.time()
+    try:
+        nccopy(filein, tmpout, clobber=True, quiet=True, **kwargs)
+        os.rename(tmpout, fileout)
+        result["bytes_out"] = os.path.getsize(fileout)
+    except Exception:
+        result["status"] = "failed"
+        result["error"]  = traceback.format_exc()
+        if os.path.exists(tmpout): os.remove(tmpout)
+    result["seconds"] = time.time()-t0
+    return result
+
+
+
+def ncbatch(files, outdir, nprocs=None, skip="mtime", suffix="", quiet=False, **kwargs):
+    """
+    Converts many files with nccopy using a pool of processes.
+    ARGUMENTS
+        files  - list of input file names (see expand_inputs)
+        outdir - directory for the output files, which have the same names as the inputs
+                 (plus suffix), laid out as the inputs are (see output_names). It must not
+                 be the directory of the inputs unless suffix is set.
+        nprocs - number of worker processes (default: the number of CPUs)
+        skip   - how to decide that an output is up to date, one of SKIP_MODES
+        suffix - appended to the base name of each output file
+        quiet  - if False, each file is reported as it finishes
+        kwargs - passed on to nccopy (except clobber, quiet and nworkers, which are set here)
+    RETURNS
+        a list with the result dict of each file (see _convert). Skipped files have status 'skipped'.
+    """
+    # The pool processes are daemons, which cannot start the reader processes of nccopy
+    kwargs.pop("nworkers", None)
+    kwargs.pop("clobber", None)
+    kwargs.pop("quiet", None)
+    if not os.path.isdir(outdir): os.makedirs(outdir)
+
+    results = []
+    jobs    = []
+    fileouts = output_names(files, outdir, suffix)
+    for filein, fileout in zip(files, fileouts):
+        if os.path.abspath(fileout) == os.path.abspath(filein):
+            raise ValueError("ncbatch: output {0} would overwrite its input".format(fileout))
+        if up_to_date(filein, fileout, skip):
+            results.append({"filein": filein, "fileout": fileout, "status": "skipped", "seconds": 0.,
+                            "bytes_in": 0, "bytes_out": 0, "error": None})
+            if not quiet: sys.stdout.write('skipping %s (up to date)\n' % filein)
+        else:
+            if not os.path.isdir(os.path.dirname(fileout)): os.makedirs(os.path.dirname(fileout))
+            jobs.append((filein, fileout, kwargs))
+
+    if jobs:
+        pool = multiprocessing.Pool(nprocs or multiprocessing.cpu_count())
+        try:
+            for result in pool.imap_unordered(_convert, jobs):
+                results.append(result)
+                if quiet: continue
+                if result["status"] == "done":
+                    sys.stdout.write('%s -> %s (%.1f s)\n' % (result["filein"], result["fileout"], result["seconds"]))
+                else:
+                    sys.stdout.write('FAILED %s\n%s\n' % (result["filein"], result["error"]))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+
+def summarize(results, elapsed):
+    """
+    Returns a dict with the aggregate numbers of a batch: the number of files done, skipped
+    and failed, files/s, MB/s (of input data) and the overall compression ratio.
+    """
+    done = [r for r in results if r["status"] == "done"]
+    bytes_in  = sum(r["bytes_in"] for r in done)
+    bytes_out = sum(r["bytes_out"] for r in done)
+    elapsed   = max(elapsed, 1e-9)
+    return {"done": len(done),
+            "skipped": sum(1 for r in results if r["status"] == "skipped"),
+            "failed": sum(1 for r in results if r["status"] == "failed"),
+            "seconds": elapsed,
+            "files_per_s": len(done)/elapsed,
+            "MB_per_s": bytes_in/1048576./elapsed,
+            "MB_in": bytes_in/1048576.,
+            "MB_out": bytes_out/1048576.,
+            "ratio": float(bytes_in)/bytes_out if bytes_out else 0.}
+
+
+
+def print_summary(summary, out=sys.stdout):
+    out.write('{done} done, {skipped} skipped, {failed} failed in {seconds:.1f} s\n'.format(**summary))
+    out.write('{files_per_s:.2f} files/s, {MB_per_s:.1f} MB/s, '
+              '{MB_in:.1f} MB -> {MB_out:.1f} MB (ratio {ratio:.2f})\n'.format(**summary))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert and compress many netCDF files with nccopy')
+    parser.add_argument('files', nargs='*', type=str, help='input files or glob patterns')
+    parser.add_argument('-o', nargs=1, type=str, required=True, help='output directory')
+    parser.add_argument('-n', nargs=1, type=int, help='number of worker processes (default: number of CPUs)', default=[None])
+    parser.add_argument('--list', nargs='+', type=str, help='text files listing input files, one per line', default=[])
+    parser.add_argument('--skip', nargs=1, type=str, choices=SKIP_MODES, help='how to detect up to date outputs', default=["mtime"])
+    parser.add_argument('--suffix', nargs=1, type=str, help='suffix added to the output file names', default=[""])
+    parser.add_argument('--complevel', nargs=1, type=int, help='zlib compression level (0 for no compression)', default=[6])
+    parser.add_argument('--noshuffle', action='store_true', help='do not use the shuffle filter')
+    parser.add_argument('--nounpack', action='store_true', help='keep packed short integers packed')
+    parser.add_argument('--classic', action='store_true', help='write NETCDF4_CLASSIC files')
+    parser.add_argument('--chunking', nargs=1, type=str, help='rechunk for this access pattern', default=[None])
+    parser.add_argument('--profile', nargs=1, type=str, help='per-variable settings written by ncbench', default=[None])
+    args = parser.parse_args()
+
+    files = expand_inputs(args.files, args.list)
+    if not files:
+        sys.stderr.write('ncbatch: no input files\n')
+        sys.exit(1)
+
+    t0 = time.time()
+    results = ncbatch(files, args.o[0], nprocs=args.n[0], skip=args.skip[0], suffix=args.suffix[0],
+                      zlib=args.complevel[0] > 0, complevel=max(1, args.complevel[0]),
+                      shuffle=not args.noshuffle, unpackshort=not args.nounpack,
+                      classic=int(args.classic), chunking=args.chunking[0], profile=args.profile[0])
+    summary = summarize(results, time.time()-t0)
+    print_summary(summary)
+    if summary["failed"]: sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
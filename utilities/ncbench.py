@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+ncbench.py
+
+Benchmarks the compression settings of the variables in a netCDF file and writes a
+per-variable settings profile that nccopy can use (see the profile argument of nccopy).
+
+For every variable a sample is written with each combination of complevel, shuffle and
+chunking, and the compressed size, the compression and decompression throughput and the
+latency of reading 2D tiles of the size used by the editors are measured.
+"""
+
+from netCDF4 import Dataset
+import numpy as np
+import sys, os, time, json, shutil, tempfile, argparse
+
+from nccopy import hyperslabs
+from chunking import plan_chunks
+
+
+COMPLEVELS = (0, 1, 4, 6, 9)      # 0 stands for no compression
+SHUFFLES   = (False, True)
+PATTERNS   = ("tile2d", "full")
+
+
+
+def sample_variable(ncvar, sample_mb):
+    """
+    Returns a hyperslab of at most sample_mb megabytes from the middle of the variable.
+    """
+    slabs = list(hyperslabs(ncvar.shape, ncvar.dtype.itemsize, int(sample_mb*1024*1024)))
+    return ncvar[slabs[len(slabs)//2]]
+
+
+
+def _tile_latencies(ncvar, tile, ntiles, rng):
+    """ Reads ntiles random tile x tile windows and returns the time taken by each, in ms. """
+    shape = ncvar.shape
+    times = []
+    for n in range(ntiles):
+        idx = [rng.randint(0, s) for s in shape[:-2]]
+        for s in shape[-2:]:
+            lo = rng.randint(0, max(1, s-tile+1))
+            idx.append(slice(lo, lo+tile))
+        t0 = time.time()
+        ncvar[tuple(idx)]
+        times.append(1000.*(time.time()-t0))
+    return times
+
+
+
+def benchmark_sample(data, tmpdir, tile=60, ntiles=20, complevels=COMPLEVELS,
+                     shuffles=SHUFFLES, patterns=PATTERNS):
+    """
+    Writes the sample data with every combination of the compression settings.
+    ARGUMENTS
+        data   - the sample (a numpy array with at least one dimension)
+        tmpdir - directory for the temporary files
+        tile   - size of the 2D windows read by the editors
+        ntiles - number of random tiles read to measure the latency
+        complevels, shuffles, patterns - the settings that are tried
+    RETURNS
+        a list with one dict of measurements for each combination
+    """
+    rng     = np.random.RandomState(0)
+    nbytes  = float(data.nbytes)
+    dims    = ["d%d" % d for d in range(data.ndim)]
+    results = []
+    for complevel in complevels:
+        for shuffle in (shuffles if complevel else (False,)):
+            for pattern in patterns:
+                chunks = plan_chunks(data.shape, data.dtype, pattern, tile)
+                path   = os.path.join(tmpdir, "sample.nc")
+
+                t0 = time.time()
+                ncfile = Dataset(path, "w", format="NETCDF4")
+                for d, n in zip(dims, data.shape): ncfile.createDimension(d, n)
+                var = ncfile.createVariable("v", data.dtype, dims, zlib=complevel > 0,
+                                            complevel=max(1, complevel), shuffle=shuffle, chunksizes=chunks)
+                var[:] = data
+                ncfile.close()
+                tcomp = time.time()-t0
+
+                ncfile = Dataset(path, "r")
+                var = ncfile.variables["v"]
+                t0 = time.time()
+                var[:]
+                tdecomp = time.time()-t0
+                # Without a chunk cache every tile read has to decompress its chunks
+                var.set_var_chunk_cache(0, 0, 0.75)
+                lat = _tile_latencies(var, tile, ntiles, rng) if data.ndim >= 2 else [0.]
+                ncfile.close()
+
+                size = os.path.getsize(path)
+                os.remove(path)
+                results.append({"zlib": complevel > 0, "complevel": complevel, "shuffle": shuffle,
+                                "chunking": pattern, "size": size, "ratio": nbytes/size,
+                                "compress_MBps": nbytes/1048576./max(tcomp, 1e-9),
+                                "decompress_MBps": nbytes/1048576./max(tdecomp, 1e-9),
+                                "tile_ms_p50": float(np.median(lat)), "tile_ms_max": float(np.max(lat))})
+    return results
+
+
+
+def choose_settings(results, max_slowdown=2.0):
+    """
+    Picks the settings with the smallest size among those whose median tile latency is within
+    max_slowdown times the fastest one, so that the chosen settings do not slow down the editors.
+    RETURNS
+        one of the dicts in results
+    """
+    fastest = min(r["tile_ms_p50"] for r in results)
+    ok = [r for r in results if r["tile_ms_p50"] <= max_slowdown*fastest] or results
+    return min(ok, key=lambda r: (r["size"], -r["compress_MBps"]))
+
+
+
+def tune(fname, varnames=None, sample_mb=16, tile=60, ntiles=20, max_slowdown=2.0, quiet=False):
+    """
+    Benchmarks the variables of a file.
+    ARGUMENTS
+        fname        - name of the netCDF file
+        varnames     - the variables to benchmark (by default all numeric variables with 2 or more dimensions)
+        sample_mb    - size of the sample of each variable in megabytes
+        tile         - size of the 2D windows read by the editors
+        ntiles       - number of random tiles read to measure the latency
+        max_slowdown - see choose_settings
+        quiet        - if False, the progress is printed
+    RETURNS
+        a tuple (report, profile). report maps each variable name to its list of results, and
+        profile maps each variable name to the chosen settings, in the form used by nccopy.
+    """
+    ncfile = Dataset(fname, "r")
+    if varnames is None:
+        varnames = [n for n, v in ncfile.variables.items() if v.ndim >= 2 and v.size > 0 and v.dtype.kind in "iuf"]
+
+    tmpdir  = tempfile.mkdtemp(prefix="ncbench")
+    report  = {}
+    profile = {}
+    try:
+        for varname in varnames:
+            if not quiet: sys.stdout.write('benchmarking variable %s\n' % varname)
+            data = sample_variable(ncfile.variables[varname], sample_mb)
+            report[varname] = benchmark_sample(np.ma.filled(data), tmpdir, tile=tile, ntiles=ntiles)
+            best = choose_settings(report[varname], max_slowdown)
+            profile[varname] = dict((k, best[k]) for k in ("zlib", "complevel", "shuffle", "chunking"))
+    finally:
+        ncfile.close()
+        shutil.rmtree(tmpdir)
+    return report, profile
+
+
+
+def print_report(report, profile, out=sys.stdout):
+    """ Prints the benchmark results as a table. The chosen settings are marked with a '*'. """
+    fmt = "{0:1s} {1:12s} {2:>5s} {3:>7s} {4:>10s} {5:>10s} {6:>7s} {7:>9s} {8:>9s} {9:>8s} {10:>8s}\n"
+    out.write(fmt.format("", "variable", "level", "shuffle", "chunking", "size(MB)", "ratio",
+                         "comp MB/s", "dec MB/s", "tile p50", "tile max"))
+    for varname in sorted(report):
+        best = profile.get(varname, {})
+        for r in report[varname]:
+            mark = "*" if all(r[k] == best.get(k) for k in ("complevel", "shuffle", "chunking")) else ""
+            out.write(fmt.format(mark, varname[:12], str(r["complevel"]), str(r["shuffle"]), r["chunking"],
+                                 "%.2f" % (r["size"]/1048576.), "%.2f" % r["ratio"],
+                                 "%.1f" % r["compress_MBps"], "%.1f" % r["decompress_MBps"],
+                                 "%.2f" % r["tile_ms_p50"], "%.2f" % r["tile_ms_max"]))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark and tune the compression settings of a netCDF file')
+    parser.add_argument('fname', nargs=1, type=str, help='name of the netcdf data file')
+    parser.add_argument('--vars', nargs='+', type=str, help='variables to benchmark', default=None)
+    parser.add_argument('--sample', nargs=1, type=float, help='size of the sample of each variable in MB', default=[16])
+    parser.add_argument('-s', nargs=1, type=int, help='size of the editor view (2D tile) in number of pixels', default=[60])
+    parser.add_argument('--max-slowdown', nargs=1, type=float, help='allowed slowdown of tile reads', default=[2.0])
+    parser.add_argument('--profile', nargs=1, type=str, help='write the chosen settings to this JSON file for nccopy')
+    parser.add_argument('--report', nargs=1, type=str, help='write all the results to this JSON file')
+    args = parser.parse_args()
+
+    report, profile = tune(args.fname[0], args.vars, sample_mb=args.sample[0], tile=args.s[0],
+                           max_slowdown=args.max_slowdown[0])
+    print_report(report, profile)
+    if args.profile:
+        with open(args.profile[0], "w") as fh: json.dump(profile, fh, indent=2, sort_keys=True)
+    if args.report:
+        with open(args.report[0], "w") as fh: json.dump(report, fh, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,249 @@
-from netCDF4 import Dataset
-import sys
+from netCDF4 import Dataset, default_fillvals
+import numpy as np
+import sys, os, time, shutil, json, itertools, multiprocessing, traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from chunking import plan_chunks, plan_chunk_cache
+from copystats import CopyStats
+
+
+def hyperslabs(shape, nbytes, budget, chunks=None, start=0, stop=None, nlead=None):
+    """
+    Splits an array into hyperslabs that each need at most budget bytes of memory. The array
+    is traversed along its leading dimensions: the first dimension along which a single
+    index (with all of the trailing dimensions) fits within the budget is cut into blocks,
+    and the dimensions before it are iterated over one index at a time.
+    ARGUMENTS
+        shape  - shape of the array
+        nbytes - bytes of memory needed per element, including any temporaries
+        budget - memory budget in bytes for one hyperslab
+        chunks - chunk sizes of the array, or None if it is not chunked. Blocks are made a
+                 multiple of the chunk size so that reads do not straddle chunks.
+        start, stop - the range of indices to traverse along the first dimension
+        nlead  - if given, at most these many indices are taken at once along the first dimension
+    RETURNS
+        a generator of tuples of slices, one tuple per hyperslab
+    """
+    ndim = len(shape)
+    if ndim == 0:
+        yield ()
+        return
+    if stop is None: stop = shape[0]
+
+    # sizes[d] is the number of bytes for a single index along dimension d
+    sizes = [0]*ndim
+    acc   = nbytes
+    for d in range(ndim-1, -1, -1):
+        sizes[d] = acc
+        acc     *= shape[d]
+
+    # The dimension that is cut into blocks
+    d = 0
+    while (d < ndim-1) and (sizes[d] > budget): d += 1
+
+    n = max(1, int(budget // sizes[d]))
+    if chunks is not None and n > chunks[d]: n -= n % chunks[d]
+    if d == 0 and nlead: n = min(n, nlead)
+
+    lead = [range(start, stop)] + [range(shape[dd]) for dd in range(1, d)]
+    lo, hi = (start, stop) if d == 0 else (0, shape[d])
+    for idx in itertools.product(*lead[:d]):
+        for b in range(lo, hi, n):
+            yield tuple(slice(i, i+1) for i in idx) + (slice(b, min(b+n, hi)),)
+
+
+
+def unpack(idata, scale_factor, add_offset, missing_value=None, mval=1.e30, fill_value=None):
+    """
+    Unpacks short integers to floats. Elements equal to missing_value are set to mval, and
+    elements equal to fill_value (that are not missing values) are masked, as they would be
+    if netCDF4 unpacked the data.
+    """
+    tmpdata = (scale_factor*idata.astype('f')+add_offset).astype('f')
+    if fill_value is not None:
+        tmpdata = np.ma.masked_where(idata == fill_value, tmpdata)
+    if missing_value is not None:
+        tmpdata = np.ma.where(idata == missing_value, mval, tmpdata)
+    return tmpdata
+
+
+
+def packed_fill_value(ncvar):
+    """
+    Returns the fill value of a packed variable, which is its _FillValue or else the default
+    fill value of its type.
+    """
+    return getattr(ncvar, '_FillValue', default_fillvals.get(ncvar.dtype.str[1:]))
+
+
+
+def quantize(data, lsd):
+    """
+    Truncates data to lsd significant decimal digits. This is the same quantization
+    that netCDF4 applies when writing a variable created with least_significant_digit.
+    """
+    precision = pow(10., -lsd)
+    exp = np.log10(precision)
+    if exp < 0:
+        exp = int(np.floor(exp))
+    else:
+        exp = int(np.ceil(exp))
+    bits  = np.ceil(np.log2(pow(10., -exp)))
+    scale = pow(2., bits)
+    return np.around(scale*data)/scale
+
+
+
+def _shift(slab, offset):
+    """ Shifts a hyperslab by -offset along its first dimension. """
+    if not (offset and slab): return slab
+    return (slice(slab[0].start-offset, slab[0].stop-offset),) + slab[1:]
+
+
+
+def _nbytes(data):
+    """ Returns the number of bytes of the values in data (an array or a scalar). """
+    return getattr(data, 'nbytes', 0)
+
+
+
+def _pipeline_reader(filein, tasks, results):
+    """
+    A reader process of the pipelined copy. It reads the hyperslabs that are listed in the
+    tasks queue, unpacks and quantizes them, and puts them on the bounded results queue for
+    the writer, together with the time spent reading and unpacking and the number of
+    bytes read. A None is put on the results queue when there are no more tasks, or when
+    the reader fails.
+    """
+    ncfilein = None
+    try:
+        ncfilein = Dataset(filein, 'r')
+        for varname, slab, outslab, dounpackshort, lsd, raw in iter(tasks.get, None):
+            ncvar = ncfilein.variables[varname]
+            if raw or dounpackshort: ncvar.set_auto_maskandscale(False)
+            t0 = time.time()
+            idata = ncvar[slab]
+            t1 = time.time()
+            if dounpackshort:
+                data = unpack(idata, ncvar.scale_factor, ncvar.add_offset,
+                              getattr(ncvar, 'missing_value', None), fill_value=packed_fill_value(ncvar))
+            else:
+                data = idata
+            if lsd is not None: data = quantize(data, lsd)
+            results.put((varname, outslab, data, t1-t0, time.time()-t1, _nbytes(idata)))
+            del idata
+    except Exception:
+        # A varname of None tells the writer that this reader failed
+        results.put((None, None, traceback.format_exc(), 0., 0., 0))
+    finally:
+        if ncfilein is not None: ncfilein.close()
+        results.put(None)
+
+
+
+def _pipelined_copy(filein, fileout, plan, nworkers, quiet, stats, report, poll=1.0):
+    """
+    Copies the data of the variables with a pool of reader processes and a single writer,
+    which is this process. The output file must already contain the variables. A reader
+    that dies without reporting (e.g. killed when out of memory) fails the copy: the writer
+    checks that the readers are alive whenever it has waited poll seconds for a slab.
+    ARGUMENTS
+        plan     - a list of (varname, slabs, offset, dounpackshort, lsd, raw) tuples, one per variable
+        nworkers - number of reader processes
+        stats    - the CopyStats that the timings are added to
+        report   - a function called as report(varname, nbytes) after each slab is written
+    """
+    tasks   = multiprocessing.Queue()
+    # Bounding the results queue bounds the memory held by slabs waiting to be written
+    results = multiprocessing.Queue(maxsize=2*nworkers)
+    readers = [multiprocessing.Process(target=_pipeline_reader, args=(filein, tasks, results))
+               for n in range(nworkers)]
+    for p in readers:
+        p.daemon = True
+        p.start()
+
+    for varname, slabs, offset, dounpackshort, lsd, raw in plan:
+        for slab in slabs:
+            tasks.put((varname, slab, _shift(slab, offset), dounpackshort, lsd, raw))
+    for p in readers: tasks.put(None)
+
+    # HDF5 is not thread-safe, so only this process ever opens the output file
+    ncfileout = Dataset(fileout, 'a')
+    for varname, slabs, offset, dounpackshort, lsd, raw in plan:
+        if raw: ncfileout.variables[varname].set_auto_maskandscale(False)
+    error   = None
+    running = nworkers
+    try:
+        while running:
+            try:
+                item = results.get(timeout=poll)
+            except queue.Empty:
+                # A reader that died never sends its None. One that exited normally has sent it.
+                dead = [p for p in readers if p.exitcode]
+                if dead:
+                    error = error or "reader process {0} died with exit code {1}".format(dead[0].pid, dead[0].exitcode)
+                    break
+                continue
+            if item is None:
+                running -= 1
+                continue
+            varname, outslab, data, tread, tunpack, nin = item
+            if varname is None:
+                error = data
+            elif error is None:
+                if not quiet: sys.stdout.write('writing variable %s %s\n' % (varname, outslab))
+                t0 = time.time()
+                ncfileout.variables[varname][outslab] = data
+                stats.add_time(varname, "write", time.time()-t0)
+                stats.add_time(varname, "read", tread)
+                stats.add_time(varname, "unpack", tunpack)
+                stats.add_bytes(varname, nin, _nbytes(data))
+                report(varname, nin)
+    finally:
+        t0 = time.time()
+        ncfileout.close()
+        stats.add_time("(file)", "sync", time.time()-t0)
+        # After an error the readers that are left may be blocked on the full results queue
+        for p in readers:
+            if (error is not None or running) and p.is_alive(): p.terminate()
+            p.join()
+
+    if error is not None:
+        raise RuntimeError("nccopy: a reader process failed\n" + error)
+
+
+
+def filters_match(ncvar, zlib, complevel, shuffle, fletcher32):
+    """
+    Returns True if the variable is stored with the given compression settings.
+    """
+    f = ncvar.filters() or {}   # None for netcdf 3 files, which are never compressed
+    if bool(f.get('zlib')) != bool(zlib): return False
+    # The complevel and shuffle settings are only used together with zlib
+    if zlib and (f.get('complevel') != complevel or bool(f.get('shuffle')) != bool(shuffle)): return False
+    return bool(f.get('fletcher32')) == bool(fletcher32)
+
+
+
+def can_passthrough(ncvar, unpackshort, lsd, zlib, complevel, shuffle, fletcher32, pattern):
+    """
+    Returns True if a variable can be copied without decoding its values: it needs no
+    unpacking, no quantization and no rechunking, and its compression settings stay the same.
+    """
+    if unpackshort and hasattr(ncvar,'scale_factor') and hasattr(ncvar,'add_offset'): return False
+    if lsd is not None or pattern: return False
+    return filters_match(ncvar, zlib, complevel, shuffle, fletcher32)
+
+
 
 def nccopy(filein,fileout,unpackshort=True,
     zlib=True,complevel=6,shuffle=True,fletcher32=False,
     clobber=False,lsd_dict=None,nchunk=10,quiet=False,classic=0,
-    vars=None,istart=0,istop=-1):
+    vars=None,istart=0,istop=-1,membudget=64,nworkers=0,
+    chunking=None,tile=60,passthrough=True,profile=None,
+    progress=None,stats_file=None):
     """convert a netcdf 3 file (filein) to a netcdf 4 file
     The default format is 'NETCDF4', but can be set
     to NETCDF4_CLASSIC if classic=1.
@@ -18,16 +257,91 @@ def nccopy(filein,fileout,unpackshort=True,
     will be copied (plus all the dimension variables).
     The zlib, complevel and shuffle keywords control
     how the compression is done.
+    Variables are copied one hyperslab at a time, and the
+    memory used by a hyperslab (including the temporaries
+    needed to unpack short integers) is kept within membudget
+    megabytes. Along an unlimited dimension at most nchunk
+    records are copied at once.
+    If nworkers > 0, the hyperslabs are read, unpacked and
+    quantized by nworkers reader processes, and written by
+    this process, which is the only one that opens the
+    output file.
+    If chunking is None, netCDF chooses the chunk shapes of
+    the output variables. Otherwise the variables are
+    rechunked for an access pattern (see
+    chunking.ACCESS_PATTERNS). chunking is either a pattern
+    name used for all variables, or a dict mapping variable
+    names to pattern names. tile is the window size of the
+    'tile2d' pattern.
+    If passthrough=True, variables that need no unpacking,
+    quantization or rechunking and whose compression settings
+    are unchanged are copied as raw values, without the mask
+    and scale conversions, and keep their chunk shape. If the
+    whole file qualifies and keeps its format, the file itself
+    is copied.
+    profile is a dict, or the name of a JSON file holding a
+    dict, that maps variable names to per-variable settings
+    (any of 'zlib', 'complevel', 'shuffle' and 'chunking')
+    which override the keyword arguments. Such profiles are
+    written by ncbench.tune.
+    The time spent reading, unpacking/quantizing, writing and
+    syncing each variable and the bytes copied are recorded
+    in a CopyStats object, which is returned. Unless quiet,
+    it is printed as a table at the end, and if stats_file is
+    not None it is also written to that file as JSON.
+    progress, if not None, is called as
+    progress(varname, done, total) after each hyperslab is
+    written, where done and total are numbers of bytes of
+    input data, so that a GUI can show a progress bar.
 
     This code is basically the nc3tonc4 script from python netCDF4 libraray
     with slight modifications.
     """
 
     ncfilein = Dataset(filein, 'r')
-    if classic:
-        ncfileout = Dataset(fileout,'w',clobber=clobber,format='NETCDF4_CLASSIC')
-    else:
-        ncfileout = Dataset(fileout,'w',clobber=clobber,format='NETCDF4')
+    fileformat = 'NETCDF4_CLASSIC' if classic else 'NETCDF4'
+    stats = CopyStats(filein, fileout)
+
+    def finish():
+        stats.finish(os.path.getsize(filein), os.path.getsize(fileout))
+        if not quiet: sys.stdout.write(stats.table())
+        if stats_file is not None: stats.dump(stats_file)
+        return stats
+
+    if profile is not None and not isinstance(profile, dict):
+        with open(profile) as fh: profile = json.load(fh)
+
+    def settings_for(varname):
+        """ Returns the (zlib, complevel, shuffle, chunking pattern) to use for a variable. """
+        pattern = chunking.get(varname) if isinstance(chunking, dict) else chunking
+        vs = (profile or {}).get(varname, {})
+        return (vs.get('zlib', zlib), vs.get('complevel', complevel),
+                vs.get('shuffle', shuffle), vs.get('chunking', pattern))
+
+    def lsd_for(varname):
+        return lsd_dict[varname] if (lsd_dict is not None and varname in lsd_dict) else None
+
+    def passes_through(varname, ncvar):
+        vzlib, vcomplevel, vshuffle, pattern = settings_for(varname)
+        return passthrough and can_passthrough(ncvar, unpackshort, lsd_for(varname),
+                                               vzlib, vcomplevel, vshuffle, fletcher32, pattern)
+
+    # If nothing in the file has to change, the file is copied as it is
+    if vars is None and istart == 0 and istop == -1 and ncfilein.file_format == fileformat and \
+       all(passes_through(varname, ncvar) for varname, ncvar in ncfilein.variables.items()):
+        ncfilein.close()
+        if os.path.exists(fileout) and not clobber:
+            raise IOError("nccopy: {0} exists and clobber=False".format(fileout))
+        if not quiet: sys.stdout.write('copying file %s unchanged ..\n' % filein)
+        t0 = time.time()
+        shutil.copyfile(filein, fileout)
+        size = os.path.getsize(filein)
+        stats.add_time("(file)", "copy", time.time()-t0)
+        stats.add_bytes("(file)", size, size)
+        if progress is not None: progress(None, size, size)
+        return finish()
+
+    ncfileout = Dataset(fileout,'w',clobber=clobber,format=fileformat)
     
     mval = 1.e30 # missing value if unpackshort=True
     # create dimensions. Check for unlimited dim.
@@ -60,14 +374,27 @@ def nccopy(filein,fileout,unpackshort=True,
        for dimname in ncfilein.dimensions.keys():
            if dimname in ncfilein.variables.keys() and dimname not in varnames:
                varnames.append(dimname)
+
+    # The number of bytes of input data to copy, for the progress callback
+    def nbytes_to_copy(ncvar):
+        shape = list(ncvar.shape)
+        if unlimdimname and unlimdimname in ncvar.dimensions: shape[0] = max(0, istop-istart)
+        return int(np.prod(shape))*ncvar.dtype.itemsize if ncvar.dtype != str else 0
+    total = sum(nbytes_to_copy(ncfilein.variables[varname]) for varname in varnames)
+    done  = [0]
+
+    def report(varname, nbytes):
+        done[0] += nbytes
+        if progress is not None: progress(varname, done[0], total)
     
     # Copy variables
+    plan = []   # The variables left for the pipelined copy
     for varname in varnames:
         ncvar = ncfilein.variables[varname]
         if not quiet: sys.stdout.write('copying variable %s\n' % varname)
         # quantize data?
-        if lsd_dict is not None and lsd_dict.has_key(varname):
-            lsd = lsd_dict[varname]
+        lsd = lsd_for(varname)
+        if lsd is not None:
             if not quiet: sys.stdout.write('truncating to least_significant_digit = %d\n'%lsd)
         else:
             lsd = None # no quantization.
@@ -94,13 +421,35 @@ def nccopy(filein,fileout,unpackshort=True,
             FillValue = ncvar._FillValue
         else:
             FillValue = None 
+
+        # rechunk for the declared access pattern?
+        vzlib, vcomplevel, vshuffle, pattern = settings_for(varname)
+        if pattern and ncvar.ndim > 0:
+            chunksizes = plan_chunks(ncvar.shape, datatype, pattern, tile)
+        else:
+            chunksizes = None
+
+        # copy the raw values without decoding them?
+        raw = passes_through(varname, ncvar)
+        contiguous = False
+        if raw:
+            if not quiet: sys.stdout.write('passing values through unchanged ...\n')
+            # Keep the storage layout of the input variable
+            inchunks = ncvar.chunking()
+            if isinstance(inchunks, (list, tuple)):
+                chunksizes = list(inchunks)
+            elif not vzlib and not fletcher32 and not (unlimdimname and unlimdimname in ncvar.dimensions):
+                contiguous = True
         
+        # In the pipelined copy the readers quantize the data, so netCDF4 must not do it again
         var = ncfileout.createVariable(varname,datatype,ncvar.dimensions, fill_value=FillValue, 
-                                                                          least_significant_digit=lsd,
-                                                                          zlib=zlib,
-                                                                          complevel=complevel,
-                                                                          shuffle=shuffle,
-                                                                          fletcher32=fletcher32)
+                                                                          least_significant_digit=None if nworkers else lsd,
+                                                                          zlib=vzlib,
+                                                                          complevel=vcomplevel,
+                                                                          shuffle=vshuffle,
+                                                                          fletcher32=fletcher32,
+                                                                          contiguous=contiguous,
+                                                                          chunksizes=chunksizes)
         
         # fill variable attributes.
         attdict = ncvar.__dict__
@@ -108,6 +457,7 @@ def nccopy(filein,fileout,unpackshort=True,
         if dounpackshort and 'add_offset' in attdict: del attdict['add_offset']
         if dounpackshort and 'scale_factor' in attdict: del attdict['scale_factor']
         if dounpackshort and 'missing_value' in attdict: attdict['missing_value']=mval
+        if nworkers and lsd is not None: attdict['least_significant_digit']=lsd
         var.setncatts(attdict)
         #for attname in ncvar.ncattrs():
         #    if attname == '_FillValue': continue
@@ -116,43 +466,72 @@ def nccopy(filein,fileout,unpackshort=True,
         #        setattr(var,attname,mval)
         #    else:
         #        setattr(var,attname,getattr(ncvar,attname))
-        # fill variables with data.
-        if hasunlimdim: # has an unlim dim, loop over unlim dim index.
-            # range to copy
-            if nchunk:
-                start = istart; stop = istop; step = nchunk
-                if step < 1: step = 1
-                for n in range(start, stop, step):
-                    nmax = n+nchunk
-                    if nmax > istop: nmax=istop
-                    idata = ncvar[n:nmax]
-                    if dounpackshort:
-                        tmpdata = (ncvar.scale_factor*idata.astype('f')+ncvar.add_offset).astype('f')
-                        if hasattr(ncvar,'missing_value'):
-                            tmpdata = NP.where(idata == ncvar.missing_value, mval, tmpdata)
-                    else:
-                        tmpdata = idata
-                    var[n-istart:nmax-istart] = tmpdata
-            else:
-                idata = ncvar[:]
-                if dounpackshort:
-                    tmpdata = (ncvar.scale_factor*idata.astype('f')+ncvar.add_offset).astype('f')
-                    if hasattr(ncvar,'missing_value'):
-                        tmpdata = NP.where(idata == ncvar.missing_value, mval, tmpdata)
-                else:
-                    tmpdata = idata
-                var[0:len(unlimdim)] = tmpdata
-        else: # no unlim dim or 1-d variable, just copy all data at once.
-            idata = ncvar[:]
+        # fill variables with data, one hyperslab at a time.
+        if raw:
+            ncvar.set_auto_maskandscale(False)
+            var.set_auto_maskandscale(False)
+            nbytes = ncvar.dtype.itemsize
+        elif dounpackshort:
+            # The data is unpacked here, so netCDF4 must not also do it when reading
+            ncvar.set_auto_maskandscale(False)
+            nbytes = ncvar.dtype.itemsize + 9   # float temporaries and the mask
+        else:
+            nbytes = ncvar.dtype.itemsize + 1
+
+        # The slabs are aligned with the output chunks when rechunking, else with the input chunks
+        chunks = chunksizes or ncvar.chunking()
+        if not isinstance(chunks, (list, tuple)): chunks = None
+
+        if hasunlimdim: # has an unlim dim, only copy the range istart:istop along it.
+            slabs = hyperslabs(ncvar.shape, nbytes, int(membudget*1024*1024), chunks=chunks,
+                               start=istart, stop=istop, nlead=nchunk)
+            offset = istart
+        else:
+            slabs = hyperslabs(ncvar.shape, nbytes, int(membudget*1024*1024), chunks=chunks)
+            offset = 0
+
+        if chunksizes and not raw:
+            # The cache holds the chunks that one slab covers, so that chunks are not evicted (and
+            # recompressed) while they are only partially written, up to the memory budget.
+            slab = next(iter(hyperslabs(ncvar.shape, nbytes, int(membudget*1024*1024), chunks=chunks,
+                                        nlead=nchunk if hasunlimdim else None)), None)
+            if slab:
+                # A slab leaves out the trailing dimensions that it takes in full
+                slabshape = [len(range(*sl.indices(n))) for sl, n in zip(slab, ncvar.shape)] + list(ncvar.shape[len(slab):])
+                var.set_var_chunk_cache(*plan_chunk_cache(ncvar.shape, datatype, chunksizes, "full",
+                                                          slab=slabshape, budget=membudget*1024*1024))
+
+        if nworkers:
+            plan.append((varname, slabs, offset, dounpackshort, lsd, raw))
+            continue
+
+        for slab in slabs:
+            t0 = time.time()
+            idata = ncvar[slab]
+            t1 = time.time()
             if dounpackshort:
-                tmpdata = (ncvar.scale_factor*idata.astype('f')+ncvar.add_offset).astype('f')
-                if hasattr(ncvar,'missing_value'):
-                    tmpdata = NP.where(idata == ncvar.missing_value, mval, tmpdata)
+                tmpdata = unpack(idata, ncvar.scale_factor, ncvar.add_offset,
+                                 getattr(ncvar, 'missing_value', None), mval, packed_fill_value(ncvar))
             else:
                 tmpdata = idata
-            var[:] = tmpdata
+            t2 = time.time()
+            # netCDF4 quantizes the data (least_significant_digit) while writing it
+            var[_shift(slab, offset)] = tmpdata
+            stats.add_time(varname, "read", t1-t0)
+            stats.add_time(varname, "unpack", t2-t1)
+            stats.add_time(varname, "write", time.time()-t2)
+            stats.add_bytes(varname, _nbytes(idata), _nbytes(tmpdata))
+            report(varname, _nbytes(idata))
+            del idata, tmpdata
+        t0 = time.time()
         ncfileout.sync() # flush data to disk
+        stats.add_time(varname, "sync", time.time()-t0)
     
     # close files.
     ncfilein.close()
+    t0 = time.time()
     ncfileout.close()
+    stats.add_time("(file)", "sync", time.time()-t0)
+
+    if nworkers: _pipelined_copy(filein, fileout, plan, nworkers, quiet, stats, report)
+    return finish()
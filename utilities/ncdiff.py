@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+ncdiff.py
+
+Compares two files on the same grid variable by variable and writes the differences of
+each 2D variable as a 'changes' table in the format of KMTEditor, together with summary
+statistics: the number of cells changed, the land/ocean flips (a value of 0 is land, as
+in the KMT and region masks) and the number of changed cells in each region.
+
+    python ncdiff.py gx1v6_kmt.nc gx1v6_kmt_from_bob.nc -o kmt_diff.nc --regions region_mask.nc
+
+The variables are read one hyperslab at a time, so the memory used is bounded by the
+membudget option whatever the size of the grid. The changes table can be loaded into any
+of the editors as an overlay (File > Load Overlay) to highlight the cells that differ. KMTEditor
+and RMaskEditor work with the rows flipped, as the table is written by default; for TopoEditor,
+which does not flip the data, make the table with --noflip.
+"""
+
+from netCDF4 import Dataset
+import numpy as np
+import sys, json, argparse
+
+from nccopy import hyperslabs
+
+
+
+def diff_variable(var_a, var_b, flip=True, regions=None, membudget=64):
+    """
+    Compares a variable in two files, one hyperslab at a time.
+    ARGUMENTS
+        var_a, var_b - the netCDF variables to compare, which must have the same shape
+        flip         - if True, the row indices of the changes table are counted from the last row,
+                       which is the orientation of the KMT and region mask editors
+        regions      - optionally, a 2D integer array (in file orientation) with a region number per
+                       cell, by which the changed cells are counted
+        membudget    - memory budget in megabytes
+    RETURNS
+        a tuple (changes, stats). changes is the (n, 3) table of (i, j, value in var_b) for a 2D
+        variable and None otherwise, and stats is a dict of summary statistics.
+    """
+    if var_a.shape != var_b.shape:
+        raise ValueError("{0} has shape {1} in one file and {2} in the other".format(var_a.name, var_a.shape, var_b.shape))
+    shape   = var_a.shape
+    is2d    = len(shape) == 2
+    nbytes  = 2*var_a.dtype.itemsize + 2*var_b.dtype.itemsize + 8
+    chunks  = var_a.chunking()
+    if not isinstance(chunks, (list, tuple)): chunks = None
+
+    blocks  = []
+    stats   = {"cells": int(np.prod(shape)), "changed": 0, "land_to_ocean": 0, "ocean_to_land": 0,
+               "max_abs_diff": 0.}
+    rcounts = None
+    for slab in hyperslabs(shape, nbytes, int(membudget*1024*1024), chunks=chunks):
+        a = var_a[slab]
+        b = var_b[slab]
+        ma, mb = np.ma.getmaskarray(a), np.ma.getmaskarray(b)
+        da, db = np.ma.filled(a, 0), np.ma.filled(b, 0)
+        changed = (ma != mb) | (~ma & (da != db))
+        if not changed.any(): continue
+
+        stats["changed"]       += int(changed.sum())
+        stats["land_to_ocean"] += int(np.sum(changed & (da == 0) & (db != 0)))
+        stats["ocean_to_land"] += int(np.sum(changed & (da != 0) & (db == 0)))
+        both = changed & ~ma & ~mb
+        if both.any() and da.dtype.kind in "iuf":
+            stats["max_abs_diff"] = max(stats["max_abs_diff"], float(np.abs(db[both].astype(np.float64) - da[both]).max()))
+
+        if is2d:
+            # The trailing dimensions that a hyperslab does not cut are left out of it
+            i0, j0 = ([s.start for s in slab] + [0, 0])[:2]
+            i, j = np.nonzero(changed)
+            i += i0
+            j += j0
+            if regions is not None:
+                counts  = np.bincount(regions[i, j].astype(np.intp).ravel() - regions.min())
+                rcounts = counts if rcounts is None else _add_counts(rcounts, counts)
+            if flip: i = shape[0] - 1 - i
+            blocks.append(np.column_stack((i, j, db[changed])).astype(np.float64))
+
+    if rcounts is not None:
+        stats["regions"] = dict((str(r + int(regions.min())), int(n)) for r, n in enumerate(rcounts) if n)
+    if not is2d: return None, stats
+    changes = np.concatenate(blocks) if blocks else np.zeros((0, 3))
+    return changes, stats
+
+
+
+def _add_counts(c1, c2):
+    """ Adds two bincount arrays of possibly different lengths. """
+    if len(c1) < len(c2): c1, c2 = c2, c1
+    c1 = c1.copy()
+    c1[:len(c2)] += c2
+    return c1
+
+
+
+def ncdiff(file_a, file_b, varnames=None, flip=True, regions=None, membudget=64):
+    """
+    Compares all the variables that are in both files (or those in varnames).
+    ARGUMENTS
+        regions - see diff_variable. Only used for the variables of the same shape.
+        other arguments - see diff_variable
+    RETURNS
+        a dict mapping each variable name to its (changes, stats) tuple
+    """
+    nca = Dataset(file_a, "r")
+    ncb = Dataset(file_b, "r")
+    try:
+        if varnames is None:
+            varnames = [v for v in nca.variables if v in ncb.variables]
+        result = {}
+        for varname in varnames:
+            va, vb = nca.variables[varname], ncb.variables[varname]
+            reg = regions if (regions is not None and regions.shape == va.shape) else None
+            result[varname] = diff_variable(va, vb, flip=flip, regions=reg, membudget=membudget)
+    finally:
+        nca.close()
+        ncb.close()
+    return result
+
+
+
+def write_changes(ofile, changes, file_a, file_b, varname):
+    """
+    Writes a changes table to a netCDF file in the layout used by KMTEditor, so that it can be
+    read with changelog.read_changes and loaded as an overlay in the editors.
+    """
+    ncfile = Dataset(ofile, "w", format="NETCDF4")
+    ncfile.createDimension("changes", None)
+    ncfile.createDimension("i", 3)
+    cngvar = ncfile.createVariable("changes", "f8", ("changes", "i"))
+    cngvar.description = "changes to original data leading to present data. (i,j,val)"
+    if len(changes): cngvar[:,:] = changes
+    ncfile.history  = "Created by ncdiff.py"
+    ncfile.file_a   = file_a
+    ncfile.file_b   = file_b
+    ncfile.variable = varname
+    ncfile.close()
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two grid files and produce a KMTEditor changes table')
+    parser.add_argument('file_a', nargs=1, type=str, help='the original file')
+    parser.add_argument('file_b', nargs=1, type=str, help='the edited file')
+    parser.add_argument('--vars', nargs='+', type=str, help='variables to compare (default: all common ones)', default=None)
+    parser.add_argument('-o', nargs=1, type=str, help='write the changes of the (first) 2D variable to this file')
+    parser.add_argument('--json', nargs=1, type=str, help='write the statistics to this JSON file')
+    parser.add_argument('--regions', nargs=1, type=str, help='region mask file whose REGION_MASK (or kmt) variable is used to count changes')
+    parser.add_argument('--noflip', action='store_true', help='do not flip the row indices (for TopoEditor files)')
+    parser.add_argument('--membudget', nargs=1, type=float, help='memory budget in MB', default=[64])
+    args = parser.parse_args()
+
+    regions = None
+    if args.regions:
+        ncfile  = Dataset(args.regions[0], "r")
+        regvar  = "REGION_MASK" if "REGION_MASK" in ncfile.variables else "kmt"
+        regions = np.ma.filled(ncfile.variables[regvar][:,:], 0)
+        ncfile.close()
+
+    result = ncdiff(args.file_a[0], args.file_b[0], args.vars, flip=not args.noflip,
+                    regions=regions, membudget=args.membudget[0])
+
+    fmt = "{0:16s} {1:>10s} {2:>10s} {3:>10s} {4:>10s} {5:>12s}\n"
+    sys.stdout.write(fmt.format("variable", "cells", "changed", "land->ocn", "ocn->land", "max |diff|"))
+    for varname in sorted(result):
+        s = result[varname][1]
+        sys.stdout.write(fmt.format(varname[:16], str(s["cells"]), str(s["changed"]), str(s["land_to_ocean"]),
+                                    str(s["ocean_to_land"]), "%g" % s["max_abs_diff"]))
+        for region, n in sorted(s.get("regions", {}).items(), key=lambda rn: int(rn[0])):
+            sys.stdout.write("    region %6s: %d\n" % (region, n))
+
+    if args.o:
+        changed2d = [v for v in (args.vars or sorted(result)) if result[v][0] is not None and len(result[v][0])]
+        if changed2d:
+            write_changes(args.o[0], result[changed2d[0]][0], args.file_a[0], args.file_b[0], changed2d[0])
+            sys.stdout.write("changes of %s written to %s\n" % (changed2d[0], args.o[0]))
+    if args.json:
+        with open(args.json[0], "w") as fh:
+            json.dump(dict((v, result[v][1]) for v in result), fh, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
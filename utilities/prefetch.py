@@ -0,0 +1,75 @@
+from PyQt4.QtCore import QThread, QMutex, SIGNAL
+import traceback
+
+from viewcache import neighbour_views
+
+
+class ViewPrefetcher(QThread):
+    """
+    A worker thread that prepares the views neighbouring the current one and stores them in a
+    viewcache.ViewCache, so that the next pan finds its view ready.
+
+    Only the latest request matters: a request made while the thread is still preparing the
+    views of an earlier one replaces it, and the thread moves on to the new views after the
+    view it is working on. The thread only reads the data. It never draws, since matplotlib
+    artists must be created in the GUI thread.
+
+    Signals emitted (old-style PyQt4 signals):
+        viewsPrefetched(int)     - the number of views prepared for a request
+        prefetchFailed(QString)  - the error message
+    """
+    def __init__(self, cache, prepare, parent=None):
+        """
+        ARGUMENTS
+            cache   - the ViewCache to fill
+            prepare - a function of (si, sj) that returns a prepared view (see viewcache.prepare_view)
+        """
+        super(ViewPrefetcher, self).__init__(parent)
+        self.cache   = cache
+        self.prepare = prepare
+        self.mutex   = QMutex()
+        self.pending = None    # The views of the latest request, a list of (si, sj)
+        self.busy    = False
+
+
+    def request(self, si, sj, nrows, ncols, ny, nx):
+        """ Asks for the neighbours of the view at (si, sj) to be prepared. """
+        views = [v for v in neighbour_views(si, sj, nrows, ncols, ny, nx) if v not in self.cache]
+        if not views: return
+        self.mutex.lock()
+        self.pending = views
+        start_thread = not self.busy
+        self.busy    = True
+        self.mutex.unlock()
+
+        if start_thread:
+            self.wait()   # The previous run() may still be returning
+            self.start(QThread.LowPriority)
+
+
+    def run(self):
+        while True:
+            self.mutex.lock()
+            views, self.pending = self.pending, None
+            if not views:
+                self.busy = False
+                self.mutex.unlock()
+                return
+            self.mutex.unlock()
+
+            nprepared = 0
+            for key in views:
+                self.mutex.lock()
+                superseded = self.pending is not None
+                self.mutex.unlock()
+                if superseded: break
+                if key in self.cache: continue
+
+                epoch = self.cache.epoch
+                try:
+                    item = self.prepare(*key)
+                except Exception:
+                    self.emit(SIGNAL("prefetchFailed(QString)"), traceback.format_exc())
+                    break
+                if self.cache.put(key, item, epoch): nprepared += 1
+            self.emit(SIGNAL("viewsPrefetched(int)"), nprepared)
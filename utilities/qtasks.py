@@ -0,0 +1,210 @@
+"""
+A small framework to run long operations (reading a file, scanning the whole grid, a flood fill
+over an ocean basin) on a QThreadPool, so that the editors stay responsive while they run.
+
+Tasks do not edit. A task is given a snapshot of the data it needs (or arrays nothing else
+writes to) and returns a result. The result is handed back on the GUI thread, through a Qt
+signal, and the editor applies it to its DataContainer there. Since every edit, including those
+made from task results, is made on the GUI thread, the edits are serialized with each other and
+with the key presses, and a task never races with an edit of the data.
+"""
+
+from PyQt4.QtCore import QObject, QRunnable, QThreadPool, QMutex, QEventLoop, SIGNAL
+from PyQt4.QtGui import QProgressDialog
+import itertools
+import traceback
+
+
+# How a task ended, sent with the internal taskDone signal
+FINISHED, FAILED, CANCELLED = range(3)
+
+
+
+class TaskCancelled(Exception):
+    """ Raised in a task by its progress function once the task has been cancelled. """
+    pass
+
+
+
+class _Task(QRunnable):
+    """ Runs one task in a thread of the pool and reports back to the TaskRunner. """
+    def __init__(self, runner, taskid, name, func, args):
+        super(_Task, self).__init__()
+        self.setAutoDelete(True)
+        self.runner = runner
+        self.taskid = taskid
+        self.name   = name
+        self.func   = func
+        self.args   = args
+
+
+    def progress(self, msg="", percent=-1):
+        """
+        Reports the progress of the task, and is also where a cancelled task stops.
+        RAISES
+            TaskCancelled if the task has been cancelled
+        """
+        if self.runner.isCancelled(self.taskid): raise TaskCancelled(self.name)
+        self.runner.emit(SIGNAL("taskProgress(QString, QString, int)"), self.name, msg, percent)
+
+
+    def run(self):
+        try:
+            self.progress()   # A task cancelled before it started does not run
+            self.runner.emit(SIGNAL("taskStarted(QString)"), self.name)
+            result = self.func(self.progress, *self.args)
+        except TaskCancelled:
+            self.runner.emit(SIGNAL("taskDone(int, int, PyQt_PyObject)"), self.taskid, CANCELLED, None)
+        except Exception as err:
+            self.runner.emit(SIGNAL("taskDone(int, int, PyQt_PyObject)"), self.taskid, FAILED,
+                             (err, traceback.format_exc()))
+        else:
+            self.runner.emit(SIGNAL("taskDone(int, int, PyQt_PyObject)"), self.taskid, FINISHED, result)
+
+
+
+class TaskRunner(QObject):
+    """
+    Runs tasks on a thread pool and hands their results back on the GUI thread. The runner must
+    be created on the GUI thread.
+
+    Signals emitted (old-style PyQt4 signals):
+        taskStarted(QString)                - the name of the task
+        taskProgress(QString, QString, int) - the name of the task, a message, and the percentage done or -1
+        taskFinished(QString)               - the name of the task
+        taskFailed(QString, QString)        - the name of the task, and the traceback of the error
+        taskCancelled(QString)              - the name of the task
+        busyChanged(bool)                   - True when the first task is submitted, False when the last one is done
+    """
+    def __init__(self, parent=None, maxthreads=None):
+        """
+        ARGUMENTS
+            maxthreads - the number of tasks that may run at once, by default the number of cores
+        """
+        super(TaskRunner, self).__init__(parent)
+        self.pool = QThreadPool(self)
+        if maxthreads: self.pool.setMaxThreadCount(maxthreads)
+        self.ids       = itertools.count(1)
+        self.active    = {}     # The tasks submitted and not yet done, id -> (name, finished, failed)
+        self.mutex     = QMutex()
+        self.cancelled = set()  # The ids of the active tasks that have been cancelled. Read by the pool threads.
+        # The pool threads emit taskDone, which Qt queues to this object's (the GUI) thread
+        self.connect(self, SIGNAL("taskDone(int, int, PyQt_PyObject)"), self._done)
+
+
+    def submit(self, name, func, args=(), finished=None, failed=None):
+        """
+        Runs a task in the background.
+        ARGUMENTS
+            name     - a short description of the task, e.g. for the status bar
+            func     - the function that does the work. It is called as func(progress, *args), where
+                       progress is a function of a message and an optional percentage. It must not
+                       touch any Qt widgets or modify the editor's data, since it runs in a pool thread.
+                       It should call progress now and then, which raises TaskCancelled once the
+                       task has been cancelled.
+            args     - the arguments for func, e.g. a snapshot of the data
+            finished - called on the GUI thread with the result of func when it returns
+            failed   - called on the GUI thread with the exception if func raises
+        RETURNS
+            the id of the task, for cancel
+        """
+        taskid = next(self.ids)
+        self.active[taskid] = (name, finished, failed)
+        if len(self.active) == 1: self.emit(SIGNAL("busyChanged(bool)"), True)
+        self.pool.start(_Task(self, taskid, name, func, args))
+        return taskid
+
+
+    def cancel(self, taskid):
+        """
+        Asks a task to stop. The task stops the next time it reports progress. A task that returns
+        without reporting progress again counts as cancelled all the same, and its result is dropped.
+        """
+        self.mutex.lock()
+        if taskid in self.active: self.cancelled.add(taskid)
+        self.mutex.unlock()
+
+
+    def cancelAll(self):
+        for taskid in list(self.active): self.cancel(taskid)
+
+
+    def isCancelled(self, taskid):
+        self.mutex.lock()
+        cancelled = taskid in self.cancelled
+        self.mutex.unlock()
+        return cancelled
+
+
+    def isBusy(self): return len(self.active) > 0
+
+
+    def isActive(self, name):
+        """ Returns True if a task of this name has been submitted and is not done. """
+        return any(n == name for n, _, _ in self.active.values())
+
+
+    def waitForDone(self):
+        """ Blocks until every task has returned, e.g. before the editor closes. """
+        self.pool.waitForDone()
+
+
+    def _done(self, taskid, status, payload):
+        name, finished, failed = self.active.pop(taskid)
+        self.mutex.lock()
+        if taskid in self.cancelled and status == FINISHED: status = CANCELLED
+        self.cancelled.discard(taskid)
+        self.mutex.unlock()
+
+        if status == FINISHED:
+            self.emit(SIGNAL("taskFinished(QString)"), name)
+            if finished is not None: finished(payload)
+        elif status == FAILED:
+            err, tb = payload
+            self.emit(SIGNAL("taskFailed(QString, QString)"), name, tb)
+            if failed is not None: failed(err)
+        else:
+            self.emit(SIGNAL("taskCancelled(QString)"), name)
+        if not self.active: self.emit(SIGNAL("busyChanged(bool)"), False)
+
+
+
+def run_with_progress(parent, name, func, args=()):
+    """
+    Runs a task while a busy dialog with a Cancel button is shown, keeping the event loop running,
+    e.g. to read a file before the editor window exists.
+    ARGUMENTS
+        parent     - the parent widget of the dialog, or None
+        name       - the text of the dialog
+        func, args - as in TaskRunner.submit
+    RETURNS
+        the result of func
+    RAISES
+        TaskCancelled if the dialog was cancelled, even if func returned before it noticed, or the
+        exception raised by func
+    """
+    runner = TaskRunner(maxthreads=1)
+    dialog = QProgressDialog(name, "Cancel", 0, 0, parent)   # A range of 0..0 shows a busy indicator
+    dialog.setWindowTitle(name)
+    dialog.setMinimumDuration(500)
+    loop   = QEventLoop()
+    outcome = {}
+
+    def finished(result): outcome["result"] = result
+    def failed(err): outcome["error"] = err
+    def progress(name, msg, percent):
+        if msg: dialog.setLabelText(msg)
+        if percent >= 0:
+            dialog.setRange(0, 100)
+            dialog.setValue(percent)
+
+    runner.connect(runner, SIGNAL("taskProgress(QString, QString, int)"), progress)
+    runner.connect(runner, SIGNAL("busyChanged(bool)"), lambda busy: busy or loop.quit())
+    taskid = runner.submit(name, func, args, finished, failed)
+    dialog.connect(dialog, SIGNAL("canceled()"), lambda: runner.cancel(taskid))
+    if runner.isBusy(): loop.exec_()
+    dialog.close()
+
+    if "error" in outcome: raise outcome["error"]
+    if "result" not in outcome: raise TaskCancelled(name)
+    return outcome["result"]
@@ -0,0 +1,143 @@
+"""
+Statistics of each region of a region mask (the number of cells, their area, and their latitude
+and longitude extent) for the region panel of RMaskEditor.
+
+The statistics are computed once for the whole grid with np.bincount, and are then updated from
+the cells each edit changes. Counts and areas are simply moved from the old to the new region of
+the cells. An extent can only grow by adding cells, so only when a cell on the edge of its region's
+extent is removed is that region's extent computed again, and then only when it is next asked for.
+"""
+
+import numpy as np
+
+
+
+class RegionStats(object):
+    def __init__(self, regions, lats, lons, area=None):
+        """
+        ARGUMENTS
+            regions    - the 2D (masked) integer array of region numbers. Masked cells (land) are
+                         left out. The statistics keep a reference to it, to recompute extents.
+            lats, lons - 2D arrays with the latitude and longitude of each cell
+            area       - optionally, a 2D array with the area of each cell in m^2
+        """
+        self.regions = regions
+        self.lats    = np.ma.filled(lats, np.nan).astype(np.float64)
+        self.lons    = np.ma.filled(lons, np.nan).astype(np.float64)
+        self.area    = None if area is None else np.asarray(area, dtype=np.float64)
+        self.dirty   = set()    # the regions whose extent must be recomputed
+        self.compute()
+
+
+    def compute(self):
+        """ Computes the statistics of all the regions over the whole grid. """
+        valid = ~np.ma.getmaskarray(self.regions)
+        ids   = np.ma.filled(self.regions, 0)[valid].astype(np.intp)
+        self.offset = min(0, int(ids.min())) if ids.size else 0
+        ids  -= self.offset
+        n     = int(ids.max()) + 1 if ids.size else 1
+
+        self.count   = np.bincount(ids, minlength=n)
+        self.areasum = np.bincount(ids, weights=self.area[valid], minlength=n) if self.area is not None else None
+
+        # The extents are the minimum and maximum over the cells of each region. Sorting the cells
+        # by region puts each region in a contiguous block, which np.minimum.reduceat reduces.
+        self.extent = np.empty((n, 4))
+        self.extent[:, 0::2] = np.inf
+        self.extent[:, 1::2] = -np.inf
+        if ids.size:
+            order  = np.argsort(ids, kind="mergesort")
+            starts = np.concatenate(([0], np.nonzero(np.diff(ids[order]))[0] + 1))
+            present = ids[order][starts]
+            for k, coord in enumerate((self.lats[valid][order], self.lons[valid][order])):
+                self.extent[present, 2*k]   = np.minimum.reduceat(coord, starts)
+                self.extent[present, 2*k+1] = np.maximum.reduceat(coord, starts)
+        self.dirty = set()
+
+
+    def _grow(self, ids):
+        """ Makes room for region numbers outside of the range seen so far. Returns ids - offset. """
+        lo, hi = int(ids.min()), int(ids.max())
+        if lo < self.offset:
+            pad = self.offset - lo
+            self.count   = np.concatenate((np.zeros(pad, dtype=self.count.dtype), self.count))
+            if self.areasum is not None: self.areasum = np.concatenate((np.zeros(pad), self.areasum))
+            self.extent  = np.concatenate((np.tile([np.inf, -np.inf, np.inf, -np.inf], (pad, 1)), self.extent))
+            self.dirty   = set(r + pad for r in self.dirty)
+            self.offset  = lo
+        if hi - self.offset >= len(self.count):
+            pad = hi - self.offset + 1 - len(self.count)
+            self.count   = np.concatenate((self.count, np.zeros(pad, dtype=self.count.dtype)))
+            if self.areasum is not None: self.areasum = np.concatenate((self.areasum, np.zeros(pad)))
+            self.extent  = np.concatenate((self.extent, np.tile([np.inf, -np.inf, np.inf, -np.inf], (pad, 1))))
+        return ids - self.offset
+
+
+    def update(self, i, j, old, new):
+        """
+        Updates the statistics after an edit.
+        ARGUMENTS
+            i, j - the global indices of the cells the edit set
+            old  - the (masked) values of the cells before the edit
+            new  - the (masked) values of the cells after the edit
+        """
+        i, j = np.atleast_1d(i).astype(np.intp), np.atleast_1d(j).astype(np.intp)
+        old, new = np.ma.atleast_1d(old), np.ma.atleast_1d(new)
+        # A cell listed more than once is counted once
+        first = np.unique(np.ravel_multi_index((i, j), self.lats.shape), return_index=True)[1]
+        if len(first) < len(i): i, j, old, new = i[first], j[first], old[first], new[first]
+        # Masked cells (land) are not counted. A cell leaves its old region if it was ocean, and joins
+        # its new region if it is ocean, unless the region did not change.
+        om, nm = np.ma.getmaskarray(old), np.ma.getmaskarray(new)
+        changed = np.ma.filled(old, 0) != np.ma.filled(new, 0)
+        leave = ~om & (nm | changed)
+        join  = ~nm & (om | changed)
+        if not (leave.any() or join.any()): return
+        nleave = int(leave.sum())
+        ids = self._grow(np.concatenate((np.ma.filled(old, 0)[leave], np.ma.filled(new, 0)[join])).astype(np.intp))
+        old, new = ids[:nleave], ids[nleave:]
+
+        np.subtract.at(self.count, old, 1)
+        np.add.at(self.count, new, 1)
+        if self.areasum is not None:
+            np.subtract.at(self.areasum, old, self.area[i[leave], j[leave]])
+            np.add.at(self.areasum, new, self.area[i[join], j[join]])
+
+        # A region that lost a cell on the edge of its extent may have shrunk
+        lats, lons = self.lats[i[leave], j[leave]], self.lons[i[leave], j[leave]]
+        ext = self.extent[old]
+        edge = (lats <= ext[:,0]) | (lats >= ext[:,1]) | (lons <= ext[:,2]) | (lons >= ext[:,3])
+        self.dirty.update(int(r) for r in np.unique(old[edge]))
+        lats, lons = self.lats[i[join], j[join]], self.lons[i[join], j[join]]
+        np.minimum.at(self.extent[:,0], new, lats)
+        np.maximum.at(self.extent[:,1], new, lats)
+        np.minimum.at(self.extent[:,2], new, lons)
+        np.maximum.at(self.extent[:,3], new, lons)
+
+
+    def _refresh(self):
+        """ Computes the extents of the dirty regions again. """
+        if not self.dirty: return
+        ids = np.ma.filled(self.regions, self.offset - 1).astype(np.intp) - self.offset
+        for r in self.dirty:
+            cells = (ids == r)
+            if self.count[r] == 0 or not cells.any():
+                self.extent[r] = [np.inf, -np.inf, np.inf, -np.inf]
+                continue
+            lats, lons = self.lats[cells], self.lons[cells]
+            self.extent[r] = [lats.min(), lats.max(), lons.min(), lons.max()]
+        self.dirty = set()
+
+
+    def table(self):
+        """
+        RETURNS
+            a list with a tuple (region, cells, area in m^2 or None, lat min, lat max, lon min, lon max)
+            for each region that has cells, in order of region number
+        """
+        self._refresh()
+        rows = []
+        for r in np.nonzero(self.count > 0)[0]:
+            area = float(self.areasum[r]) if self.areasum is not None else None
+            rows.append((int(r) + self.offset, int(self.count[r]), area) + tuple(float(x) for x in self.extent[r]))
+        return rows
@@ -0,0 +1,133 @@
+"""
+A persistent selection of cells of a global grid for the editors. Cells selected with the lasso,
+the rectangle or a flood fill in different views are gathered in one selection, which can then
+be edited as a whole with a single bulk edit.
+"""
+
+import numpy as np
+
+
+# How a new set of cells is combined with the selection
+MODES = ("union", "subtract", "replace")
+
+
+
+class Selection(object):
+    """
+    The selection is a bitmap of the global grid packed eight cells to a byte along the rows (as
+    by np.packbits), together with the bounding box of the selected cells. All the operations are
+    limited to a box, which is unpacked to booleans only for as long as the operation takes.
+    """
+
+    def __init__(self, ny, nx):
+        self.shape = (ny, nx)
+        self.bits  = np.zeros((ny, (nx+7)//8), dtype=np.uint8)
+        self.bbox  = None    # (i0, i1, j0, j1) such that all the selected cells are in rows i0:i1, columns j0:j1
+        self.count = 0
+
+
+    def __len__(self): return self.count
+
+
+    def _unpack(self, i0, i1, j0, j1):
+        """ Returns the cells in rows i0:i1, columns j0:j1 as a boolean array. """
+        b0 = j0//8
+        block = np.unpackbits(self.bits[i0:i1, b0:(j1+7)//8], axis=1)
+        return block[:, j0-8*b0:j1-8*b0].astype(bool)
+
+
+    def _set(self, points_i, points_j, value):
+        """ Sets the given cells to value, unpacking only the bytes of their bounding box. """
+        i0, i1 = int(points_i.min()), int(points_i.max())+1
+        b0, b1 = int(points_j.min())//8, int(points_j.max())//8+1
+        block = np.unpackbits(self.bits[i0:i1, b0:b1], axis=1)
+        block[points_i-i0, points_j-8*b0] = value
+        self.bits[i0:i1, b0:b1] = np.packbits(block, axis=1)
+
+
+    def clear(self):
+        if self.bbox is not None:
+            i0, i1, j0, j1 = self.bbox
+            self.bits[i0:i1, j0//8:(j1+7)//8] = 0
+        self.bbox  = None
+        self.count = 0
+
+
+    def add(self, points_i, points_j, mode="union"):
+        """
+        Combines a set of cells with the selection.
+        ARGUMENTS
+            points_i, points_j - arrays with the global row and column indices of the cells
+            mode               - one of MODES: add the cells to the selection, remove them from
+                                 it, or make them the new selection
+        RETURNS
+            the number of cells selected
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown selection mode {0}. Must be one of {1}".format(mode, MODES))
+        points_i = np.asarray(points_i, dtype=np.intp).ravel()
+        points_j = np.asarray(points_j, dtype=np.intp).ravel()
+        if mode == "replace": self.clear()
+
+        if mode == "subtract":
+            if self.bbox is None or len(points_i) == 0: return self.count
+            self._set(points_i, points_j, 0)
+        else:
+            if len(points_i) == 0: return self.count
+            self._set(points_i, points_j, 1)
+            box = (int(points_i.min()), int(points_i.max())+1, int(points_j.min()), int(points_j.max())+1)
+            if self.bbox is not None:
+                box = (min(box[0], self.bbox[0]), max(box[1], self.bbox[1]),
+                       min(box[2], self.bbox[2]), max(box[3], self.bbox[3]))
+            self.bbox = box
+        self._shrink()
+        return self.count
+
+
+    def _shrink(self):
+        """ Recounts the selected cells and fits the bounding box to them. """
+        i0, i1, j0, j1 = self.bbox
+        block = self._unpack(i0, i1, j0, j1)
+        rows = np.nonzero(block.any(axis=1))[0]
+        if len(rows) == 0:
+            self.bbox, self.count = None, 0
+            return
+        cols = np.nonzero(block.any(axis=0))[0]
+        self.bbox  = (i0+int(rows[0]), i0+int(rows[-1])+1, j0+int(cols[0]), j0+int(cols[-1])+1)
+        self.count = int(np.count_nonzero(block))
+
+
+    def indices(self):
+        """ Returns the (rows, cols) global indices of the selected cells in row-major order. """
+        if self.bbox is None: return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        i0, i1, j0, j1 = self.bbox
+        rows, cols = np.nonzero(self._unpack(i0, i1, j0, j1))
+        return rows + i0, cols + j0
+
+
+    def outline(self, si, sj, nrows, ncols):
+        """
+        Finds the edges between selected and unselected cells within a view, so that the outline
+        of the selection can be drawn. Cell (row, col) of the view covers [col, col+1] x [row, row+1].
+        ARGUMENTS
+            si, sj       - the global indices of the top left cell of the view
+            nrows, ncols - the size of the view
+        RETURNS
+            an (n, 2, 2) array of line segments ((x0, y0), (x1, y1)) in view coordinates, as taken
+            by matplotlib's LineCollection
+        """
+        if self.bbox is None: return np.zeros((0, 2, 2))
+        ny, nx = self.shape
+        # The view with a border of the cells around it, which are unselected beyond the grid
+        block = np.zeros((nrows+2, ncols+2), dtype=bool)
+        i0, i1 = max(0, si-1), min(ny, si+nrows+1)
+        j0, j1 = max(0, sj-1), min(nx, sj+ncols+1)
+        block[i0-si+1:i1-si+1, j0-sj+1:j1-sj+1] = self._unpack(i0, i1, j0, j1)
+
+        # Vertical edges x = c between the cells in columns c-1 and c, and horizontal edges
+        # y = r between the cells in rows r-1 and r
+        vr, vc = np.nonzero(block[1:-1, :-1] != block[1:-1, 1:])
+        hr, hc = np.nonzero(block[:-1, 1:-1] != block[1:, 1:-1])
+        vert = np.concatenate((np.c_[vc, vr][:, None], np.c_[vc, vr+1][:, None]), axis=1)
+        horz = np.concatenate((np.c_[hc, hr][:, None], np.c_[hc+1, hr][:, None]), axis=1)
+        return np.concatenate((vert, horz)).astype(np.float64)
@@ -0,0 +1,121 @@
+"""
+Smoothing of a selected set of cells of a 2D field, for TopoEditor. The whole selection is
+smoothed at once with shifted-array (convolution) sums over the bounding box of the selection,
+instead of one cell at a time.
+
+Cells outside of the grid are left out of a cell's neighbourhood, and the average is taken
+over the neighbours that exist. The single-cell keys of TopoEditor have no edge handling to
+follow: their 3x3 slice is empty on the first row or column and cut short on the last, and
+what is left is still divided by a fixed 8 or 9.
+
+In the interior of the grid 'mean8' is the average of the F key, (sum of the 3x3 block - centre)/8,
+and 'akey' that of the A key, which counts the centre twice, (sum of the 3x3 block + centre)/9
+(see DataContainer.getAverage of TopoEditor). 'mean9' is the plain mean of the 3x3 block.
+"""
+
+import numpy as np
+
+
+# The offsets (di, dj) of the cells averaged by each N-point kernel
+MEAN_KERNELS = {
+    "mean4": [(-1, 0), (1, 0), (0, -1), (0, 1)],
+    "mean5": [(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)],
+    "mean8": [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1) if (di, dj) != (0, 0)],
+    "mean9": [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)],
+}
+# Kernels that weight some cells more than others, but are divided by the number of cells as the
+# keys of TopoEditor are: name -> (offsets, weights)
+KEY_KERNELS = {
+    "akey": (MEAN_KERNELS["mean9"], [2. if o == (0, 0) else 1. for o in MEAN_KERNELS["mean9"]]),
+}
+KERNELS = sorted(MEAN_KERNELS) + sorted(KEY_KERNELS) + ["median", "gaussian"]
+
+
+
+def _shifted(a, di, dj, halo):
+    """ Returns the view of the padded array a shifted by (di, dj), trimmed of the halo. """
+    ny, nx = a.shape[0]-2*halo, a.shape[1]-2*halo
+    return a[halo+di:halo+di+ny, halo+dj:halo+dj+nx]
+
+
+
+def _smooth_once(block, kernel, sigma):
+    """
+    Smooths every cell of block, which is padded with a halo of NaN where it lies outside of
+    the grid. Returns the smoothed block without the halo.
+    """
+    valid = ~np.isnan(block)
+    vals  = np.where(valid, block, 0.)
+
+    # The sum is weighted by weights and divided by the sum of counts over the cells that exist
+    if kernel in MEAN_KERNELS:
+        halo, offsets = 1, MEAN_KERNELS[kernel]
+        weights = counts = [1.]*len(offsets)
+    elif kernel in KEY_KERNELS:
+        halo, (offsets, weights) = 1, KEY_KERNELS[kernel]
+        counts = [1.]*len(offsets)
+    elif kernel == "gaussian":
+        halo = max(1, int(np.ceil(3*sigma)))
+        offsets = [(di, dj) for di in range(-halo, halo+1) for dj in range(-halo, halo+1)]
+        weights = counts = [np.exp(-(di*di + dj*dj)/(2.*sigma*sigma)) for di, dj in offsets]
+    elif kernel == "median":
+        halo = 1
+        stack = np.array([_shifted(block, di, dj, halo) for di in (-1, 0, 1) for dj in (-1, 0, 1)])
+        # All 9 values are NaN only for cells whose neighbourhood is entirely outside the grid
+        with np.errstate(all="ignore"):
+            return np.nanmedian(stack, axis=0)
+    else:
+        raise ValueError("Unknown kernel {0}. Must be one of {1}".format(kernel, KERNELS))
+
+    total = np.zeros((block.shape[0]-2*halo, block.shape[1]-2*halo))
+    count = np.zeros_like(total)
+    for (di, dj), w, c in zip(offsets, weights, counts):
+        total += w*_shifted(vals, di, dj, halo)
+        count += c*_shifted(valid, di, dj, halo)
+    with np.errstate(all="ignore"):
+        return total/count
+
+
+
+def halo_for(kernel, sigma=1.0):
+    """ Returns the number of cells around a cell that a kernel reads. """
+    return max(1, int(np.ceil(3*sigma))) if kernel == "gaussian" else 1
+
+
+
+def smooth_selection(data, i, j, kernel="mean9", iterations=1, sigma=1.0):
+    """
+    Smooths the selected cells of a 2D field. The cells outside of the selection are not changed,
+    but are used as neighbours of the selected cells.
+    ARGUMENTS
+        data       - the 2D field (not modified)
+        i, j       - arrays with the row and column indices of the selected cells
+        kernel     - one of KERNELS: an N-point average, the average of the A key ('akey'; 'mean8'
+                     is that of the F key), the median of the 3x3 block, or a Gaussian with
+                     standard deviation sigma (in cells)
+        iterations - the number of times the kernel is applied. Each pass uses the values
+                     smoothed by the previous one.
+    RETURNS
+        an array with the new values of the selected cells, in the order of i, j
+    """
+    i = np.asarray(i, dtype=np.intp).ravel()
+    j = np.asarray(j, dtype=np.intp).ravel()
+    if i.size == 0: return np.zeros(0)
+    ny, nx = data.shape
+    halo   = halo_for(kernel, sigma)
+
+    # Only the bounding box of the selection, with the halo the kernel needs, is worked on.
+    # Parts of the halo outside of the grid are NaN.
+    i0, i1 = i.min()-halo, i.max()+halo+1
+    j0, j1 = j.min()-halo, j.max()+halo+1
+    block  = np.full((i1-i0, j1-j0), np.nan)
+    block[max(0, i0)-i0:min(ny, i1)-i0, max(0, j0)-j0:min(nx, j1)-j0] = \
+        np.ma.filled(data[max(0, i0):min(ny, i1), max(0, j0):min(nx, j1)].astype(np.float64), np.nan)
+
+    bi, bj = i - i0, j - j0
+    for n in range(max(1, int(iterations))):
+        smoothed = _smooth_once(block, kernel, sigma)
+        new = smoothed[bi-halo, bj-halo]
+        # A cell without any valid neighbours keeps its value
+        block[bi, bj] = np.where(np.isnan(new), block[bi, bj], new)
+    return block[bi, bj]
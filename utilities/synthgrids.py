@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+synthgrids.py
+
+Writes synthetic input files of realistic sizes for the editors, e.g. for editorbench.py:
+
+    python synthgrids.py benchdir --pop gx3v7 gx1v6 --topo 1deg 0.25deg
+
+The POP grids (gx3v7, gx1v6, tx0.1v2) get a file with kmt, ULAT, ULON and TAREA, which both
+KMTEditor and RMaskEditor open. The topographies (1deg, 0.25deg, 1min) get a file with latitude,
+longitude and topo (in m). The land and ocean come from the same smooth random field for every
+grid, so that about 30% of the cells are land, and are the same for the same seed.
+"""
+
+from netCDF4 import Dataset
+from collections import OrderedDict
+import numpy as np
+import sys, os, argparse
+
+
+# (ny, nx) of the POP grids
+POP_GRIDS  = OrderedDict([("gx3v7", (116, 100)), ("gx1v6", (384, 320)), ("tx0.1v2", (2400, 3600))])
+# Resolution in degrees of the topographies
+TOPO_GRIDS = OrderedDict([("1deg", 1.0), ("0.25deg", 0.25), ("1min", 1./60)])
+
+KMT_LEVELS   = 60
+EARTH_RADIUS = 6.371e8     # in cm, as POP uses
+LAND_FRACTION = 0.3
+
+
+
+class Relief(object):
+    """
+    A smooth random field of height over the sphere, a sum of products of cosines of the longitude
+    and latitude, scaled to ocean depths of up to 5500 m and land heights of up to 4000 m.
+    """
+    def __init__(self, seed=0, nterms=24):
+        rng = np.random.RandomState(seed)
+        self.m     = rng.randint(1, 12, nterms)           # zonal wave numbers
+        self.n     = rng.uniform(0.5, 8, nterms)          # meridional wave numbers
+        self.amp   = 1.0/(1 + self.m + self.n)            # larger scales are stronger
+        self.phase = rng.uniform(0, 2*np.pi, (nterms, 2))
+        # The level of the sea is chosen so that LAND_FRACTION of a coarse sample is land
+        lat, lon = np.meshgrid(np.linspace(-89, 89, 90), np.linspace(0, 358, 180), indexing="ij")
+        self.sea = 0.
+        self.sea = np.percentile(self.raw(lat, lon), 100*(1 - LAND_FRACTION))
+        h = self.raw(lat, lon) - self.sea
+        self.top, self.bottom = h.max(), -h.min()
+
+
+    def raw(self, lat, lon):
+        rlat, rlon = np.radians(lat), np.radians(lon)
+        h = np.zeros(np.broadcast(rlat, rlon).shape)
+        for m, n, a, (p, q) in zip(self.m, self.n, self.amp, self.phase):
+            h += a*np.cos(m*rlon + p)*np.cos(n*rlat + q)
+        # Antarctica, so that the south of the grids is land as on the real ones
+        return h + 2.*(lat < -72)
+
+
+    def height(self, lat, lon):
+        """ Returns the height in m of the points (lat, lon) in degrees, which broadcast together. """
+        h = self.raw(lat, lon) - self.sea
+        return np.where(h > 0, 4000./self.top*h, 5500./self.bottom*h).astype(np.float32)
+
+
+
+def write_pop_grid(fname, grid, seed=0):
+    """
+    Writes a KMT file on one of the POP_GRIDS, with KMT, ULAT, ULON (in degrees) and TAREA (in cm^2)
+    on a simple latitude-longitude grid of the same size.
+    """
+    ny, nx = POP_GRIDS[grid]
+    lats = np.linspace(-78.5, 89.5, ny)
+    lons = (np.arange(nx) + 0.5)*360./nx
+    ulat, ulon = np.meshgrid(lats, lons, indexing="ij")
+    depth = -Relief(seed).height(ulat, ulon)
+    kmt = np.where(depth > 0, np.clip(np.ceil(depth/5500.*KMT_LEVELS), 1, KMT_LEVELS), 0).astype(np.int32)
+    tarea = EARTH_RADIUS**2*np.cos(np.radians(ulat))*np.radians(lats[1] - lats[0])*np.radians(360./nx)
+
+    ncfile = Dataset(fname, "w", format="NETCDF4")
+    ncfile.createDimension("nlat", ny)
+    ncfile.createDimension("nlon", nx)
+    for name, data, dtype, units in (("kmt", kmt, "i4", None), ("ULAT", ulat, "f8", "degrees_north"),
+                                     ("ULON", ulon, "f8", "degrees_east"), ("TAREA", tarea, "f8", "centimeter^2")):
+        var = ncfile.createVariable(name, dtype, ("nlat", "nlon"))
+        if units: var.units = units
+        var[:,:] = data
+    ncfile.title = "Synthetic {0} KMT".format(grid)
+    ncfile.close()
+
+
+
+def write_topo_grid(fname, grid, seed=0, block=540):
+    """
+    Writes a topography on one of the TOPO_GRIDS, with 1D latitude and longitude and topo in m. The
+    file is written in blocks of rows, so that even the 1min grid does not have to fit in memory
+    more than once.
+    """
+    res  = TOPO_GRIDS[grid]
+    ny, nx = int(round(180/res)), int(round(360/res))
+    lats = -90 + (np.arange(ny) + 0.5)*res
+    lons = (np.arange(nx) + 0.5)*res
+    relief = Relief(seed)
+
+    ncfile = Dataset(fname, "w", format="NETCDF4")
+    ncfile.createDimension("latitude", ny)
+    ncfile.createDimension("longitude", nx)
+    ncfile.createVariable("latitude", "f8", ("latitude",))[:] = lats
+    ncfile.createVariable("longitude", "f8", ("longitude",))[:] = lons
+    topo = ncfile.createVariable("topo", "f4", ("latitude", "longitude"), chunksizes=(min(ny, 256), min(nx, 256)))
+    topo.units = "m"
+    for i in range(0, ny, block):
+        topo[i:i+block, :] = relief.height(lats[i:i+block, np.newaxis], lons[np.newaxis, :])
+    ncfile.title = "Synthetic {0} topography".format(grid)
+    ncfile.close()
+
+
+
+def pop_file(dirname, grid): return os.path.join(dirname, "kmt_{0}.nc".format(grid))
+
+def topo_file(dirname, grid): return os.path.join(dirname, "topo_{0}.nc".format(grid))
+
+
+
+def generate(dirname, pop=POP_GRIDS.keys(), topo=TOPO_GRIDS.keys(), seed=0, force=False, quiet=True):
+    """
+    Writes the files for the given grids into dirname, unless they exist already.
+    RETURNS
+        a dict with the name of the file of each grid
+    """
+    if not os.path.isdir(dirname): os.makedirs(dirname)
+    files = {}
+    for grids, path, write in ((pop, pop_file, write_pop_grid), (topo, topo_file, write_topo_grid)):
+        for grid in grids:
+            files[grid] = path(dirname, grid)
+            if os.path.exists(files[grid]) and not force: continue
+            if not quiet: sys.stdout.write("Writing {0}\n".format(files[grid]))
+            write(files[grid], grid, seed)
+    return files
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic input files for the editors')
+    parser.add_argument('dirname', nargs=1, type=str, help='directory to write the files to')
+    parser.add_argument('--pop',  nargs='*', choices=list(POP_GRIDS), help='POP grids', default=list(POP_GRIDS))
+    parser.add_argument('--topo', nargs='*', choices=list(TOPO_GRIDS), help='topography grids', default=list(TOPO_GRIDS))
+    parser.add_argument('--seed', nargs=1, type=int, help='seed of the random relief', default=[0])
+    parser.add_argument('--force', action='store_true', help='overwrite existing files')
+    args = parser.parse_args()
+    generate(args.dirname[0], args.pop, args.topo, args.seed[0], args.force, quiet=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+A cache of prepared views for the editors. When the view settles, the views that the H, J, K
+and L keys would move to next are prepared in the background (see prefetch.ViewPrefetcher):
+the data of the view is copied, its statistics computed and its cells coloured. A pan to one
+of them then only has to draw what is already prepared.
+
+Nothing in here depends on Qt, and the cache may be used from several threads.
+"""
+
+from collections import OrderedDict
+import threading
+import numpy as np
+
+
+
+def neighbour_views(si, sj, nrows, ncols, ny, nx):
+    """
+    Returns the list of the (si, sj) positions of the views that DataContainer.moveView moves
+    to from the view at (si, sj), leaving out those that are the same view.
+    """
+    col_inc = int(ncols*0.25)  # Column increment
+    row_inc = int(nrows*0.25)  # Row increment
+    views = [(si, min(nx-ncols, sj + col_inc)), (si, max(0, sj - col_inc)),
+             (max(0, si - row_inc), sj), (min(ny-nrows, si + row_inc), sj)]
+    return [v for v in views if v != (si, sj)]
+
+
+
+def prepare_view(data, si, sj, nrows, ncols, stats=None, colorize=None):
+    """
+    Prepares a view for drawing.
+    ARGUMENTS
+        data         - the 2D (possibly masked) global data
+        si, sj       - the global indices of the top left cell of the view
+        nrows, ncols - the size of the view
+        stats        - a function of (view, si, sj) that returns the statistics of the view
+        colorize     - a function that maps the view to an (nrows, ncols, 4) array of RGBA colours
+    RETURNS
+        a dict with the copy of the 'view', and its 'stats' and 'rgba' if asked for
+    """
+    view = data[si:si+nrows, sj:sj+ncols].copy()
+    item = {"view": view}
+    if stats is not None: item["stats"] = stats(view, si, sj)
+    if colorize is not None: item["rgba"] = colorize(view)
+    return item
+
+
+
+def face_colors(item, view=None):
+    """
+    Returns the RGBA colours of a prepared view in the order of the cells of the collection that
+    pcolor draws, which leaves out the masked cells.
+    """
+    rgba = item["rgba"]
+    mask = np.ma.getmaskarray(item["view"] if view is None else view)
+    return rgba[~mask].reshape(-1, 4)
+
+
+
+class ViewCache(object):
+    """
+    A least-recently-used cache of prepared views, keyed by the (si, sj) position of the view.
+
+    Edits invalidate the views that contain the edited cells. A view that was being prepared while
+    an edit was made may have read the data before the edit, so every invalidation starts a new
+    'epoch', and put only accepts views that were prepared within the current epoch.
+    """
+
+    def __init__(self, maxitems=16):
+        self.maxitems = maxitems
+        self.items    = OrderedDict()
+        self.epoch    = 0
+        self.lock     = threading.Lock()
+        self.hits     = 0
+        self.misses   = 0
+
+
+    def __contains__(self, key):
+        with self.lock: return key in self.items
+
+
+    def get(self, key):
+        """ Returns the prepared view at key, or None, and marks it as the most recently used. """
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items[key] = item
+            self.hits += 1
+            return item
+
+
+    def peek(self, key):
+        """ Returns the prepared view at key, or None, without counting it as used. """
+        with self.lock: return self.items.get(key)
+
+
+    def put(self, key, item, epoch):
+        """
+        Stores a prepared view, unless the cache was invalidated after the view started being
+        prepared, i.e. if epoch is not the current epoch. Returns True if the view was stored.
+        """
+        with self.lock:
+            if epoch != self.epoch: return False
+            self.items.pop(key, None)
+            self.items[key] = item
+            while len(self.items) > self.maxitems:
+                self.items.popitem(last=False)
+            return True
+
+
+    def invalidate(self, points_i, points_j):
+        """ Drops the views that contain any of the given global cells. """
+        points_i = np.atleast_1d(points_i)
+        points_j = np.atleast_1d(points_j)
+        if points_i.size == 0: return
+        i0, i1 = points_i.min(), points_i.max()
+        j0, j1 = points_j.min(), points_j.max()
+        with self.lock:
+            self.epoch += 1
+            for (si, sj), item in list(self.items.items()):
+                nrows, ncols = item["view"].shape
+                # The bounding box of the cells is checked first, as most edits are far from most views
+                if i1 < si or i0 >= si+nrows or j1 < sj or j0 >= sj+ncols: continue
+                if np.any((points_i >= si) & (points_i < si+nrows) & (points_j >= sj) & (points_j < sj+ncols)):
+                    del self.items[(si, sj)]
+
+
+    def clear(self):
+        """ Drops all the views, e.g. when the colour map changes. """
+        with self.lock:
+            self.epoch += 1
+            self.items.clear()